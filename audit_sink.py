@@ -0,0 +1,99 @@
+# audit_sink.py
+import atexit
+import queue
+import threading
+from config import logger
+
+
+class AuditSink:
+    """
+    Buffer en memoria para los eventos de auditoría.
+
+    Los handlers solo encolan (sin tocar la BD); un hilo en segundo plano
+    escribe los eventos por lotes cuando se acumulan `batch_size` o cada
+    `flush_interval` segundos, lo que ocurra antes. La cola está acotada: si
+    se llena, el evento se descarta y se cuenta en `dropped`. Al salir del
+    proceso se vacía lo pendiente.
+    """
+
+    def __init__(self, write_batch, max_queue=10000, batch_size=200, flush_interval=2.0):
+        self._write_batch = write_batch
+        self._queue = queue.Queue(maxsize=max_queue)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self.stats = {'enqueued': 0, 'flushed': 0, 'dropped': 0, 'failed': 0, 'batches': 0}
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self.stats[key] += amount
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="audit-sink", daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def submit(self, event):
+        """Encola un evento; devuelve False si se descartó por cola llena."""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self._count('dropped')
+            return False
+        self._count('enqueued')
+        if self._queue.qsize() >= self.batch_size:
+            self._wakeup.set()
+        return True
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """Escribe todo lo encolado, en lotes de como mucho `batch_size` eventos."""
+        with self._flush_lock:
+            while True:
+                batch = []
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if not batch:
+                    return
+
+                try:
+                    self._write_batch(batch)
+                except Exception as e:
+                    logger.error(f"Error escribiendo lote de auditoría ({len(batch)} eventos): {e}")
+                    self._count('failed', len(batch))
+                    continue
+                self._count('flushed', len(batch))
+                self._count('batches')
+
+    def stop(self, timeout=5):
+        """Detiene el hilo y vacía los eventos pendientes."""
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+        self.flush()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+        stats['queued'] = self._queue.qsize()
+        return stats
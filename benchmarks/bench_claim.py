@@ -0,0 +1,200 @@
+# benchmarks/bench_claim.py
+"""
+Benchmark de concurrencia de la aceptación de solicitudes.
+
+N hilos (50 por defecto) aceptan solicitudes a la vez en dos escenarios:
+
+  - misma:      en cada ronda todos los hilos compiten por la misma solicitud
+  - distintas:  cada hilo acepta sus propias solicitudes (sin conflicto)
+
+y se comparan dos implementaciones:
+
+  - antes:   leer el estado y después escribir (SELECT + UPDATE)
+  - después: db.claim_solicitud, una única UPDATE condicional
+
+Se informa del rendimiento (aceptaciones intentadas por segundo), la
+latencia y la corrección: en "misma" debe haber exactamente un ganador por
+solicitud y coincidir con `transportista_asignado`; en "distintas" deben
+ganar todas.
+
+Uso:
+    python benchmarks/bench_claim.py [--threads 50] [--rounds 100] [--per-thread 40]
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('BOT_TOKEN', '0:benchmark')
+
+import db  # noqa: E402
+
+CONFIRM_UNTIL = '2099-01-01 00:00:00'
+SOLICITANTE_TID = 1
+FIRST_CARRIER_TID = 1000
+# Todas las solicitudes del benchmark están en la zona 1
+WORK_ZONES = [1]
+
+
+def claim_read_then_write(solicitud_id, transportista_tid, confirm_until):
+    """Patrón ingenuo: comprobar el estado y luego asignar."""
+    try:
+        with db.db_connection() as conn:
+            row = conn.execute("SELECT estado FROM solicitudes WHERE id = ?", (solicitud_id,)).fetchone()
+            if row is None or row['estado'] != 'activa':
+                return None
+            conn.execute('''
+                UPDATE solicitudes
+                SET estado = 'pendiente_confirmacion',
+                    transportista_asignado = (SELECT id FROM usuarios WHERE telegram_id = ?),
+                    pending_confirm_until = ?
+                WHERE id = ?
+            ''', (transportista_tid, confirm_until, solicitud_id))
+        return SOLICITANTE_TID
+    except Exception:
+        return 'error'
+
+
+def claim_conditional(solicitud_id, transportista_tid, confirm_until):
+    claimed, solicitante_tid = db.claim_solicitud(solicitud_id, transportista_tid, confirm_until, WORK_ZONES)
+    return solicitante_tid if claimed else None
+
+
+def setup(path, n_threads):
+    db._pool = db.ConnectionPool(path)
+    db.init_db()
+    with db.db_connection() as conn:
+        conn.executemany(
+            "INSERT INTO usuarios (telegram_id, nombre_completo, tipo, estado) VALUES (?, ?, ?, 'activo')",
+            [(SOLICITANTE_TID, 'Solicitante', 'solicitante')]
+            + [(FIRST_CARRIER_TID + i, f'Transportista {i}', 'transportista') for i in range(n_threads)]
+        )
+
+
+def create_solicitudes(count):
+    with db.db_connection() as conn:
+        solicitante_id = conn.execute(
+            "SELECT id FROM usuarios WHERE telegram_id = ?", (SOLICITANTE_TID,)
+        ).fetchone()[0]
+        first = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM solicitudes").fetchone()[0]
+        conn.executemany(
+            "INSERT INTO solicitudes (usuario_id, zona_id, vehicle_type, cargo_type, estado) "
+            "VALUES (?, 1, 'Moto/Bicicleta', 'Paquete pequeño', 'activa')",
+            [(solicitante_id,)] * count
+        )
+    return list(range(first, first + count))
+
+
+def run_threads(n_threads, work):
+    """Ejecuta work(i) en n hilos que arrancan a la vez; devuelve (segundos, resultados por hilo)."""
+    barrier = threading.Barrier(n_threads + 1)
+    results = [None] * n_threads
+
+    def worker(i):
+        barrier.wait()
+        results[i] = work(i)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(n_threads)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, results
+
+
+def timed_claim(claim, solicitud_id, carrier_tid, latencies):
+    start = time.perf_counter()
+    result = claim(solicitud_id, carrier_tid, CONFIRM_UNTIL)
+    latencies.append((time.perf_counter() - start) * 1000)
+    return result
+
+
+def assigned_carriers(solicitud_ids):
+    with db.db_connection() as conn:
+        rows = conn.execute(f'''
+            SELECT s.id, u.telegram_id FROM solicitudes s
+            LEFT JOIN usuarios u ON u.id = s.transportista_asignado
+            WHERE s.id IN ({', '.join('?' * len(solicitud_ids))})
+        ''', solicitud_ids).fetchall()
+    return {row[0]: row[1] for row in rows}
+
+
+def bench_same(label, claim, n_threads, rounds):
+    """Todos los hilos contra la misma solicitud, `rounds` veces."""
+    latencies = []
+    elapsed = 0.0
+    winners_by_request = {}
+    errors = 0
+    for _ in range(rounds):
+        solicitud_id = create_solicitudes(1)[0]
+        seconds, results = run_threads(
+            n_threads, lambda i: timed_claim(claim, solicitud_id, FIRST_CARRIER_TID + i, latencies)
+        )
+        elapsed += seconds
+        winners_by_request[solicitud_id] = [FIRST_CARRIER_TID + i for i, r in enumerate(results) if r not in (None, 'error')]
+        errors += sum(1 for r in results if r == 'error')
+
+    assigned = assigned_carriers(list(winners_by_request))
+    double = sum(1 for winners in winners_by_request.values() if len(winners) > 1)
+    none = sum(1 for winners in winners_by_request.values() if not winners)
+    mismatched = sum(
+        1 for sid, winners in winners_by_request.items() if len(winners) == 1 and assigned[sid] != winners[0]
+    )
+    report(label, 'misma', n_threads * rounds, elapsed, latencies,
+           f"doble asignación={double}  sin ganador={none}  discrepancias={mismatched}  errores={errors}")
+
+
+def bench_distinct(label, claim, n_threads, per_thread):
+    """Cada hilo acepta sus propias `per_thread` solicitudes."""
+    latencies = []
+    ids = create_solicitudes(n_threads * per_thread)
+    chunks = [ids[i * per_thread:(i + 1) * per_thread] for i in range(n_threads)]
+
+    def work(i):
+        return [timed_claim(claim, sid, FIRST_CARRIER_TID + i, latencies) for sid in chunks[i]]
+
+    elapsed, results = run_threads(n_threads, work)
+    flat = [r for chunk in results for r in chunk]
+    lost = sum(1 for r in flat if r is None)
+    errors = sum(1 for r in flat if r == 'error')
+    assigned = assigned_carriers(ids)
+    mismatched = sum(
+        1 for i, chunk in enumerate(chunks) for sid in chunk if assigned[sid] != FIRST_CARRIER_TID + i
+    )
+    report(label, 'distintas', len(flat), elapsed, latencies,
+           f"fallidas={lost}  discrepancias={mismatched}  errores={errors}")
+
+
+def report(label, scenario, attempts, elapsed, latencies, correctness):
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print(
+        f"{label:<8} {scenario:<10} {attempts / elapsed:8.0f} aceptaciones/s  "
+        f"p50={statistics.median(latencies):7.3f} ms  p99={p99:8.3f} ms  {correctness}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=50)
+    parser.add_argument('--rounds', type=int, default=100)
+    parser.add_argument('--per-thread', type=int, default=40)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, claim in (("antes", claim_read_then_write), ("después", claim_conditional)):
+            setup(os.path.join(tmp, f'{label}.db'), args.threads)
+            bench_same(label, claim, args.threads, args.rounds)
+            bench_distinct(label, claim, args.threads, args.per_thread)
+            db.flush_audit_log()
+            db._pool.close_all()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+# benchmarks/bench_db_pool.py
+"""
+Benchmark del pool de conexiones SQLite.
+
+Simula el trabajo de base de datos de un update típico (un callback del
+registro más el panel de administración) y compara:
+
+  - antes:   una conexión nueva por helper, sin PRAGMAs (comportamiento original)
+  - después: pool persistente con WAL, synchronous=NORMAL y caché ajustada
+
+Uso:
+    python benchmarks/bench_db_pool.py [--updates 2000] [--users 500]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('BOT_TOKEN', '0:benchmark')
+
+import db  # noqa: E402
+
+
+class LegacyPool(db.ConnectionPool):
+    """Reproduce el patrón anterior: conectar y cerrar en cada helper."""
+
+    def __init__(self, database):
+        super().__init__(database, max_idle=0)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database, timeout=10, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        with self._lock:
+            self.stats['connects'] += 1
+        return conn
+
+
+def simulate_update(telegram_id):
+    """Secuencia de helpers que ejecuta un callback de registro."""
+    db.get_user_language(telegram_id)
+    user = db.get_user_by_telegram_id(telegram_id)
+    db.set_user_registration_data(
+        telegram_id=telegram_id,
+        username=f"user{telegram_id}",
+        name=user['nombre_completo'] if user else "Usuario",
+        phone="",
+        user_type='solicitante',
+        pais_id=1,
+        provincia_id=random.randint(1, 15),
+        zona_id=None,
+        lang='es'
+    )
+    db.set_user_state(telegram_id, 'waiting_zonas')
+    db.get_admin_data(telegram_id)
+    db.log_audit("bench_update", telegram_id, "registro")
+
+
+def run(label, pool, n_updates, n_users):
+    db._pool = pool
+    db.init_db()
+    for tid in range(1, n_users + 1):
+        db.set_user_registration_data(tid, f"user{tid}", "Usuario", "", 'pendiente', None, None, None)
+
+    before = dict(pool.stats)
+    latencies = []
+    for _ in range(n_updates):
+        tid = random.randint(1, n_users)
+        start = time.perf_counter()
+        simulate_update(tid)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    connects = pool.stats['connects'] - before['connects']
+    db.flush_audit_log()
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print(
+        f"{label:<8} connects/update={connects / n_updates:5.2f}  "
+        f"p50={statistics.median(latencies):7.3f} ms  p99={p99:7.3f} ms"
+    )
+    pool.close_all()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=500)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        random.seed(42)
+        run("antes", LegacyPool(os.path.join(tmp, 'legacy.db')), args.updates, args.users)
+        random.seed(42)
+        run("después", db.ConnectionPool(os.path.join(tmp, 'pooled.db')), args.updates, args.users)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+# benchmarks/bench_registration.py
+"""
+Micro-benchmark del embudo de registro completo (idioma → tipo → país →
+provincia → zona) para N usuarios simulados.
+
+  - antes:   SELECT + INSERT/UPDATE por paso y set_user_state aparte, cada
+             escritura en su propia transacción (patrón original)
+  - después: cada paso es un update con unidad de trabajo y UPSERT parcial
+
+Uso:
+    python benchmarks/bench_registration.py [--users 10000]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('BOT_TOKEN', '0:benchmark')
+
+import logging  # noqa: E402
+import db  # noqa: E402
+from config import STATE_WAITING_ROLE, STATE_ACTIVE, ROLE_PENDIENTE, ROLE_TRANSPORTISTA  # noqa: E402
+
+logging.disable(logging.INFO)
+
+
+class TracedPool(db.ConnectionPool):
+    """Pool que cuenta sentencias de escritura y transacciones confirmadas."""
+
+    def __init__(self, database):
+        super().__init__(database)
+        self.writes = 0
+        self.commits = 0
+        self.statements = 0
+
+    def _connect(self):
+        conn = super()._connect()
+        conn.set_trace_callback(self._trace)
+        return conn
+
+    def _trace(self, statement):
+        if statement.startswith('PRAGMA'):
+            return
+        self.statements += 1
+        keyword = statement.lstrip().split(' ', 1)[0]
+        if keyword in ('INSERT', 'UPDATE'):
+            self.writes += 1
+        elif keyword == 'COMMIT':
+            self.commits += 1
+
+
+# --- Patrón original (copiado del registro previo a los UPSERT) ---
+
+def legacy_save(telegram_id, username, name, phone, user_type, pais_id, provincia_id, zona_id, lang):
+    with db.db_connection() as conn:
+        if conn.execute("SELECT id FROM usuarios WHERE telegram_id = ?", (telegram_id,)).fetchone():
+            conn.execute('''
+                UPDATE usuarios SET username = ?, nombre_completo = ?, telefono = ?, tipo = ?,
+                pais_id = ?, provincia_id = ?, zona_id = ?, idioma = ?, estado = 'activo'
+                WHERE telegram_id = ?
+            ''', (username, name, phone, user_type, pais_id, provincia_id, zona_id, lang, telegram_id))
+        else:
+            conn.execute('''
+                INSERT INTO usuarios (telegram_id, username, nombre_completo, telefono, tipo, pais_id, provincia_id, zona_id, idioma, estado)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'activo')
+            ''', (telegram_id, username, name, phone, user_type, pais_id, provincia_id, zona_id, lang))
+
+
+def legacy_state(telegram_id, state):
+    with db.db_connection() as conn:
+        conn.execute("UPDATE usuarios SET estado = ? WHERE telegram_id = ?", (state, telegram_id))
+
+
+def legacy_load(telegram_id):
+    with db.db_connection() as conn:
+        user = dict(conn.execute("SELECT * FROM usuarios WHERE telegram_id = ?", (telegram_id,)).fetchone())
+    user['zonas_trabajo_ids'] = json.loads(user['zonas_trabajo_ids'] or '[]')
+    return user
+
+
+def legacy_funnel(tid):
+    legacy_save(tid, f"u{tid}", "Usuario", "", ROLE_PENDIENTE, None, None, None, 'es')
+    legacy_state(tid, STATE_WAITING_ROLE)
+    for step in ('tipo', 'pais', 'provincia', 'zona'):
+        u = legacy_load(tid)
+        legacy_save(
+            tid, f"u{tid}", u['nombre_completo'], u['telefono'],
+            ROLE_TRANSPORTISTA if step == 'tipo' else u['tipo'],
+            1 if step == 'pais' else u['pais_id'],
+            2 if step == 'provincia' else u['provincia_id'],
+            3 if step == 'zona' else u['zona_id'],
+            u['idioma']
+        )
+    legacy_state(tid, STATE_ACTIVE)
+
+
+# --- Patrón actual: una unidad de trabajo por update ---
+
+def upsert_funnel(tid):
+    with db.unit_of_work():  # handle_language_selection
+        db.upsert_user(tid, username=f"u{tid}", nombre_completo="Usuario", telefono="",
+                       tipo=ROLE_PENDIENTE, pais_id=None, provincia_id=None, zona_id=None,
+                       idioma='es', estado=STATE_WAITING_ROLE)
+    for step, value in (('tipo', ROLE_TRANSPORTISTA), ('pais', 1), ('provincia', 2)):
+        with db.unit_of_work():  # handle_user_type / country / provincia
+            u = db.get_user_by_telegram_id(tid)
+            db.set_user_registration_data(
+                tid, f"u{tid}", u['nombre_completo'], u['telefono'],
+                value if step == 'tipo' else u['tipo'],
+                value if step == 'pais' else u['pais_id'],
+                value if step == 'provincia' else u['provincia_id'],
+                u['zona_id'], u['idioma']
+            )
+    with db.unit_of_work():  # handle_zona_selection
+        if db.get_user_by_telegram_id(tid):
+            db.upsert_user(tid, username=f"u{tid}", zona_id=3, estado=STATE_ACTIVE)
+
+
+def run(label, funnel, path, n_users):
+    pool = TracedPool(path)
+    db._pool = pool
+    db.init_db()
+    pool.writes = pool.commits = pool.statements = 0
+
+    start = time.perf_counter()
+    for tid in range(1_000_000, 1_000_000 + n_users):
+        funnel(tid)
+    elapsed = time.perf_counter() - start
+
+    print(
+        f"{label:<8} {n_users} usuarios en {elapsed:6.2f} s  "
+        f"({n_users / elapsed:8.0f} usuarios/s)  "
+        f"sentencias/usuario={pool.statements / n_users:5.2f}  "
+        f"escrituras/usuario={pool.writes / n_users:5.2f}  "
+        f"commits/usuario={pool.commits / n_users:5.2f}"
+    )
+    pool.close_all()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=10000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        run("antes", legacy_funnel, os.path.join(tmp, 'legacy.db'), args.users)
+        run("después", upsert_funnel, os.path.join(tmp, 'upsert.db'), args.users)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,8 @@
 # bot_instance.py
 import telebot
+from telebot.handler_backends import BaseMiddleware
 from config import logger, BOT_TOKEN # Importamos el token de configu.py (config)
+from db import begin_unit_of_work, end_unit_of_work
 
 # -------------------------------------------------------------
 # 🚨 SOLUCIÓN AL ImportError: user_states 🚨
@@ -9,6 +11,31 @@ from config import logger, BOT_TOKEN # Importamos el token de configu.py (config
 # Este diccionario almacena el estado temporal de los usuarios (ej. el FSM de administración)
 user_states = {} 
 
+
+class UnitOfWorkMiddleware(BaseMiddleware):
+    """
+    Abre una unidad de trabajo de BD por update: la fila del usuario (y la de
+    administrador) se carga una sola vez y las escrituras se aplican juntas
+    cuando el handler termina. Se ejecuta en el mismo hilo que el handler.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.update_types = ['message', 'edited_message', 'callback_query', 'inline_query']
+
+    def pre_process(self, message, data):
+        data['uow'] = begin_unit_of_work()
+
+    def post_process(self, message, data, exception):
+        try:
+            end_unit_of_work(data['uow'])
+        except Exception:
+            # Ya registrado en end_unit_of_work; el usuario debe saber que no se guardó
+            try:
+                bot.send_message(message.from_user.id, "❌ No se pudieron guardar los cambios. Inténtalo de nuevo.")
+            except Exception as e:
+                logger.error(f"Error avisando del fallo al guardar a {message.from_user.id}: {e}")
+
 # 2. Inicialización de la Instancia del Bot
 if not BOT_TOKEN:
     logger.error("❌ BOT_TOKEN no encontrado. No se puede inicializar el bot.")
@@ -16,7 +43,8 @@ if not BOT_TOKEN:
 else:
     try:
         # Usamos el BOT_TOKEN importado de config
-        bot = telebot.TeleBot(BOT_TOKEN, parse_mode='HTML')
+        bot = telebot.TeleBot(BOT_TOKEN, parse_mode='HTML', use_class_middlewares=True)
+        bot.setup_middleware(UnitOfWorkMiddleware())
         logger.info("✅ Instancia del bot creada.")
     except Exception as e:
         logger.error(f"❌ Error al inicializar TeleBot: {e}")
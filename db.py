@@ -1,203 +1,335 @@
 # db.py
-import sqlite3
 import json
-from config import logger, ADMIN_SUPREMO, ADMIN_SUPREMO_ID
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
+from audit_sink import AuditSink
+from config import logger, ADMIN_SUPREMO, ADMIN_SUPREMO_ID, ADMIN_PERMISSIONS, ROLE_TRANSPORTISTA, ROLE_AMBOS, STATE_BANNED
+from migrations import apply_migrations, STATS_COUNTERS_REBUILD_SQL, SOLICITUDES_COLUMNS
+
+DATABASE_FILE = os.getenv('DATABASE_FILE', 'ecotransportistas.db')
+
+# --- Parámetros del pool de conexiones ---
+DB_BUSY_TIMEOUT_MS = int(os.getenv('DB_BUSY_TIMEOUT_MS', 10000))
+DB_CACHE_SIZE_KB = int(os.getenv('DB_CACHE_SIZE_KB', 8192))
+DB_POOL_MAX_IDLE = int(os.getenv('DB_POOL_MAX_IDLE', 8))
+
+# --- Parámetros del buffer de auditoría ---
+AUDIT_QUEUE_MAX = int(os.getenv('AUDIT_QUEUE_MAX', 10000))
+AUDIT_BATCH_SIZE = int(os.getenv('AUDIT_BATCH_SIZE', 200))
+AUDIT_FLUSH_INTERVAL = float(os.getenv('AUDIT_FLUSH_INTERVAL', 2.0))
+
+# Caché de roles de administrador (telegram_id → datos de admin o None)
+ADMIN_CACHE_TTL = float(os.getenv('ADMIN_CACHE_TTL', 60))
+ADMIN_CACHE_MAX = int(os.getenv('ADMIN_CACHE_MAX', 10000))
+LANGUAGE_CACHE_MAX = int(os.getenv('LANGUAGE_CACHE_MAX', 50000))
 
-DATABASE_FILE = 'ecotransportistas.db'
 
-def get_db_connection():
+class ConnectionPool:
     """
-    Establece y devuelve una conexión a la base de datos SQLite.
-    Configura el 'row_factory' para acceder a las columnas por nombre.
+    Pool de conexiones SQLite persistentes y reutilizables.
+
+    Un hilo conserva la misma conexión mientras tenga adquisiciones abiertas:
+    las adquisiciones anidadas (un helper que llama a otro) comparten conexión
+    y transacción. Al liberar la última se confirma (o se revierte si algún
+    nivel falló) y la conexión vuelve al pool en lugar de cerrarse.
     """
-    try:
-        conn = sqlite3.connect(DATABASE_FILE, timeout=10)
+
+    def __init__(self, database, max_idle=DB_POOL_MAX_IDLE):
+        self.database = database
+        self.max_idle = max_idle
+        self._idle = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.stats = {'connects': 0, 'acquires': 0}
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.database,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False  # Una conexión solo la usa un hilo a la vez
+        )
         # Permite acceder a los resultados por nombre de columna
         conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        with self._lock:
+            self.stats['connects'] += 1
         return conn
-    except sqlite3.Error as e:
-        logger.error(f"Error conectando a la base de datos {DATABASE_FILE}: {e}")
-        return None
 
-def init_db():
+    def acquire(self):
+        """Devuelve la conexión del hilo actual, tomándola del pool si no tiene una."""
+        local = self._local
+        conn = getattr(local, 'conn', None)
+        if conn is not None:
+            local.depth += 1
+        else:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                conn = self._connect()
+            local.conn = conn
+            local.depth = 1
+            local.failed = False
+        with self._lock:
+            self.stats['acquires'] += 1
+        return conn
+
+    def release(self, conn, commit=True):
+        """Libera una adquisición; la última confirma la transacción y devuelve la conexión."""
+        local = self._local
+        if getattr(local, 'conn', None) is not conn:
+            raise RuntimeError("La conexión no pertenece a este hilo")
+        if not commit:
+            local.failed = True
+        local.depth -= 1
+        if local.depth > 0:
+            return
+
+        local.conn = None
+        if conn.in_transaction:
+            try:
+                if local.failed:
+                    conn.rollback()
+                else:
+                    conn.commit()
+            except sqlite3.Error as e:
+                # La conexión no vuelve al pool: al cerrarla SQLite descarta lo
+                # que quedara de la transacción. El error se propaga para que
+                # quien escribió no dé por buena una escritura perdida.
+                logger.error(f"Error finalizando transacción en {self.database}: {e}")
+                conn.close()
+                raise
+
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close_all(self):
+        """Cierra las conexiones inactivas del pool (p. ej. al apagar el bot)."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+_pool = ConnectionPool(DATABASE_FILE)
+
+
+def acquire_connection():
+    """Obtiene una conexión del pool. Debe devolverse con release_connection()."""
+    return _pool.acquire()
+
+
+def release_connection(conn, commit=True):
+    """Devuelve una conexión al pool, confirmando o revirtiendo la transacción."""
+    _pool.release(conn, commit=commit)
+
+
+@contextmanager
+def db_connection():
+    """
+    Context manager sobre acquire/release: confirma al salir y revierte si hay
+    una excepción. Si el commit falla, la excepción sale del bloque `with`.
+    Es la forma habitual de acceder a la base de datos.
+    """
+    conn = _pool.acquire()
     try:
-        conn = get_db_connection()
-        if not conn:
-            logger.error("❌ No se pudo conectar a la base de datos")
-            return False
-            
-        cursor = conn.cursor()
+        yield conn
+    except BaseException:
+        try:
+            _pool.release(conn, commit=False)
+        except sqlite3.Error:
+            pass  # Ya registrado; prevalece la excepción original
+        raise
+    else:
+        _pool.release(conn)
 
-        # --- 1. CREACIÓN DE TABLAS ---
 
-        # TABLA DE USUARIOS
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS usuarios (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                telegram_id INTEGER UNIQUE,
-                username TEXT,
-                nombre_completo TEXT,
-                telefono TEXT,
-                tipo TEXT,
-                
-                -- Nuevas columnas de ID para geografía de residencia
-                pais_id INTEGER,
-                provincia_id INTEGER,
-                zona_id INTEGER,
-                
-                idioma TEXT DEFAULT 'es',
-                estado TEXT DEFAULT 'activo',
-                vehiculos TEXT DEFAULT '[]',
-                
-                -- Nueva columna para filtros de zona de trabajo del transportista
-                zonas_trabajo_ids TEXT DEFAULT '[]', 
-                
-                creado_en TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # TABLA DE ADMINISTRADORES
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS administradores (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                usuario_id INTEGER,
-                nivel TEXT,
-                
-                -- Nuevas columnas de ID para jurisdicción
-                pais_id INTEGER, 
-                provincia_id INTEGER,
-                zona_id INTEGER,
-                
-                comision_transportistas REAL DEFAULT 100,
-                comision_solicitantes REAL DEFAULT 50,
-                porcentaje_minimo_ganancia REAL DEFAULT 5,
-                
-                estado TEXT DEFAULT 'activo',
-                creado_en TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                
-                FOREIGN KEY(usuario_id) REFERENCES usuarios(id)
-            )
-        ''')
-        
-        # TABLAS GEOGRÁFICAS
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS paises (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                nombre TEXT UNIQUE,
-                codigo TEXT UNIQUE,
-                creado_por_admin_id INTEGER,
-                estado TEXT DEFAULT 'activo',
-                creado_en TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY(creado_por_admin_id) REFERENCES usuarios(id)
-            )
-        ''')
+def get_pool_stats():
+    """Devuelve los contadores del pool (conexiones abiertas y adquisiciones)."""
+    with _pool._lock:
+        return dict(_pool.stats)
 
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS provincias (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                pais_id INTEGER,
-                nombre TEXT,
-                creado_por_admin_id INTEGER,
-                estado TEXT DEFAULT 'activo',
-                creado_en TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(pais_id, nombre),
-                FOREIGN KEY(pais_id) REFERENCES paises(id),
-                FOREIGN KEY(creado_por_admin_id) REFERENCES usuarios(id)
-            )
-        ''')
 
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS zonas (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                provincia_id INTEGER,
-                nombre TEXT,
-                creado_por_admin_id INTEGER,
-                estado TEXT DEFAULT 'activo',
-                creado_en TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(provincia_id, nombre),
-                FOREIGN KEY(provincia_id) REFERENCES provincias(id),
-                FOREIGN KEY(creado_por_admin_id) REFERENCES usuarios(id)
-            )
-        ''')
+def close_pool():
+    _pool.close_all()
 
-        # TABLA DE SOLICITUDES
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS solicitudes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                usuario_id INTEGER,
-                pais_id INTEGER,
-                provincia_id INTEGER,
-                zona_id INTEGER,
-                vehicle_type TEXT,
-                cargo_type TEXT,
-                description TEXT,
-                pickup TEXT,
-                delivery TEXT,
-                budget REAL,
-                estado TEXT DEFAULT 'activa',
-                transportista_asignado INTEGER,
-                pending_confirm_until TIMESTAMP,
-                creado_en TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                
-                FOREIGN KEY(usuario_id) REFERENCES usuarios(id),
-                FOREIGN KEY(transportista_asignado) REFERENCES usuarios(id)
-            )
-        ''')
-        
-        # TABLA DE VEHÍCULOS
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS vehiculos (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                usuario_id INTEGER,
-                tipo TEXT,
-                placa TEXT UNIQUE,
-                capacidad_toneladas REAL,
-                estado TEXT DEFAULT 'activo',
-                FOREIGN KEY(usuario_id) REFERENCES usuarios(id)
-            )
-        ''')
 
-        # TABLA DE AUDITORÍA
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS auditoria (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                accion TEXT,
-                usuario_id INTEGER,
-                detalles TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # --- 2. INSERCIÓN DEL ADMINISTRADOR SUPREMO ---
-        # 1. Asegurar que el Admin Supremo esté registrado en la tabla `usuarios`
-        cursor.execute("SELECT id FROM usuarios WHERE telegram_id = ?", (ADMIN_SUPREMO_ID,))
-        admin_user_id = cursor.fetchone()
-        
-        if not admin_user_id:
-            # Insertar al admin supremo en la tabla de usuarios
-            cursor.execute('''
-                INSERT INTO usuarios (telegram_id, username, nombre_completo, telefono, tipo, pais_id, provincia_id, zona_id, estado)
-                VALUES (?, ?, ?, ?, ?, NULL, NULL, NULL, 'activo')
-            ''', (ADMIN_SUPREMO_ID, ADMIN_SUPREMO, "Admin Supremo", "N/A", "ambos"))
-            admin_user_id = cursor.lastrowid
-            logger.info(f"✅ Admin Supremo insertado en usuarios con ID: {admin_user_id}")
+# --- Unidad de trabajo por update ---
+
+_uow_local = threading.local()
+
+
+class UnitOfWork:
+    """
+    Mapa de identidad del update en curso.
+
+    Guarda la fila de `usuarios` y la de `administradores` de cada Telegram ID
+    leído durante el update, y acumula las escrituras sobre `usuarios`
+    fusionadas por columna. flush() las aplica todas en una sola transacción.
+    """
+
+    def __init__(self):
+        self.users = {}          # telegram_id -> dict de la fila (None si no existe)
+        self.admins = {}         # telegram_id -> datos de admin (None si no es admin)
+        self.pending_users = {}  # telegram_id -> {columna: valor}
+        self.upserts = set()     # telegram_id cuyas escrituras pueden crear la fila
+        self.depth = 0
+
+    def stage_user_write(self, telegram_id, changes, upsert=False):
+        """Registra cambios pendientes y los refleja en la fila cacheada."""
+        self.pending_users.setdefault(telegram_id, {}).update(changes)
+        if upsert:
+            self.upserts.add(telegram_id)
+        cached = self.users.get(telegram_id)
+        if cached is not None:
+            cached.update(changes)
         else:
-            admin_user_id = admin_user_id[0]
-            
-        # 2. Asegurar que el Admin Supremo tenga rol en la tabla `administradores`
-        cursor.execute("SELECT nivel FROM administradores WHERE usuario_id = ? AND estado = 'activo'", (admin_user_id,))
-        admin_role = cursor.fetchone()
-        
-        if not admin_role:
-            cursor.execute('''
-                INSERT INTO administradores (usuario_id, nivel, pais_id, provincia_id, zona_id, estado)
-                VALUES (?, ?, NULL, NULL, NULL, 'activo')
-            ''', (admin_user_id, 'supremo'))
-            logger.info("✅ Rol de Admin Supremo asignado en administradores")
-            
-        # --- 3. FINALIZACIÓN ---
-        conn.commit()
-        conn.close()
+            # Fila inexistente o no leída: se releerá tras el flush
+            self.users.pop(telegram_id, None)
+
+    def flush_user(self, telegram_id):
+        changes = self.pending_users.pop(telegram_id, None)
+        if changes is None:
+            return
+        upsert = telegram_id in self.upserts
+        self.upserts.discard(telegram_id)
+        with db_connection() as conn:
+            _write_user_changes(conn, telegram_id, changes, upsert)
+        _remember_language(telegram_id, changes)
+        _notify_user_changed(telegram_id, changes)
+
+    def flush(self):
+        if not self.pending_users:
+            return
+        with db_connection() as conn:
+            for telegram_id, changes in self.pending_users.items():
+                _write_user_changes(conn, telegram_id, changes, telegram_id in self.upserts)
+        written = self.pending_users
+        self.pending_users = {}
+        self.upserts.clear()
+        for telegram_id, changes in written.items():
+            _remember_language(telegram_id, changes)
+            _notify_user_changed(telegram_id, changes)
+
+
+# Columnas de `usuarios` que se pueden escribir con upsert_user()
+USER_WRITABLE_COLUMNS = frozenset({
+    'username', 'nombre_completo', 'telefono', 'tipo',
+    'pais_id', 'provincia_id', 'zona_id', 'idioma', 'estado', 'radio_trabajo_km', 'modo_resumen',
+})
+
+
+@lru_cache(maxsize=64)
+def _user_write_sql(columns, upsert):
+    """SQL (cacheado por combinación de columnas) para escribir un usuario."""
+    unknown = set(columns) - USER_WRITABLE_COLUMNS
+    if unknown:
+        raise ValueError(f"Columnas de usuario no permitidas: {sorted(unknown)}")
+    if upsert:
+        updates = ', '.join(f"{column} = excluded.{column}" for column in columns)
+        return (
+            f"INSERT INTO usuarios (telegram_id, {', '.join(columns)}) VALUES (?{', ?' * len(columns)}) "
+            f"ON CONFLICT(telegram_id) DO UPDATE SET {updates}"
+        )
+    assignments = ', '.join(f"{column} = ?" for column in columns)
+    return f"UPDATE usuarios SET {assignments} WHERE telegram_id = ?"
+
+
+def _write_user_changes(conn, telegram_id, changes, upsert):
+    """
+    Aplica los cambios de un usuario en una sola sentencia: UPDATE parcial, o
+    INSERT ... ON CONFLICT(telegram_id) DO UPDATE si la fila puede no existir.
+    """
+    columns = tuple(changes)
+    values = [changes[column] for column in columns]
+    if upsert:
+        conn.execute(_user_write_sql(columns, True), [telegram_id] + values)
+    else:
+        conn.execute(_user_write_sql(columns, False), values + [telegram_id])
+    logger.info(f"✅ Usuario {telegram_id} guardado en la base de datos")
+
+
+# --- Avisos de cambios de usuario (índices en memoria, p. ej. matching) ---
+
+# Columnas cuyo cambio puede alterar la elegibilidad como transportista
+MATCHING_COLUMNS = frozenset({'tipo', 'estado', 'radio_trabajo_km'})
+_user_change_listeners = []
+
+def add_user_change_listener(listener, columns=MATCHING_COLUMNS):
+    """
+    Registra `listener(telegram_id)`, llamado tras confirmar un cambio de
+    `columns` (por defecto rol, estado y radio) o de las zonas de trabajo de un usuario.
+    """
+    _user_change_listeners.append((listener, frozenset(columns)))
+
+def _notify_user_changed(telegram_id, changes=None):
+    for listener, columns in _user_change_listeners:
+        if changes is not None and columns.isdisjoint(changes):
+            continue
+        try:
+            listener(telegram_id)
+        except Exception as e:
+            logger.error(f"Error notificando el cambio del usuario {telegram_id}: {e}")
+
+
+def _current_uow():
+    return getattr(_uow_local, 'uow', None)
+
+
+def begin_unit_of_work():
+    """Abre (o reutiliza, si ya hay una abierta en el hilo) la unidad de trabajo."""
+    uow = _current_uow()
+    if uow is None:
+        uow = UnitOfWork()
+        _uow_local.uow = uow
+    uow.depth += 1
+    return uow
+
+
+def end_unit_of_work(uow):
+    """
+    Cierra la unidad de trabajo; el nivel más externo aplica las escrituras.
+    Se hace flush también si el handler falló, igual que antes cada escritura
+    quedaba guardada en el momento. Si el flush falla la excepción se propaga:
+    el handler no puede dar por guardado lo que se perdió.
+    """
+    uow.depth -= 1
+    if uow.depth > 0:
+        return
+    _uow_local.uow = None
+    try:
+        uow.flush()
+    except Exception as e:
+        logger.error(f"Error aplicando la unidad de trabajo: {e}")
+        raise
+
+
+@contextmanager
+def unit_of_work():
+    uow = begin_unit_of_work()
+    try:
+        yield uow
+    finally:
+        end_unit_of_work(uow)
+
+
+def init_db():
+    try:
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            _create_schema(cursor)
+            apply_migrations(cursor)
         logger.info("✅ Base de datos inicializada correctamente")
         return True
         
@@ -205,226 +337,967 @@ def init_db():
         logger.error(f"❌ Error inicializando BD: {e}")
         return False
 
+def _create_schema(cursor):
+    """Crea las tablas base y asegura el registro del Admin Supremo."""
+    # --- 1. CREACIÓN DE TABLAS ---
+
+    # TABLA DE USUARIOS
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS usuarios (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER UNIQUE,
+            username TEXT,
+            nombre_completo TEXT,
+            telefono TEXT,
+            tipo TEXT,
+            
+            -- Nuevas columnas de ID para geografía de residencia
+            pais_id INTEGER,
+            provincia_id INTEGER,
+            zona_id INTEGER,
+            
+            idioma TEXT DEFAULT 'es',
+            estado TEXT DEFAULT 'activo',
+            vehiculos TEXT DEFAULT '[]',
+            
+            -- Columna heredada (JSON): las zonas de trabajo viven en `transportista_zonas`
+            zonas_trabajo_ids TEXT DEFAULT '[]', 
+            
+            creado_en TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # TABLA DE ADMINISTRADORES
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS administradores (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            usuario_id INTEGER,
+            nivel TEXT,
+            
+            -- Nuevas columnas de ID para jurisdicción
+            pais_id INTEGER, 
+            provincia_id INTEGER,
+            zona_id INTEGER,
+            
+            comision_transportistas REAL DEFAULT 100,
+            comision_solicitantes REAL DEFAULT 50,
+            porcentaje_minimo_ganancia REAL DEFAULT 5,
+            
+            estado TEXT DEFAULT 'activo',
+            creado_en TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            
+            FOREIGN KEY(usuario_id) REFERENCES usuarios(id)
+        )
+    ''')
+    
+    # TABLAS GEOGRÁFICAS
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS paises (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nombre TEXT UNIQUE,
+            codigo TEXT UNIQUE,
+            creado_por_admin_id INTEGER,
+            estado TEXT DEFAULT 'activo',
+            creado_en TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(creado_por_admin_id) REFERENCES usuarios(id)
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS provincias (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            pais_id INTEGER,
+            nombre TEXT,
+            creado_por_admin_id INTEGER,
+            estado TEXT DEFAULT 'activo',
+            creado_en TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(pais_id, nombre),
+            FOREIGN KEY(pais_id) REFERENCES paises(id),
+            FOREIGN KEY(creado_por_admin_id) REFERENCES usuarios(id)
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS zonas (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            provincia_id INTEGER,
+            nombre TEXT,
+            creado_por_admin_id INTEGER,
+            estado TEXT DEFAULT 'activo',
+            creado_en TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(provincia_id, nombre),
+            FOREIGN KEY(provincia_id) REFERENCES provincias(id),
+            FOREIGN KEY(creado_por_admin_id) REFERENCES usuarios(id)
+        )
+    ''')
+
+    # TABLA DE SOLICITUDES
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS solicitudes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            usuario_id INTEGER,
+            pais_id INTEGER,
+            provincia_id INTEGER,
+            zona_id INTEGER,
+            vehicle_type TEXT,
+            cargo_type TEXT,
+            description TEXT,
+            pickup TEXT,
+            delivery TEXT,
+            budget REAL,
+            estado TEXT DEFAULT 'activa',
+            transportista_asignado INTEGER,
+            pending_confirm_until TIMESTAMP,
+            creado_en TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            
+            FOREIGN KEY(usuario_id) REFERENCES usuarios(id),
+            FOREIGN KEY(transportista_asignado) REFERENCES usuarios(id)
+        )
+    ''')
+    
+    # TABLA DE VEHÍCULOS
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS vehiculos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            usuario_id INTEGER,
+            tipo TEXT,
+            placa TEXT UNIQUE,
+            capacidad_toneladas REAL,
+            estado TEXT DEFAULT 'activo',
+            FOREIGN KEY(usuario_id) REFERENCES usuarios(id)
+        )
+    ''')
+
+    # TABLA DE AUDITORÍA
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS auditoria (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            accion TEXT,
+            usuario_id INTEGER,
+            detalles TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # --- 2. INSERCIÓN DEL ADMINISTRADOR SUPREMO ---
+    # 1. Asegurar que el Admin Supremo esté registrado en la tabla `usuarios`
+    cursor.execute("SELECT id FROM usuarios WHERE telegram_id = ?", (ADMIN_SUPREMO_ID,))
+    admin_user_id = cursor.fetchone()
+    
+    if not admin_user_id:
+        # Insertar al admin supremo en la tabla de usuarios
+        cursor.execute('''
+            INSERT INTO usuarios (telegram_id, username, nombre_completo, telefono, tipo, pais_id, provincia_id, zona_id, estado)
+            VALUES (?, ?, ?, ?, ?, NULL, NULL, NULL, 'activo')
+        ''', (ADMIN_SUPREMO_ID, ADMIN_SUPREMO, "Admin Supremo", "N/A", "ambos"))
+        admin_user_id = cursor.lastrowid
+        logger.info(f"✅ Admin Supremo insertado en usuarios con ID: {admin_user_id}")
+    else:
+        admin_user_id = admin_user_id[0]
+        
+    # 2. Asegurar que el Admin Supremo tenga rol en la tabla `administradores`
+    cursor.execute("SELECT nivel FROM administradores WHERE usuario_id = ? AND estado = 'activo'", (admin_user_id,))
+    admin_role = cursor.fetchone()
+    
+    if not admin_role:
+        cursor.execute('''
+            INSERT INTO administradores (usuario_id, nivel, pais_id, provincia_id, zona_id, estado)
+            VALUES (?, ?, NULL, NULL, NULL, 'activo')
+        ''', (admin_user_id, 'supremo'))
+        logger.info("✅ Rol de Admin Supremo asignado en administradores")
+
 # --- Helper functions para DB ---
 
+class LRUCache:
+    """
+    Caché LRU acotada y thread-safe, con caducidad opcional (`ttl` en
+    segundos, None = sin caducidad). Admite valores None: `get` devuelve
+    (encontrado, valor) para distinguir un None cacheado de un fallo.
+    """
+
+    def __init__(self, max_entries, ttl=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """(True, valor) si hay entrada vigente, (False, None) si no."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            expires_at, value = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+            return True, value
+
+    def put(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+
+# Idioma por telegram_id; se actualiza al escribir `idioma` (ver upsert_user)
+_language_cache = LRUCache(LANGUAGE_CACHE_MAX)
+
 def get_user_language(user_id):
+    uow = _current_uow()
+    if uow is not None:
+        # Idioma elegido en este update: vale ya, pero no se cachea hasta el flush
+        idioma = uow.pending_users.get(user_id, {}).get('idioma')
+        if idioma:
+            return idioma
+
+    cached, idioma = _language_cache.get(user_id)
+    if cached:
+        return idioma
+
+    if uow is not None and uow.users.get(user_id):
+        idioma = uow.users[user_id]['idioma'] or 'es'
+        _language_cache.put(user_id, idioma)
+        return idioma
+
     try:
-        conn = get_db_connection()
-        if not conn:
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT idioma FROM usuarios WHERE telegram_id = ?", (user_id,))
+            result = cursor.fetchone()
+        # Los usuarios aún no registrados no se cachean: su idioma llega con el registro
+        if not result:
             return 'es'
-            
-        cursor = conn.cursor()
-        cursor.execute("SELECT idioma FROM usuarios WHERE telegram_id = ?", (user_id,))
-        result = cursor.fetchone()
-        conn.close()
-        return result[0] if result else 'es'
+        idioma = result[0] or 'es'
+        _language_cache.put(user_id, idioma)
+        return idioma
     except Exception as e:
         logger.error(f"Error getting user language: {e}")
         return 'es'
 
+def _write_audit_batch(events):
+    with db_connection() as conn:
+        conn.executemany('''
+            INSERT INTO auditoria (accion, usuario_id, detalles, timestamp)
+            VALUES (?, ?, ?, ?)
+        ''', events)
+
+_audit_sink = AuditSink(
+    _write_audit_batch,
+    max_queue=AUDIT_QUEUE_MAX,
+    batch_size=AUDIT_BATCH_SIZE,
+    flush_interval=AUDIT_FLUSH_INTERVAL
+)
+
 def log_audit(accion, user_id, detalles=""):
-    try:
-        conn = get_db_connection()
-        if not conn:
-            return
-            
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO auditoria (accion, usuario_id, detalles)
-            VALUES (?, ?, ?)
-        ''', (accion, user_id, detalles))
-        conn.commit()
-        conn.close()
-    except Exception as e:
-        logger.error(f"Error en auditoría: {e}")
+    """Encola un evento de auditoría; se escribe por lotes en segundo plano."""
+    # Se guarda la hora del evento, no la de la escritura del lote
+    timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+    _audit_sink.submit((accion, user_id, detalles, timestamp))
+
+def flush_audit_log():
+    """Escribe de inmediato los eventos de auditoría pendientes."""
+    _audit_sink.flush()
+
+def get_audit_stats():
+    """Contadores del buffer de auditoría (encolados, escritos, descartados, en cola)."""
+    return _audit_sink.get_stats()
 
 def get_user_by_telegram_id(user_id):
-    """Obtiene todos los datos del usuario por su ID de Telegram, incluyendo la conversión de JSON de las zonas de trabajo."""
+    """Obtiene todos los datos del usuario por su ID de Telegram, incluyendo sus zonas de trabajo."""
+    uow = _current_uow()
+    if uow is not None:
+        if user_id in uow.users:
+            cached = uow.users[user_id]
+            return dict(cached) if cached is not None else None
+        # Leer después de escribir: aplicar antes los cambios pendientes
+        uow.flush_user(user_id)
+
     try:
-        conn = get_db_connection()
-        if not conn:
-            return None
-            
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM usuarios WHERE telegram_id = ?", (user_id,))
-        user_data = cursor.fetchone()
-        conn.close()
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT u.*,
+                       (SELECT group_concat(tz.zona_id) FROM transportista_zonas tz
+                        WHERE tz.usuario_id = u.id) AS zonas_trabajo_csv
+                FROM usuarios u
+                WHERE u.telegram_id = ?
+            ''', (user_id,))
+            user_data = cursor.fetchone()
         
         if not user_data:
+            if uow is not None:
+                uow.users[user_id] = None
             return None
             
         # Convertir a diccionario para poder modificar
         user_dict = dict(user_data)
         
-        # Convertir zonas_trabajo_ids de JSON string a lista de enteros
-        if user_dict.get('zonas_trabajo_ids'):
-            try:
-                user_dict['zonas_trabajo_ids'] = json.loads(user_dict['zonas_trabajo_ids'])
-            except:
-                user_dict['zonas_trabajo_ids'] = []
-        else:
-            user_dict['zonas_trabajo_ids'] = []
-            
+        # Zonas de trabajo como lista de enteros (desde transportista_zonas)
+        zonas_csv = user_dict.pop('zonas_trabajo_csv')
+        user_dict['zonas_trabajo_ids'] = [int(z) for z in zonas_csv.split(',')] if zonas_csv else []
+
+        if uow is not None:
+            uow.users[user_id] = dict(user_dict)
         return user_dict
             
     except Exception as e:
         logger.error(f"Error obteniendo datos de usuario {user_id}: {e}")
         return None
 
-def set_user_registration_data(telegram_id, username, name, phone, user_type, pais_id, provincia_id, zona_id, lang='es'):
-    """Actualiza o inserta los datos de registro de un usuario, usando IDs geográficos."""
-    try:
-        conn = get_db_connection()
-        if not conn:
-            return False
-            
-        cursor = conn.cursor()
-        
-        # Buscar si el usuario ya existe
-        cursor.execute("SELECT id FROM usuarios WHERE telegram_id = ?", (telegram_id,))
-        existing_user = cursor.fetchone()
+def _remember_language(telegram_id, fields):
+    if fields.get('idioma'):
+        _language_cache.put(telegram_id, fields['idioma'])
 
-        if existing_user:
-            # Si existe, actualizamos
-            cursor.execute('''
-                UPDATE usuarios SET username = ?, nombre_completo = ?, telefono = ?, tipo = ?, 
-                pais_id = ?, provincia_id = ?, zona_id = ?, idioma = ?, estado = 'activo'
-                WHERE telegram_id = ?
-            ''', (username, name, phone, user_type, pais_id, provincia_id, zona_id, lang, telegram_id))
-            logger.info(f"✅ Usuario {telegram_id} actualizado en la base de datos")
-        else:
-            # Si no existe, insertamos
-            cursor.execute('''
-                INSERT INTO usuarios (telegram_id, username, nombre_completo, telefono, tipo, pais_id, provincia_id, zona_id, idioma, estado)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'activo')
-            ''', (telegram_id, username, name, phone, user_type, pais_id, provincia_id, zona_id, lang))
-            logger.info(f"✅ Nuevo usuario {telegram_id} insertado en la base de datos")
-            
-        conn.commit()
-        conn.close()
+def upsert_user(telegram_id, **fields):
+    """
+    Inserta o actualiza un usuario en una sola escritura, tocando solo las
+    columnas indicadas (p. ej. upsert_user(id, idioma='es', estado=...)).
+    Dentro de una unidad de trabajo la escritura se fusiona y se aplica al final.
+    """
+    uow = _current_uow()
+    if uow is not None:
+        # La caché de idiomas se actualiza al confirmar el flush
+        uow.stage_user_write(telegram_id, fields, upsert=True)
+        return True
+
+    try:
+        with db_connection() as conn:
+            _write_user_changes(conn, telegram_id, fields, upsert=True)
+        _remember_language(telegram_id, fields)
+        _notify_user_changed(telegram_id, fields)
         return True
         
     except Exception as e:
         logger.error(f"Error guardando datos de registro para {telegram_id}: {e}")
         return False
+
+def set_user_registration_data(telegram_id, username, name, phone, user_type, pais_id, provincia_id, zona_id, lang='es'):
+    """Actualiza o inserta los datos de registro de un usuario, usando IDs geográficos."""
+    return upsert_user(
+        telegram_id,
+        username=username,
+        nombre_completo=name,
+        telefono=phone,
+        tipo=user_type,
+        pais_id=pais_id,
+        provincia_id=provincia_id,
+        zona_id=zona_id,
+        idioma=lang,
+        estado='activo'
+    )
         
 def get_user_internal_id(telegram_id):
     """Obtiene el ID interno (AUTOINCREMENT) del usuario."""
+    uow = _current_uow()
+    if uow is not None:
+        if uow.users.get(telegram_id) is not None:
+            return uow.users[telegram_id]['id']
+        # Leer después de escribir: aplicar antes los cambios pendientes
+        uow.flush_user(telegram_id)
+
     try:
-        conn = get_db_connection()
-        if not conn:
-            return None
-            
-        cursor = conn.cursor()
-        cursor.execute("SELECT id FROM usuarios WHERE telegram_id = ?", (telegram_id,))
-        result = cursor.fetchone()
-        conn.close()
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id FROM usuarios WHERE telegram_id = ?", (telegram_id,))
+            result = cursor.fetchone()
         return result[0] if result else None
     except Exception as e:
         logger.error(f"Error obteniendo ID interno para {telegram_id}: {e}")
         return None
         
+# Roles de admin por telegram_id; también cachea los None para que los
+# usuarios normales no consulten `administradores` en cada update
+_admin_cache = LRUCache(ADMIN_CACHE_MAX, ttl=ADMIN_CACHE_TTL)
+
 def get_admin_data(telegram_id):
-    """Obtiene el nivel y región de un administrador por su ID de Telegram."""
+    """
+    Obtiene el nivel, región y permisos (`permisos`, frozenset) de un
+    administrador por su ID de Telegram, o None si no lo es.
+    """
+    uow = _current_uow()
+    if uow is not None and telegram_id in uow.admins:
+        return uow.admins[telegram_id]
+
+    cached, admin_data = _admin_cache.get(telegram_id)
+    if cached:
+        if uow is not None:
+            uow.admins[telegram_id] = admin_data
+        return admin_data
+
     try:
-        conn = get_db_connection()
-        if not conn:
-            return None
-            
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT a.nivel, a.pais_id, a.provincia_id, a.zona_id
-            FROM administradores a
-            JOIN usuarios u ON a.usuario_id = u.id
-            WHERE u.telegram_id = ? AND a.estado = 'activo'
-        ''', (telegram_id,))
-        result = cursor.fetchone()
-        conn.close()
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT a.nivel, a.pais_id, a.provincia_id, a.zona_id
+                FROM administradores a
+                JOIN usuarios u ON a.usuario_id = u.id
+                WHERE u.telegram_id = ? AND a.estado = 'activo'
+            ''', (telegram_id,))
+            result = cursor.fetchone()
         
+        admin_data = None
         if result:
-            return {
+            admin_data = {
                 'nivel': result[0],
                 'pais_id': result[1],
                 'provincia_id': result[2],
-                'zona_id': result[3]
+                'zona_id': result[3],
+                'permisos': ADMIN_PERMISSIONS.get(result[0], frozenset())
             }
-        return None
+        _admin_cache.put(telegram_id, admin_data)
+        if uow is not None:
+            uow.admins[telegram_id] = admin_data
+        return admin_data
         
     except Exception as e:
         logger.error(f"Error obteniendo datos de admin para {telegram_id}: {e}")
         return None
 
+def get_admin_level(telegram_id):
+    """Nivel de administración; el Admin Supremo por ID cuenta como 'supremo' aunque no tenga fila."""
+    admin_data = get_admin_data(telegram_id)
+    if admin_data:
+        return admin_data['nivel']
+    return 'supremo' if telegram_id == ADMIN_SUPREMO_ID else None
+
+def admin_has_permission(telegram_id, accion):
+    """Comprueba en memoria si el usuario puede realizar `accion` (ver config.ADMIN_PERMISSIONS)."""
+    return accion in ADMIN_PERMISSIONS.get(get_admin_level(telegram_id), frozenset())
+
+def invalidate_admin_cache(telegram_id=None):
+    """Olvida el rol cacheado de un usuario (o de todos) tras cambiarlo."""
+    _admin_cache.invalidate(telegram_id)
+    uow = _current_uow()
+    if uow is not None:
+        if telegram_id is None:
+            uow.admins.clear()
+        else:
+            uow.admins.pop(telegram_id, None)
+
 def set_user_work_zones(telegram_id, zonas_trabajo_ids):
     """
     Guarda la lista de IDs de zona de trabajo para un transportista.
     zonas_trabajo_ids debe ser una lista de enteros.
     """
     try:
-        # Convertir la lista de IDs a una cadena JSON
-        zonas_json = json.dumps(zonas_trabajo_ids)
-        
-        conn = get_db_connection()
-        if not conn:
+        zonas = sorted(set(int(z) for z in zonas_trabajo_ids))
+        user_internal_id = get_user_internal_id(telegram_id)
+        if not user_internal_id:
             return False
-            
-        cursor = conn.cursor()
-        cursor.execute('''
-            UPDATE usuarios 
-            SET zonas_trabajo_ids = ?
-            WHERE telegram_id = ?
-        ''', (zonas_json, telegram_id))
-        conn.commit()
-        conn.close()
+        
+        with db_connection() as conn:
+            conn.execute("DELETE FROM transportista_zonas WHERE usuario_id = ?", (user_internal_id,))
+            conn.executemany(
+                "INSERT INTO transportista_zonas (usuario_id, zona_id) VALUES (?, ?)",
+                [(user_internal_id, zona_id) for zona_id in zonas]
+            )
+
+        uow = _current_uow()
+        if uow is not None and uow.users.get(telegram_id) is not None:
+            uow.users[telegram_id]['zonas_trabajo_ids'] = zonas
+        _notify_user_changed(telegram_id)
         return True
         
     except Exception as e:
         logger.error(f"Error guardando zonas de trabajo para {telegram_id}: {e}")
         return False
 
-def get_requests_for_transportista(user_db, limit=10):
+def set_user_work_radius(telegram_id, radio_km):
+    """Guarda el radio de trabajo (km) del transportista; 0 desactiva la ampliación."""
+    changes = {'radio_trabajo_km': float(radio_km)}
+    uow = _current_uow()
+    if uow is not None:
+        uow.stage_user_write(telegram_id, changes)
+        return True
+
+    try:
+        with db_connection() as conn:
+            _write_user_changes(conn, telegram_id, changes, False)
+        _notify_user_changed(telegram_id, changes)
+        return True
+    except Exception as e:
+        logger.error(f"Error guardando el radio de trabajo de {telegram_id}: {e}")
+        return False
+
+def set_user_digest_mode(telegram_id, enabled):
+    """Activa o desactiva el modo resumen de notificaciones del transportista."""
+    changes = {'modo_resumen': 1 if enabled else 0}
+    uow = _current_uow()
+    if uow is not None:
+        uow.stage_user_write(telegram_id, changes)
+        return True
+
+    try:
+        with db_connection() as conn:
+            _write_user_changes(conn, telegram_id, changes, False)
+        _notify_user_changed(telegram_id, changes)
+        return True
+    except Exception as e:
+        logger.error(f"Error guardando el modo resumen de {telegram_id}: {e}")
+        return False
+
+def get_user_digest_mode(telegram_id):
+    """True si el usuario tiene el modo resumen activado (lectura directa de la BD)."""
+    try:
+        with db_connection() as conn:
+            row = conn.execute("SELECT modo_resumen FROM usuarios WHERE telegram_id = ?", (telegram_id,)).fetchone()
+        return bool(row and row[0])
+    except Exception as e:
+        logger.error(f"Error leyendo el modo resumen de {telegram_id}: {e}")
+        return False
+
+def get_digest_mode_users():
+    """Telegram IDs con el modo resumen activado."""
+    try:
+        with db_connection() as conn:
+            return {row[0] for row in conn.execute("SELECT telegram_id FROM usuarios WHERE modo_resumen = 1")}
+    except Exception as e:
+        logger.error(f"Error obteniendo usuarios en modo resumen: {e}")
+        return set()
+
+def add_digest_entries(entries):
+    """Guarda (transportista_tid, solicitud_id) pendientes de resumen en una sola transacción."""
+    with db_connection() as conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO resumen_pendiente (transportista_tid, solicitud_id) VALUES (?, ?)",
+            entries
+        )
+
+def get_digest_entries():
+    """Coincidencias pendientes guardadas: [(transportista_tid, solicitud_id, creado_en)] por antigüedad."""
+    with db_connection() as conn:
+        return [
+            tuple(row) for row in conn.execute(
+                "SELECT transportista_tid, solicitud_id, creado_en FROM resumen_pendiente ORDER BY creado_en"
+            )
+        ]
+
+def delete_digest_entries(telegram_id, solicitud_ids):
+    with db_connection() as conn:
+        conn.executemany(
+            "DELETE FROM resumen_pendiente WHERE transportista_tid = ? AND solicitud_id = ?",
+            [(telegram_id, solicitud_id) for solicitud_id in solicitud_ids]
+        )
+
+def create_solicitud(telegram_id, vehicle_type, cargo_type, description, pickup, delivery, budget):
+    """
+    Publica una solicitud activa en la zona de registro del solicitante.
+    Devuelve la fila creada o None si falla (o el usuario no tiene zona).
+    """
+    uow = _current_uow()
+    if uow is not None:
+        # La zona sale de `usuarios`: aplicar antes los cambios pendientes
+        uow.flush_user(telegram_id)
+    try:
+        with db_connection() as conn:
+            cursor = conn.execute('''
+                INSERT INTO solicitudes (usuario_id, pais_id, provincia_id, zona_id, vehicle_type, cargo_type,
+                                         description, pickup, delivery, budget, estado)
+                SELECT id, pais_id, provincia_id, zona_id, ?, ?, ?, ?, ?, ?, 'activa'
+                FROM usuarios WHERE telegram_id = ? AND zona_id IS NOT NULL
+            ''', (vehicle_type, cargo_type, description, pickup, delivery, budget, telegram_id))
+            if cursor.rowcount != 1:
+                return None
+            return conn.execute("SELECT * FROM solicitudes WHERE id = ?", (cursor.lastrowid,)).fetchone()
+    except Exception as e:
+        logger.error(f"Error creando la solicitud de {telegram_id}: {e}")
+        return None
+
+def get_solicitudes_by_ids(solicitud_ids, estado=None):
+    """Filas de las solicitudes indicadas (opcionalmente solo en `estado`), en el mismo orden."""
+    if not solicitud_ids:
+        return []
+    try:
+        query = f"SELECT * FROM solicitudes WHERE id IN ({', '.join('?' * len(solicitud_ids))})"
+        params = list(solicitud_ids)
+        if estado is not None:
+            query += " AND estado = ?"
+            params.append(estado)
+        with db_connection() as conn:
+            rows = {row['id']: row for row in conn.execute(query, params)}
+        return [rows[id_] for id_ in solicitud_ids if id_ in rows]
+    except Exception as e:
+        logger.error(f"Error obteniendo las solicitudes {solicitud_ids}: {e}")
+        return []
+
+def search_solicitudes(match_expression, limit=20, offset=0):
+    """
+    Solicitudes activas que cumplen la expresión FTS5, de más a menos
+    relevante (bm25). El índice solo contiene solicitudes activas; el filtro
+    por estado cubre las que cambiaron dentro de la misma transacción.
+    """
+    try:
+        with db_connection() as conn:
+            return [
+                dict(row) for row in conn.execute('''
+                    SELECT s.id, s.zona_id, s.vehicle_type, s.cargo_type,
+                           s.description, s.pickup, s.delivery, s.budget
+                    FROM solicitudes_fts f
+                    JOIN solicitudes s ON s.id = f.rowid
+                    WHERE solicitudes_fts MATCH ?
+                    AND s.estado = 'activa'
+                    ORDER BY bm25(solicitudes_fts)
+                    LIMIT ? OFFSET ?
+                ''', (match_expression, limit, offset))
+            ]
+    except Exception as e:
+        logger.error(f"Error buscando solicitudes ({match_expression!r}): {e}")
+        return []
+
+def get_transportistas_for_zona(zona_id):
+    """
+    Devuelve los Telegram IDs de los transportistas que trabajan en una zona.
+    Es una sola búsqueda sobre el índice (zona_id, usuario_id).
+    """
+    try:
+        with db_connection() as conn:
+            cursor = conn.execute('''
+                SELECT u.telegram_id
+                FROM transportista_zonas tz
+                JOIN usuarios u ON u.id = tz.usuario_id
+                WHERE tz.zona_id = ?
+                AND u.tipo IN (?, ?)
+                AND u.estado != ?
+            ''', (zona_id, ROLE_TRANSPORTISTA, ROLE_AMBOS, STATE_BANNED))
+            return [row[0] for row in cursor.fetchall()]
+    except Exception as e:
+        logger.error(f"Error obteniendo transportistas de la zona {zona_id}: {e}")
+        return []
+
+# Capacidad máxima (toneladas) entre los vehículos activos del usuario `u`; NULL si no tiene
+CARRIER_CAPACITY_SQL = '''
+    (SELECT MAX(v.capacidad_toneladas) FROM vehiculos v
+     WHERE v.usuario_id = u.id AND v.estado = 'activo')
+'''
+
+def get_carrier_index_rows():
+    """
+    (telegram_id, zona_id, capacidad, radio_trabajo_km) de todos los
+    transportistas activos, para cargar el índice de matching.
+    """
+    with db_connection() as conn:
+        return conn.execute(f'''
+            SELECT u.telegram_id, tz.zona_id, {CARRIER_CAPACITY_SQL} AS capacidad, u.radio_trabajo_km
+            FROM transportista_zonas tz
+            JOIN usuarios u ON u.id = tz.usuario_id
+            WHERE u.tipo IN (?, ?) AND u.estado != ?
+        ''', (ROLE_TRANSPORTISTA, ROLE_AMBOS, STATE_BANNED)).fetchall()
+
+def get_carrier_profile(telegram_id):
+    """
+    (zonas, capacidad, radio_km) del usuario si puede recibir solicitudes;
+    ([], None, 0) si no es transportista o está baneado. capacidad es None sin vehículos.
+    """
+    with db_connection() as conn:
+        rows = conn.execute(f'''
+            SELECT tz.zona_id, {CARRIER_CAPACITY_SQL} AS capacidad, u.radio_trabajo_km
+            FROM usuarios u
+            JOIN transportista_zonas tz ON tz.usuario_id = u.id
+            WHERE u.telegram_id = ? AND u.tipo IN (?, ?) AND u.estado != ?
+        ''', (telegram_id, ROLE_TRANSPORTISTA, ROLE_AMBOS, STATE_BANNED)).fetchall()
+    if not rows:
+        return [], None, 0
+    return [row[0] for row in rows], rows[0][1], rows[0][2] or 0
+
+def get_capacity_requirements():
+    """{(vehicle_type, cargo_type): min_toneladas}; '*' actúa como comodín."""
+    with db_connection() as conn:
+        return {
+            (row[0], row[1]): row[2]
+            for row in conn.execute("SELECT vehicle_type, cargo_type, min_toneladas FROM requisitos_capacidad")
+        }
+
+# --- Contadores materializados (panel de administración) ---
+
+STATS_COUNTER_FIELDS = ('usuarios_total', 'usuarios_activos', 'solicitudes_total', 'solicitudes_activas')
+
+def get_stats_counters():
+    """Lee los contadores del panel: una sola lectura por clave primaria."""
+    try:
+        with db_connection() as conn:
+            row = conn.execute(
+                f"SELECT {', '.join(STATS_COUNTER_FIELDS)} FROM stats_counters WHERE id = 1"
+            ).fetchone()
+        return dict(row) if row else dict.fromkeys(STATS_COUNTER_FIELDS, 0)
+    except Exception as e:
+        logger.error(f"Error leyendo contadores de estadísticas: {e}")
+        return dict.fromkeys(STATS_COUNTER_FIELDS, 0)
+
+def verify_stats_counters():
+    """
+    Compara los contadores con un COUNT(*) real.
+    Devuelve {campo: (valor_contador, valor_real)} solo para los que no cuadran.
+    """
+    with db_connection() as conn:
+        stored = dict(conn.execute(
+            f"SELECT {', '.join(STATS_COUNTER_FIELDS)} FROM stats_counters WHERE id = 1"
+        ).fetchone())
+        real = dict(conn.execute('''
+            SELECT
+                (SELECT COUNT(*) FROM usuarios) AS usuarios_total,
+                (SELECT COUNT(*) FROM usuarios WHERE estado = 'activo') AS usuarios_activos,
+                (SELECT COUNT(*) FROM solicitudes) AS solicitudes_total,
+                (SELECT COUNT(*) FROM solicitudes WHERE estado = 'activa') AS solicitudes_activas
+        ''').fetchone())
+    return {
+        field: (stored[field], real[field])
+        for field in STATS_COUNTER_FIELDS
+        if stored[field] != real[field]
+    }
+
+def rebuild_stats_counters():
+    """Recalcula los contadores desde cero con COUNT(*)."""
+    with db_connection() as conn:
+        conn.execute(STATS_COUNTERS_REBUILD_SQL)
+    logger.info("✅ Contadores de estadísticas recalculados")
+
+# Toneladas que exige una solicitud `s2` (máximo de los requisitos que le aplican)
+REQUEST_REQUIREMENT_SQL = '''
+    (SELECT COALESCE(MAX(rc.min_toneladas), 0) FROM requisitos_capacidad rc
+     WHERE rc.vehicle_type IN (s2.vehicle_type, '*') AND rc.cargo_type IN (s2.cargo_type, '*'))
+'''
+
+def get_work_zone_ids(user_db):
+    """Zonas de trabajo del transportista, ampliadas con su radio de trabajo si lo tiene."""
+    zonas_trabajo = user_db.get('zonas_trabajo_ids') or []
+    radio_km = user_db.get('radio_trabajo_km') or 0
+    if zonas_trabajo and radio_km > 0:
+        # Matriz de distancias en memoria (import local: geography_db depende de db)
+        from geography_db import expand_zones_by_radius
+        return sorted(expand_zones_by_radius(zonas_trabajo, radio_km))
+    return sorted(zonas_trabajo)
+
+def get_requests_for_transportista(user_db, limit=10, cursor=None, direction='next'):
     """
     Obtiene solicitudes activas que coinciden con las zonas de trabajo del transportista.
+
+    Paginación por cursor (keyset) sobre (creado_en, id):
+      - cursor=None: primera página (las más recientes).
+      - direction='next': solicitudes más antiguas que el cursor.
+      - direction='prev': solicitudes más recientes que el cursor.
+    El resultado siempre va ordenado de más reciente a más antigua. Cada zona
+    aporta como mucho `limit` filas leídas con un rango del índice, así que el
+    coste no crece con la profundidad de la página.
     """
     try:
-        # 1. Obtener las zonas de trabajo del usuario
-        zonas_trabajo = user_db.get('zonas_trabajo_ids', [])
+        # 1. Obtener las zonas de trabajo del usuario (con las cercanas si tiene radio)
+        zonas_trabajo = get_work_zone_ids(user_db)
         
         # Si el usuario no tiene zonas definidas, no hay solicitudes para mostrar
         if not zonas_trabajo:
             return []
-            
-        conn = get_db_connection()
-        if not conn:
-            return []
-            
-        cursor = conn.cursor()
-        
-        # 2. Crear un string de placeholders para la cláusula IN
-        placeholders = ','.join(['?'] * len(zonas_trabajo))
+
+        backwards = direction == 'prev' and cursor is not None
+        order = 'ASC' if backwards else 'DESC'
+        cursor_filter = ''
+        cursor_params = []
+        if cursor is not None:
+            cursor_filter = f"AND (s2.creado_en, s2.id) {'>' if backwards else '<'} (?, ?)"
+            cursor_params = list(cursor)
         
-        # La consulta filtra por estado 'activa' y zonas de trabajo
+        # 2. Por cada zona, las `limit` solicitudes activas contiguas al cursor
+        #    que su vehículo más grande puede llevar; después se ordena el
+        #    conjunto (como mucho zonas × limit). Sin vehículos registrados no
+        #    se filtra por capacidad.
         query = f'''
+            WITH cap AS (
+                SELECT COALESCE({CARRIER_CAPACITY_SQL}, 1e308) AS toneladas
+                FROM usuarios u WHERE u.id = ?
+            ),
+            tz(zona_id) AS (SELECT value FROM json_each(?))
             SELECT s.*, u.nombre_completo AS solicitante_nombre
-            FROM solicitudes s
+            FROM tz
+            JOIN solicitudes s ON s.id IN (
+                SELECT s2.id FROM solicitudes s2
+                WHERE s2.estado = 'activa'
+                AND s2.zona_id = tz.zona_id
+                AND s2.usuario_id != ?
+                {cursor_filter}
+                AND {REQUEST_REQUIREMENT_SQL} <= (SELECT toneladas FROM cap)
+                ORDER BY s2.creado_en {order}, s2.id {order}
+                LIMIT ?
+            )
             JOIN usuarios u ON s.usuario_id = u.id
-            WHERE s.estado = 'activa' 
-            AND s.zona_id IN ({placeholders})
-            AND s.usuario_id != ?
-            ORDER BY s.creado_en DESC
+            ORDER BY s.creado_en {order}, s.id {order}
             LIMIT ?
         '''
         
-        params = zonas_trabajo + [user_db['id'], limit]
-        cursor.execute(query, params)
-        results = cursor.fetchall()
-        conn.close()
+        params = [user_db['id'], json.dumps(zonas_trabajo), user_db['id']] + cursor_params + [limit, limit]
+        with db_connection() as conn:
+            results = conn.execute(query, params).fetchall()
         
+        if backwards:
+            results.reverse()
         return results
             
     except Exception as e:
         logger.error(f"Error obteniendo solicitudes para transportista {user_db.get('telegram_id', 'unknown')}: {e}")
         return []
 
+def iter_ranking_candidates(user_db, fetch_size=200):
+    """
+    Recorre en streaming (fetchmany de `fetch_size` filas) todas las solicitudes
+    activas de las zonas del transportista que su vehículo puede llevar, con
+    las columnas que usa el ranking. No materializa el conjunto completo.
+    """
+    zonas_trabajo = get_work_zone_ids(user_db)
+    if not zonas_trabajo:
+        return
+
+    query = f'''
+        WITH cap AS (
+            SELECT COALESCE({CARRIER_CAPACITY_SQL}, 1e308) AS toneladas
+            FROM usuarios u WHERE u.id = ?
+        )
+        SELECT s2.id, s2.zona_id, s2.vehicle_type, s2.cargo_type, s2.budget, s2.creado_en,
+               CAST(strftime('%s', s2.creado_en) AS INTEGER) AS creado_epoch,
+               {REQUEST_REQUIREMENT_SQL} AS min_toneladas
+        FROM json_each(?) tz
+        JOIN solicitudes s2 ON s2.estado = 'activa' AND s2.zona_id = tz.value
+        WHERE s2.usuario_id != ?
+        AND min_toneladas <= (SELECT toneladas FROM cap)
+    '''
+    with db_connection() as conn:
+        cursor = conn.execute(query, (user_db['id'], json.dumps(zonas_trabajo), user_db['id']))
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                return
+            yield from rows
+
+def get_carrier_vehicles(user_internal_id):
+    """(tipo, capacidad_toneladas) de los vehículos activos del usuario."""
+    try:
+        with db_connection() as conn:
+            return [
+                (row['tipo'], row['capacidad_toneladas'])
+                for row in conn.execute(
+                    "SELECT tipo, capacidad_toneladas FROM vehiculos WHERE usuario_id = ? AND estado = 'activo'",
+                    (user_internal_id,)
+                )
+            ]
+    except Exception as e:
+        logger.error(f"Error obteniendo vehículos del usuario {user_internal_id}: {e}")
+        return []
+
+def archive_solicitudes_batch(estados, older_than, batch_size=1000):
+    """
+    Mueve a `solicitudes_archivo` como mucho `batch_size` solicitudes en alguno
+    de `estados` creadas antes de `older_than` ('YYYY-MM-DD HH:MM:SS', UTC).
+    Cada lote es una transacción corta; devuelve cuántas filas se movieron.
+    """
+    columns = ', '.join(SOLICITUDES_COLUMNS)
+    estados_ph = ','.join('?' * len(estados))
+    with db_connection() as conn:
+        # Tomar el bloqueo de escritura al inicio evita fallar al promocionar la lectura
+        conn.execute("BEGIN IMMEDIATE")
+        ids = [row[0] for row in conn.execute(f'''
+            SELECT id FROM solicitudes
+            WHERE estado IN ({estados_ph}) AND creado_en < ?
+            ORDER BY creado_en
+            LIMIT ?
+        ''', (*estados, older_than, batch_size))]
+        if not ids:
+            return 0
+
+        ids_ph = ','.join('?' * len(ids))
+        conn.execute(
+            f"INSERT OR REPLACE INTO solicitudes_archivo ({columns}) SELECT {columns} FROM solicitudes WHERE id IN ({ids_ph})",
+            ids
+        )
+        conn.execute(f"DELETE FROM solicitudes WHERE id IN ({ids_ph})", ids)
+    return len(ids)
+
+def get_pending_confirmations():
+    """Devuelve [(solicitud_id, pending_confirm_until)] de las solicitudes pendientes de confirmación."""
+    try:
+        with db_connection() as conn:
+            return [tuple(row) for row in conn.execute('''
+                SELECT id, pending_confirm_until FROM solicitudes
+                WHERE estado = 'pendiente_confirmacion' AND pending_confirm_until IS NOT NULL
+            ''')]
+    except Exception as e:
+        logger.error(f"Error obteniendo confirmaciones pendientes: {e}")
+        return []
+
+def claim_solicitud(solicitud_id, transportista_telegram_id, confirm_until, zona_ids):
+    """
+    Asigna la solicitud al transportista si sigue 'activa', dejándola pendiente
+    de confirmación hasta `confirm_until` ('YYYY-MM-DD HH:MM:SS', UTC).
+
+    Es una única UPDATE condicional: entre varios transportistas que aceptan a
+    la vez solo uno cambia la fila (rowcount 1); el resto no la ve 'activa' y
+    no hay lectura previa que pueda quedar obsoleta. La misma UPDATE exige lo
+    que exige el feed: la solicitud está en `zona_ids` (get_work_zone_ids), su
+    vehículo más grande puede llevarla y no es el propio solicitante.
+
+    Retorna (asignada, telegram_id del solicitante). El solicitante se lee en
+    la misma transacción (RETURNING): si se asignó, asignada es True aunque no
+    se encuentre su telegram_id (None).
+    """
+    try:
+        with db_connection() as conn:
+            rows = conn.execute(f'''
+                UPDATE solicitudes AS s2
+                SET estado = 'pendiente_confirmacion',
+                    transportista_asignado = (SELECT id FROM usuarios WHERE telegram_id = ?),
+                    pending_confirm_until = ?
+                WHERE s2.id = ? AND s2.estado = 'activa'
+                AND s2.usuario_id != (SELECT id FROM usuarios WHERE telegram_id = ?)
+                AND s2.zona_id IN (SELECT value FROM json_each(?))
+                AND {REQUEST_REQUIREMENT_SQL} <= (
+                    SELECT COALESCE({CARRIER_CAPACITY_SQL}, 1e308) FROM usuarios u WHERE u.telegram_id = ?
+                )
+                RETURNING usuario_id
+            ''', (transportista_telegram_id, confirm_until, solicitud_id, transportista_telegram_id,
+                  json.dumps(list(zona_ids)), transportista_telegram_id)).fetchall()
+            if len(rows) != 1:
+                return False, None
+            solicitante = conn.execute("SELECT telegram_id FROM usuarios WHERE id = ?", (rows[0][0],)).fetchone()
+        return True, solicitante[0] if solicitante else None
+    except Exception as e:
+        logger.error(f"Error asignando la solicitud {solicitud_id} a {transportista_telegram_id}: {e}")
+        return False, None
+
+def expire_pending_solicitud(solicitud_id, now):
+    """
+    Devuelve la solicitud a 'activa' si sigue pendiente y su plazo venció en
+    `now` ('YYYY-MM-DD HH:MM:SS', UTC). La UPDATE condicional hace la operación
+    idempotente frente a confirmaciones concurrentes.
+
+    Retorna (telegram_id_solicitante, telegram_id_transportista) o None si no expiró.
+    """
+    try:
+        with db_connection() as conn:
+            row = conn.execute('''
+                SELECT s.transportista_asignado,
+                       (SELECT telegram_id FROM usuarios WHERE id = s.usuario_id),
+                       (SELECT telegram_id FROM usuarios WHERE id = s.transportista_asignado)
+                FROM solicitudes s WHERE s.id = ?
+            ''', (solicitud_id,)).fetchone()
+            cursor = conn.execute('''
+                UPDATE solicitudes
+                SET estado = 'activa', transportista_asignado = NULL, pending_confirm_until = NULL
+                WHERE id = ? AND estado = 'pendiente_confirmacion' AND pending_confirm_until <= ?
+            ''', (solicitud_id, now))
+            if cursor.rowcount != 1:
+                return None
+        return row[1], row[2]
+    except Exception as e:
+        logger.error(f"Error expirando la solicitud {solicitud_id}: {e}")
+        return None
+
 def add_vehicle(user_id, tipo, placa, capacidad_toneladas):
     """Añade un vehículo a la tabla 'vehiculos'."""
     try:
@@ -432,26 +1305,22 @@ def add_vehicle(user_id, tipo, placa, capacidad_toneladas):
         if not user_internal_id:
             return "error_user_not_found", None
             
-        conn = get_db_connection()
-        if not conn:
-            return "error_db", None
+        with db_connection() as conn:
+            cursor = conn.cursor()
             
-        cursor = conn.cursor()
-        
-        # Verificar si la placa ya existe
-        cursor.execute("SELECT id FROM vehiculos WHERE placa = ?", (placa,))
-        if cursor.fetchone():
-            conn.close()
-            return "error_plate_exists", None
-        
-        cursor.execute('''
-            INSERT INTO vehiculos (usuario_id, tipo, placa, capacidad_toneladas, estado)
-            VALUES (?, ?, ?, ?, 'activo')
-        ''', (user_internal_id, tipo, placa, capacidad_toneladas))
-        
-        new_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+            # Verificar si la placa ya existe
+            cursor.execute("SELECT id FROM vehiculos WHERE placa = ?", (placa,))
+            if cursor.fetchone():
+                return "error_plate_exists", None
+            
+            cursor.execute('''
+                INSERT INTO vehiculos (usuario_id, tipo, placa, capacidad_toneladas, estado)
+                VALUES (?, ?, ?, ?, 'activo')
+            ''', (user_internal_id, tipo, placa, capacidad_toneladas))
+            
+            new_id = cursor.lastrowid
+        # La capacidad máxima del transportista puede haber cambiado
+        _notify_user_changed(user_id)
         return "success", new_id
         
     except Exception as e:
@@ -461,15 +1330,18 @@ def add_vehicle(user_id, tipo, placa, capacidad_toneladas):
 # Nueva función crítica para registro.py
 def get_user_state(telegram_id):
     """Obtiene el estado actual del usuario por su Telegram ID."""
+    uow = _current_uow()
+    if uow is not None:
+        if uow.users.get(telegram_id) is not None:
+            return uow.users[telegram_id]['estado']
+        # Leer después de escribir: aplicar antes los cambios pendientes
+        uow.flush_user(telegram_id)
+
     try:
-        conn = get_db_connection()
-        if not conn:
-            return None
-            
-        cursor = conn.cursor()
-        cursor.execute("SELECT estado FROM usuarios WHERE telegram_id = ?", (telegram_id,))
-        result = cursor.fetchone()
-        conn.close()
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT estado FROM usuarios WHERE telegram_id = ?", (telegram_id,))
+            result = cursor.fetchone()
         return result[0] if result else None
     except Exception as e:
         logger.error(f"Error obteniendo estado del usuario {telegram_id}: {e}")
@@ -477,16 +1349,16 @@ def get_user_state(telegram_id):
 
 def set_user_state(telegram_id, state):
     """Actualiza el estado del usuario por su Telegram ID."""
+    uow = _current_uow()
+    if uow is not None:
+        uow.stage_user_write(telegram_id, {'estado': state})
+        return True
+
     try:
-        conn = get_db_connection()
-        if not conn:
-            return False
-            
-        cursor = conn.cursor()
-        cursor.execute("UPDATE usuarios SET estado = ? WHERE telegram_id = ?", (state, telegram_id))
-        conn.commit()
-        conn.close()
+        with db_connection() as conn:
+            conn.execute("UPDATE usuarios SET estado = ? WHERE telegram_id = ?", (state, telegram_id))
+        _notify_user_changed(telegram_id, {'estado': state})
         return True
     except Exception as e:
         logger.error(f"Error actualizando estado del usuario {telegram_id}: {e}")
-        return False
\ No newline at end of file
+        return False
@@ -0,0 +1,215 @@
+# digest.py
+import os
+import threading
+import time
+from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
+from config import logger, REQUEST_STATE_ACTIVE
+from db import (
+    add_user_change_listener, get_digest_mode_users, get_user_digest_mode, set_user_digest_mode,
+    add_digest_entries, get_digest_entries, delete_digest_entries, get_solicitudes_by_ids
+)
+from expirations import parse_db_timestamp
+from matching import get_candidate_carriers
+
+# Un resumen sale a los N minutos de la primera coincidencia pendiente...
+DIGEST_INTERVAL_MINUTES = float(os.getenv('DIGEST_INTERVAL_MINUTES', 15))
+# ...o en cuanto se acumulan K coincidencias
+DIGEST_MAX_MATCHES = int(os.getenv('DIGEST_MAX_MATCHES', 10))
+DIGEST_TICK_SECONDS = float(os.getenv('DIGEST_TICK_SECONDS', 30))
+# Botones por resumen (uno por solicitud); el resto se cuenta en el texto
+DIGEST_MAX_BUTTONS = 10
+
+
+class DigestBuffer:
+    """
+    Coincidencias pendientes por transportista en modo resumen.
+
+    Cada nueva solicitud se añade al buffer del transportista (y a
+    `resumen_pendiente`, en la misma transacción para toda la difusión); un
+    hilo envía un único mensaje por transportista cuando su primera
+    coincidencia cumple `interval` segundos o al llegar a `max_matches`.
+    """
+
+    def __init__(self, send_digest, interval=DIGEST_INTERVAL_MINUTES * 60,
+                 max_matches=DIGEST_MAX_MATCHES, tick=DIGEST_TICK_SECONDS):
+        self._send_digest = send_digest
+        self.interval = interval
+        self.max_matches = max_matches
+        self.tick = tick
+        self._pending = {}  # telegram_id -> (desde, [solicitud_id])
+        self._full = set()  # transportistas que ya llegaron a max_matches
+        self._cond = threading.Condition()
+        self._thread = None
+        self.started = False
+        self.stats = {'matches': 0, 'digests': 0}
+
+    def add(self, telegram_id, solicitud_id, since=None):
+        with self._cond:
+            _, ids = self._pending.setdefault(telegram_id, (since or time.time(), []))
+            if solicitud_id in ids:
+                return
+            ids.append(solicitud_id)
+            self.stats['matches'] += 1
+            if len(ids) >= self.max_matches:
+                self._full.add(telegram_id)
+                self._cond.notify()
+
+    def flush_user(self, telegram_id):
+        """Fuerza el envío del resumen pendiente del transportista en el próximo ciclo."""
+        with self._cond:
+            if telegram_id in self._pending:
+                self._full.add(telegram_id)
+                self._cond.notify()
+
+    def _take_due(self):
+        now = time.time()
+        with self._cond:
+            due = [
+                tid for tid, (since, _) in self._pending.items()
+                if tid in self._full or now - since >= self.interval
+            ]
+            self._full.difference_update(due)
+            return [(tid, self._pending.pop(tid)[1]) for tid in due]
+
+    def flush_due(self):
+        for telegram_id, solicitud_ids in self._take_due():
+            try:
+                self._send_digest(telegram_id, solicitud_ids)
+                with self._cond:
+                    self.stats['digests'] += 1
+            except Exception as e:
+                logger.error(f"❌ Error enviando el resumen a {telegram_id}: {e}")
+
+    def start(self):
+        if self.started:
+            return
+        self.started = True
+        self._thread = threading.Thread(target=self._run, name="digest", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._full:
+                    self._cond.wait(self.tick)
+            self.flush_due()
+
+    def get_stats(self):
+        with self._cond:
+            stats = dict(self.stats)
+            stats['carriers_pending'] = len(self._pending)
+            stats['matches_pending'] = sum(len(ids) for _, ids in self._pending.values())
+        return stats
+
+
+def build_digest_message(telegram_id, solicitudes):
+    """Texto y botones 'sol_ver_<id>' de un resumen."""
+    from utils import get_message
+
+    lines = [get_message('digest_header', telegram_id, count=len(solicitudes)), ""]
+    markup = InlineKeyboardMarkup(row_width=2)
+    buttons = []
+    for solicitud in solicitudes[:DIGEST_MAX_BUTTONS]:
+        presupuesto = f" - 💰 {solicitud['budget']:g}" if solicitud['budget'] else ""
+        lines.append(f"• #{solicitud['id']} - {solicitud['cargo_type']}{presupuesto}")
+        buttons.append(InlineKeyboardButton(f"📦 #{solicitud['id']}", callback_data=f"sol_ver_{solicitud['id']}"))
+    if len(solicitudes) > DIGEST_MAX_BUTTONS:
+        lines.append("")
+        lines.append(get_message('digest_more', telegram_id, count=len(solicitudes) - DIGEST_MAX_BUTTONS))
+    markup.add(*buttons)
+    return "\n".join(lines), markup
+
+
+def send_digest(telegram_id, solicitud_ids):
+    """Un mensaje con las solicitudes que siguen activas; borra su copia en SQLite."""
+    from bot_instance import bot
+    from outbound import send_bulk
+
+    solicitudes = get_solicitudes_by_ids(solicitud_ids, estado=REQUEST_STATE_ACTIVE)
+    if solicitudes:
+        msg, markup = build_digest_message(telegram_id, solicitudes)
+        send_bulk(bot, telegram_id, msg, reply_markup=markup, parse_mode='Markdown')
+    delete_digest_entries(telegram_id, solicitud_ids)
+
+
+digest_buffer = DigestBuffer(send_digest)
+_digest_users = set()
+_digest_users_lock = threading.Lock()
+
+
+def is_digest_mode(telegram_id):
+    return telegram_id in _digest_users
+
+def set_digest_mode(telegram_id, enabled):
+    """
+    Guarda la preferencia. El conjunto en memoria se actualiza en
+    _refresh_digest_mode, una vez confirmada la escritura.
+    """
+    return set_user_digest_mode(telegram_id, enabled)
+
+def _refresh_digest_mode(telegram_id):
+    """Tras un cambio confirmado: al desactivarlo se envía ya lo que hubiera pendiente."""
+    enabled = get_user_digest_mode(telegram_id)
+    with _digest_users_lock:
+        if enabled:
+            _digest_users.add(telegram_id)
+        else:
+            _digest_users.discard(telegram_id)
+    if not enabled:
+        digest_buffer.flush_user(telegram_id)
+
+
+def notify_new_solicitud(solicitud, exclude=None):
+    """
+    Avisa de una solicitud nueva a los transportistas candidatos: un mensaje
+    inmediato a cada uno, salvo a los que están en modo resumen, cuya
+    coincidencia se acumula para el próximo resumen. Devuelve (directos, en resumen).
+    """
+    from bot_instance import bot
+    from outbound import send_bulk
+    from utils import get_message
+
+    carriers = get_candidate_carriers(solicitud, exclude=exclude)
+    digest = [tid for tid in carriers if tid in _digest_users]
+    direct = [tid for tid in carriers if tid not in _digest_users]
+
+    if digest:
+        try:
+            add_digest_entries([(tid, solicitud['id']) for tid in digest])
+        except Exception as e:
+            # Sin copia duradera se envía igualmente en el próximo resumen
+            logger.error(f"Error guardando coincidencias en resumen de la solicitud {solicitud['id']}: {e}")
+        for telegram_id in digest:
+            digest_buffer.add(telegram_id, solicitud['id'])
+
+    markup = InlineKeyboardMarkup()
+    markup.add(InlineKeyboardButton("📦 Ver solicitud", callback_data=f"sol_ver_{solicitud['id']}"))
+    for telegram_id in direct:
+        try:
+            msg = get_message('new_request_match', telegram_id, id=solicitud['id'],
+                              cargo_type=solicitud['cargo_type'], vehicle_type=solicitud['vehicle_type'])
+            send_bulk(bot, telegram_id, msg, reply_markup=markup, parse_mode='Markdown')
+        except Exception as e:
+            logger.error(f"Error notificando la solicitud {solicitud['id']} a {telegram_id}: {e}")
+    return len(direct), len(digest)
+
+
+def init_digest():
+    """Carga las preferencias y el buffer guardado e inicia el hilo de envío."""
+    global _digest_users
+    if digest_buffer.started:
+        return
+    with _digest_users_lock:
+        _digest_users = get_digest_mode_users()
+    restored = 0
+    try:
+        for telegram_id, solicitud_id, creado_en in get_digest_entries():
+            digest_buffer.add(telegram_id, solicitud_id, since=parse_db_timestamp(creado_en))
+            restored += 1
+    except Exception as e:
+        logger.error(f"❌ Error recuperando los resúmenes pendientes: {e}")
+    digest_buffer.start()
+    logger.info(f"✅ Modo resumen iniciado ({len(_digest_users)} transportistas, {restored} coincidencias recuperadas)")
+
+
+add_user_change_listener(_refresh_digest_mode, columns={'modo_resumen'})
@@ -0,0 +1,148 @@
+# expirations.py
+import calendar
+import heapq
+import threading
+import time
+from config import logger
+from db import get_pending_confirmations, expire_pending_solicitud
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def parse_db_timestamp(value):
+    """'YYYY-MM-DD HH:MM:SS' (UTC, formato de SQLite) → epoch en segundos."""
+    return calendar.timegm(time.strptime(str(value)[:19], TIMESTAMP_FORMAT))
+
+
+def format_db_timestamp(epoch):
+    """Epoch en segundos → 'YYYY-MM-DD HH:MM:SS' (UTC)."""
+    return time.strftime(TIMESTAMP_FORMAT, time.gmtime(epoch))
+
+
+class ExpirationScheduler:
+    """
+    Expira las solicitudes en 'pendiente_confirmacion' al vencer su
+    `pending_confirm_until`.
+
+    Mantiene un min-heap (plazo, solicitud_id) en memoria; un hilo duerme
+    exactamente hasta el plazo más próximo y se despierta antes si se programa
+    uno anterior. Reprogramar o cancelar no borra del heap: la entrada vieja se
+    descarta al salir porque ya no coincide con `_deadlines`.
+    """
+
+    def __init__(self, on_expire=None):
+        self._heap = []
+        self._deadlines = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._on_expire = on_expire
+        self.stats = {'scheduled': 0, 'expired': 0, 'skipped': 0}
+
+    def schedule(self, solicitud_id, deadline):
+        """Programa (o reprograma) la expiración; `deadline` es epoch o timestamp de BD."""
+        if not isinstance(deadline, (int, float)):
+            deadline = parse_db_timestamp(deadline)
+        with self._cond:
+            self._deadlines[solicitud_id] = deadline
+            heapq.heappush(self._heap, (deadline, solicitud_id))
+            self.stats['scheduled'] += 1
+            if self._heap[0][1] == solicitud_id:
+                self._cond.notify()
+
+    def cancel(self, solicitud_id):
+        """Olvida la expiración (p. ej. al confirmarse la solicitud)."""
+        with self._cond:
+            self._deadlines.pop(solicitud_id, None)
+
+    def load_from_db(self):
+        """Reconstruye el heap con las confirmaciones pendientes guardadas."""
+        pending = get_pending_confirmations()
+        for solicitud_id, deadline in pending:
+            try:
+                self.schedule(solicitud_id, deadline)
+            except ValueError:
+                logger.warning(f"⚠️ pending_confirm_until inválido en la solicitud {solicitud_id}: {deadline}")
+        return len(pending)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        loaded = self.load_from_db()
+        self._thread = threading.Thread(target=self._run, name="expirations", daemon=True)
+        self._thread.start()
+        logger.info(f"✅ Planificador de expiraciones iniciado ({loaded} pendientes).")
+
+    def _next_due(self):
+        """Bloquea hasta que vence la próxima entrada vigente y la devuelve."""
+        with self._cond:
+            while True:
+                while self._heap and self._deadlines.get(self._heap[0][1]) != self._heap[0][0]:
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                deadline, solicitud_id = self._heap[0]
+                delay = deadline - time.time()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._heap)
+                del self._deadlines[solicitud_id]
+                return solicitud_id, deadline
+
+    def _run(self):
+        while True:
+            solicitud_id, deadline = self._next_due()
+            try:
+                self._expire(solicitud_id, deadline)
+            except Exception as e:
+                logger.error(f"❌ Error procesando la expiración de la solicitud {solicitud_id}: {e}")
+
+    def _expire(self, solicitud_id, deadline):
+        # Se compara con el plazo programado: un reloj de BD algo adelantado no la salta
+        parties = expire_pending_solicitud(solicitud_id, format_db_timestamp(max(deadline, time.time())))
+        if parties is None:
+            self.stats['skipped'] += 1
+            return
+        self.stats['expired'] += 1
+        logger.info(f"⏰ Solicitud {solicitud_id} expirada y devuelta a 'activa'.")
+        if self._on_expire:
+            self._on_expire(solicitud_id, *parties)
+
+    def get_stats(self):
+        with self._cond:
+            stats = dict(self.stats)
+            stats['pending'] = len(self._deadlines)
+        return stats
+
+
+def notify_expired(solicitud_id, solicitante_id, transportista_id):
+    """Avisa a ambas partes de que la solicitud vuelve a estar disponible."""
+    from bot_instance import bot
+    from outbound import send_bulk
+    from utils import get_message
+
+    for telegram_id in (solicitante_id, transportista_id):
+        if not telegram_id:
+            continue
+        try:
+            send_bulk(
+                bot, telegram_id, get_message('request_expired', telegram_id, id=solicitud_id), parse_mode='Markdown'
+            )
+        except Exception as e:
+            logger.error(f"Error notificando la expiración de la solicitud {solicitud_id} a {telegram_id}: {e}")
+
+
+expiration_scheduler = ExpirationScheduler(on_expire=notify_expired)
+
+
+def schedule_expiration(solicitud_id, deadline):
+    expiration_scheduler.schedule(solicitud_id, deadline)
+
+
+def cancel_expiration(solicitud_id):
+    expiration_scheduler.cancel(solicitud_id)
+
+
+def init_expirations():
+    expiration_scheduler.start()
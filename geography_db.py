@@ -1,27 +1,447 @@
+# geography_db.py
+import sqlite3
+import threading
+from types import MappingProxyType
+import numpy as np
+from config import logger
+from db import db_connection, get_admin_data, get_admin_level, get_user_internal_id
+
+LEVELS = ('pais', 'provincia', 'zona')
+LEVEL_TABLES = {'pais': 'paises', 'provincia': 'provincias', 'zona': 'zonas'}
+EARTH_RADIUS_KM = 6371.0088
+
+
+class GeographySnapshot:
+    """
+    Copia inmutable del árbol países → provincias → zonas.
+
+    `by_id[nivel]` da la fila de cada id en O(1) y `children[nivel]` los ids
+    hijos activos de cada padre (provincias por país, zonas por provincia),
+    ordenados por nombre. Las filas de zona incluyen `pais_id` para no tener
+    que subir por el árbol, y su centroide (`lat`/`lon`, o None).
+
+    `distances` es la matriz de distancias entre centroides, calculada la
+    primera vez que se pide y válida mientras lo sea el snapshot.
+    """
+
+    def __init__(self, version, paises, provincias, zonas):
+        self.version = version
+        self.by_id = MappingProxyType({
+            'pais': MappingProxyType({row['id']: row for row in paises}),
+            'provincia': MappingProxyType({row['id']: row for row in provincias}),
+            'zona': MappingProxyType({row['id']: row for row in zonas}),
+        })
+        self.root = tuple(row['id'] for row in paises if row['estado'] == 'activo')
+        self.children = MappingProxyType({
+            'pais': self._group(provincias, 'pais_id'),
+            'provincia': self._group(zonas, 'provincia_id'),
+        })
+        self._distances = None
+        self._distances_lock = threading.Lock()
+
+    @staticmethod
+    def _group(rows, parent_key):
+        groups = {}
+        for row in rows:
+            if row['estado'] == 'activo':
+                groups.setdefault(row[parent_key], []).append(row['id'])
+        return MappingProxyType({parent: tuple(ids) for parent, ids in groups.items()})
+
+    def rows(self, level, ids):
+        table = self.by_id[level]
+        return [table[id_] for id_ in ids]
+
+    @property
+    def distances(self):
+        if self._distances is None:
+            with self._distances_lock:
+                if self._distances is None:
+                    self._distances = ZoneDistances(self.by_id['zona'].values())
+        return self._distances
+
+
+class ZoneDistances:
+    """
+    Distancias (km) entre los centroides de las zonas activas, en una matriz
+    NxN calculada de una vez con haversine vectorizado. `ids` da el id de zona
+    de cada fila/columna; las zonas sin centroide no aparecen.
+    """
+
+    def __init__(self, zonas):
+        located = [z for z in zonas if z['estado'] == 'activo' and z['lat'] is not None and z['lon'] is not None]
+        self.ids = np.array([z['id'] for z in located], dtype=np.int64)
+        self.position = {int(id_): i for i, id_ in enumerate(self.ids)}
+
+        lat = np.radians(np.array([z['lat'] for z in located], dtype=np.float64))
+        lon = np.radians(np.array([z['lon'] for z in located], dtype=np.float64))
+        dlat = lat[:, None] - lat[None, :]
+        dlon = lon[:, None] - lon[None, :]
+        a = np.sin(dlat / 2) ** 2 + np.cos(lat)[:, None] * np.cos(lat)[None, :] * np.sin(dlon / 2) ** 2
+        # float32: la mitad de memoria; la precisión sobra para radios en km
+        self.matrix = (2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))).astype(np.float32)
+
+    def within(self, zona_ids, radio_km):
+        """Ids de las zonas a ≤ radio_km del centroide de alguna de `zona_ids`."""
+        rows = [self.position[id_] for id_ in zona_ids if id_ in self.position]
+        if not rows:
+            return set()
+        mask = (self.matrix[rows] <= radio_km).any(axis=0)
+        return set(self.ids[mask].tolist())
+
+    def around(self, zona_id, radio_km):
+        """{zona_id: km} de las zonas a ≤ radio_km del centroide de `zona_id` (ella incluida)."""
+        row = self.position.get(zona_id)
+        if row is None:
+            return {}
+        distances = self.matrix[row]
+        mask = distances <= radio_km
+        return dict(zip(self.ids[mask].tolist(), distances[mask].tolist()))
+
+    def nearest_from(self, zona_ids):
+        """{zona_id: km hasta la más cercana de `zona_ids`} para las zonas con centroide."""
+        rows = [self.position[id_] for id_ in zona_ids if id_ in self.position]
+        if not rows:
+            return {}
+        return dict(zip(self.ids.tolist(), self.matrix[rows].min(axis=0).tolist()))
+
+
+# Se incrementa en cada escritura; el snapshot se reconstruye al leer si no coincide
+_version = 0
+_snapshot = None
+_snapshot_lock = threading.Lock()
+
+
+def _load_snapshot(version):
+    with db_connection() as conn:
+        paises = [
+            MappingProxyType(dict(row))
+            for row in conn.execute("SELECT id, nombre, codigo, estado FROM paises ORDER BY nombre")
+        ]
+        provincias = [
+            MappingProxyType(dict(row))
+            for row in conn.execute("SELECT id, pais_id, nombre, estado FROM provincias ORDER BY nombre")
+        ]
+        zonas = [
+            MappingProxyType(dict(row))
+            for row in conn.execute('''
+                SELECT z.id, z.provincia_id, p.pais_id, z.nombre, z.estado, z.lat, z.lon
+                FROM zonas z LEFT JOIN provincias p ON p.id = z.provincia_id
+                ORDER BY z.nombre
+            ''')
+        ]
+    return GeographySnapshot(version, paises, provincias, zonas)
+
+
+def get_geography_snapshot():
+    """Devuelve el snapshot vigente; solo consulta SQLite tras una invalidación."""
+    global _snapshot
+    snapshot = _snapshot
+    if snapshot is not None and snapshot.version == _version:
+        return snapshot
+
+    with _snapshot_lock:
+        if _snapshot is None or _snapshot.version != _version:
+            _snapshot = _load_snapshot(_version)
+            logger.info(f"🗺️ Caché geográfica cargada (versión {_version})")
+        return _snapshot
+
+
+def invalidate_geography_cache():
+    global _version
+    with _snapshot_lock:
+        _version += 1
+
+
 def get_geographic_level_name(level, id_):
     """Obtiene el nombre de un país, provincia o zona dado su ID y nivel."""
     if not id_:
         return "N/A"
-        
-    try:
-        with sqlite3.connect(DATABASE_FILE, timeout=10) as conn:
-            cursor = conn.cursor()
-            
-            # ✅ CORREGIR: Mapear niveles a nombres de tabla correctos
-            table_map = {
-                'pais': 'paises',
-                'provincia': 'provincias', 
-                'zona': 'zonas'
-            }
-            
-            table = table_map.get(level)
-            if not table:
-                return "Nivel desconocido"
-            
-            cursor.execute(f"SELECT nombre FROM {table} WHERE id = ?", (id_,))
-            result = cursor.fetchone()
-            return result[0] if result else "Desconocido"
-            
+
+    try:
+        snapshot = get_geography_snapshot()
+        if level not in snapshot.by_id:
+            return "Nivel desconocido"
+
+        row = snapshot.by_id[level].get(int(id_))
+        return row['nombre'] if row else "Desconocido"
+
     except Exception as e:
         logger.error(f"Error obteniendo nombre geográfico para {level} ID {id_}: {e}")
-        return "ERROR_DB"
\ No newline at end of file
+        return "ERROR_DB"
+
+
+def get_geographic_names(ids_by_level):
+    """
+    Resuelve de una vez nombres de cualquier mezcla de niveles.
+
+    `ids_by_level` es {nivel: [ids]}; devuelve {nivel: {id: nombre}}. Los ids
+    ausentes del snapshot se buscan en una sola consulta (UNION ALL con IN).
+    """
+    names = {level: {} for level in ids_by_level}
+    missing = {}
+    try:
+        snapshot = get_geography_snapshot()
+        for level, ids in ids_by_level.items():
+            table = snapshot.by_id.get(level)
+            if table is None:
+                continue
+            for id_ in ids:
+                if not id_:
+                    continue
+                row = table.get(int(id_))
+                if row:
+                    names[level][row['id']] = row['nombre']
+                else:
+                    missing.setdefault(level, set()).add(int(id_))
+
+        if missing:
+            parts, params = [], []
+            for level, ids in missing.items():
+                parts.append(
+                    f"SELECT '{level}' AS nivel, id, nombre FROM {LEVEL_TABLES[level]} "
+                    f"WHERE id IN ({','.join('?' * len(ids))})"
+                )
+                params.extend(ids)
+            with db_connection() as conn:
+                for nivel, id_, nombre in conn.execute(" UNION ALL ".join(parts), params):
+                    names[nivel][id_] = nombre
+
+    except Exception as e:
+        logger.error(f"Error resolviendo nombres geográficos {ids_by_level}: {e}")
+    return names
+
+
+def get_full_path(zona_id):
+    """
+    Devuelve {pais_id, pais_nombre, provincia_id, provincia_nombre, zona_id,
+    zona_nombre} de una zona, o None si no existe.
+    """
+    if not zona_id:
+        return None
+    try:
+        snapshot = get_geography_snapshot()
+        zona = snapshot.by_id['zona'].get(int(zona_id))
+        if zona:
+            provincia = snapshot.by_id['provincia'].get(zona['provincia_id'])
+            pais = snapshot.by_id['pais'].get(zona['pais_id'])
+            if provincia and pais:
+                return {
+                    'pais_id': pais['id'], 'pais_nombre': pais['nombre'],
+                    'provincia_id': provincia['id'], 'provincia_nombre': provincia['nombre'],
+                    'zona_id': zona['id'], 'zona_nombre': zona['nombre'],
+                }
+
+        with db_connection() as conn:
+            row = conn.execute('''
+                SELECT pa.id AS pais_id, pa.nombre AS pais_nombre,
+                       pr.id AS provincia_id, pr.nombre AS provincia_nombre,
+                       z.id AS zona_id, z.nombre AS zona_nombre
+                FROM zonas z
+                JOIN provincias pr ON pr.id = z.provincia_id
+                JOIN paises pa ON pa.id = pr.pais_id
+                WHERE z.id = ?
+            ''', (zona_id,)).fetchone()
+        return dict(row) if row else None
+
+    except Exception as e:
+        logger.error(f"Error obteniendo la ruta de la zona {zona_id}: {e}")
+        return None
+
+
+# --- Listados (servidos desde el snapshot) ---
+
+def get_countries():
+    snapshot = get_geography_snapshot()
+    return snapshot.rows('pais', snapshot.root)
+
+def get_provincias(pais_id):
+    snapshot = get_geography_snapshot()
+    return snapshot.rows('provincia', snapshot.children['pais'].get(pais_id, ()))
+
+def get_zonas(provincia_id):
+    snapshot = get_geography_snapshot()
+    return snapshot.rows('zona', snapshot.children['provincia'].get(provincia_id, ()))
+
+def get_available_countries_for_registration():
+    return get_countries()
+
+
+# --- Jerarquía (closure table `geo_ancestros`) ---
+
+def is_descendant(nivel, id_, ancestro_nivel, ancestro_id):
+    """True si el nodo (nivel, id_) es o cuelga de (ancestro_nivel, ancestro_id)."""
+    try:
+        with db_connection() as conn:
+            return conn.execute('''
+                SELECT 1 FROM geo_ancestros
+                WHERE nodo_nivel = ? AND nodo_id = ? AND ancestro_nivel = ? AND ancestro_id = ?
+            ''', (nivel, id_, ancestro_nivel, ancestro_id)).fetchone() is not None
+    except Exception as e:
+        logger.error(f"Error comprobando ascendencia de {nivel} {id_}: {e}")
+        return False
+
+def get_descendant_ids(nivel, ancestros):
+    """
+    Ids de los nodos de `nivel` que cuelgan de todos los `ancestros`
+    [(nivel, id)] a la vez (p. ej. jurisdicción del admin y país elegido).
+    """
+    if not ancestros:
+        return None
+    joins, where, params = [], [], []
+    for i, (ancestro_nivel, ancestro_id) in enumerate(ancestros):
+        alias = f"a{i}"
+        if i:
+            joins.append(f"JOIN geo_ancestros {alias} ON {alias}.nodo_nivel = a0.nodo_nivel AND {alias}.nodo_id = a0.nodo_id")
+        where.append(f"{alias}.ancestro_nivel = ? AND {alias}.ancestro_id = ?")
+        params.extend((ancestro_nivel, ancestro_id))
+    try:
+        with db_connection() as conn:
+            return {
+                row[0] for row in conn.execute(
+                    f"SELECT a0.nodo_id FROM geo_ancestros a0 {' '.join(joins)} "
+                    f"WHERE a0.nodo_nivel = ? AND {' AND '.join(where)}",
+                    (nivel, *params)
+                )
+            }
+    except Exception as e:
+        logger.error(f"Error obteniendo descendientes de {ancestros}: {e}")
+        return set()
+
+def get_zone_data(zona_id):
+    """pais/provincia/zona (ids y nombres) de una zona, o None."""
+    return get_full_path(zona_id)
+
+def expand_zones_by_radius(zona_ids, radio_km):
+    """
+    Zonas elegidas más todas las que tienen el centroide a ≤ radio_km de alguna
+    de ellas. Un corte de la matriz precalculada, sin calcular distancias.
+    """
+    zonas = set(zona_ids)
+    if not radio_km or radio_km <= 0:
+        return zonas
+    try:
+        return zonas | get_geography_snapshot().distances.within(zonas, radio_km)
+    except Exception as e:
+        logger.error(f"Error ampliando zonas {sorted(zonas)} a {radio_km} km: {e}")
+        return zonas
+
+def get_zones_around(zona_id, radio_km):
+    """{zona_id: km} de las zonas a ≤ radio_km de `zona_id`; vacío sin centroide."""
+    try:
+        return get_geography_snapshot().distances.around(zona_id, radio_km)
+    except Exception as e:
+        logger.error(f"Error buscando zonas a {radio_km} km de la zona {zona_id}: {e}")
+        return {}
+
+def get_zone_distances_from(zona_ids):
+    """{zona_id: km hasta la zona más cercana de `zona_ids`}; vacío sin centroides."""
+    try:
+        distances = {id_: 0.0 for id_ in zona_ids}
+        return {**get_geography_snapshot().distances.nearest_from(zona_ids), **distances}
+    except Exception as e:
+        logger.error(f"Error calculando distancias desde las zonas {sorted(zona_ids)}: {e}")
+        return {id_: 0.0 for id_ in zona_ids}
+
+
+# --- Listados filtrados por jurisdicción del administrador ---
+
+def _admin_root(telegram_id):
+    """
+    Nodo raíz de la jurisdicción del admin: None para supremo (todo el árbol),
+    (nivel, id) para admins regionales o False si no es administrador.
+    """
+    nivel = get_admin_level(telegram_id)
+    if nivel in ('supremo', 'supremo_2'):
+        return None
+    admin_data = get_admin_data(telegram_id)
+    if nivel in LEVELS and admin_data.get(f'{nivel}_id'):
+        return nivel, admin_data[f'{nivel}_id']
+    return False
+
+def is_in_jurisdiction(telegram_id, nivel, id_):
+    """¿Puede el admin gestionar el nodo (nivel, id_)? Una sola búsqueda indexada."""
+    root = _admin_root(telegram_id)
+    if root is False:
+        return False
+    if root is None:
+        return id_ in get_geography_snapshot().by_id[nivel]
+    return is_descendant(nivel, id_, *root)
+
+def _admin_nodes(telegram_id, nivel, within=None):
+    """Filas activas de `nivel` bajo la jurisdicción del admin (y bajo `within` si se da)."""
+    root = _admin_root(telegram_id)
+    if root is False:
+        return []
+
+    snapshot = get_geography_snapshot()
+    ancestros = [node for node in (root, within) if node]
+    ids = get_descendant_ids(nivel, ancestros)
+    table = snapshot.by_id[nivel]
+    rows = table.values() if ids is None else (table[id_] for id_ in ids if id_ in table)
+    return sorted((row for row in rows if row['estado'] == 'activo'), key=lambda row: row['nombre'])
+
+def get_admin_creatable_countries(telegram_id):
+    """Países en los que el admin puede crear provincias o designar administradores."""
+    return _admin_nodes(telegram_id, 'pais')
+
+def get_admin_creatable_provincias(telegram_id, pais_id=None):
+    """Provincias en las que el admin puede crear zonas o designar administradores."""
+    return _admin_nodes(telegram_id, 'provincia', ('pais', pais_id) if pais_id else None)
+
+def get_admin_creatable_zonas(telegram_id, provincia_id=None):
+    """Zonas que el admin puede asignar, opcionalmente limitadas a una provincia."""
+    return _admin_nodes(telegram_id, 'zona', ('provincia', provincia_id) if provincia_id else None)
+
+
+# --- Escrituras (invalidan el snapshot) ---
+
+def _create(table, columns, values):
+    try:
+        with db_connection() as conn:
+            cursor = conn.execute(
+                f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                values
+            )
+            new_id = cursor.lastrowid
+    except sqlite3.IntegrityError:
+        return "error_already_exists", None
+    except Exception as e:
+        logger.error(f"Error creando registro en {table}: {e}")
+        return str(e), None
+
+    invalidate_geography_cache()
+    return "success", new_id
+
+def create_country(admin_telegram_id, nombre, codigo):
+    return _create(
+        'paises', ('nombre', 'codigo', 'creado_por_admin_id'),
+        (nombre, codigo, get_user_internal_id(admin_telegram_id))
+    )
+
+def create_provincia(admin_telegram_id, pais_id, nombre):
+    return _create(
+        'provincias', ('pais_id', 'nombre', 'creado_por_admin_id'),
+        (pais_id, nombre, get_user_internal_id(admin_telegram_id))
+    )
+
+def create_zona(admin_telegram_id, provincia_id, nombre):
+    return _create(
+        'zonas', ('provincia_id', 'nombre', 'creado_por_admin_id'),
+        (provincia_id, nombre, get_user_internal_id(admin_telegram_id))
+    )
+
+def set_zone_centroid(zona_id, lat, lon):
+    """Guarda el centroide de una zona; la matriz de distancias se recalcula al pedirla."""
+    try:
+        with db_connection() as conn:
+            updated = conn.execute(
+                "UPDATE zonas SET lat = ?, lon = ? WHERE id = ?", (lat, lon, zona_id)
+            ).rowcount
+    except Exception as e:
+        logger.error(f"Error guardando el centroide de la zona {zona_id}: {e}")
+        return str(e)
+
+    if not updated:
+        return "error_not_found"
+    invalidate_geography_cache()
+    return "success"
@@ -1,21 +1,18 @@
 # admin.py
 
-import sqlite3
+import html
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove
 from bot_instance import bot, user_states
-from db import log_audit, get_user_by_telegram_id, DATABASE_FILE, get_admin_data
+from db import (
+    log_audit, get_user_by_telegram_id, db_connection, get_admin_data, get_admin_level, admin_has_permission,
+    invalidate_admin_cache, get_stats_counters, verify_stats_counters, rebuild_stats_counters, set_user_state
+)
 from utils import get_message
 # 🚨 LÍNEA CORREGIDA Y COMPLETA 🚨
-from config import logger, ADMIN_SUPREMO_ID, ADMIN_SUPREMO 
+from config import logger, ADMIN_SUPREMO_ID, ADMIN_SUPREMO, ADMIN_PERMISSIONS
 import keyboards
 import geography_db # Nueva dependencia
 
-# Se asume que set_user_state está disponible, generalmente con:
-# from handlers.registro import set_user_state 
-# Si el código se ejecuta desde main.py, y main.py importa todo handlers, puede que funcione.
-# Sin embargo, para seguridad, añadiremos la importación:
-from handlers.registro import set_user_state # 🚨 IMPORTACIÓN AÑADIDA
-
 # ESTADOS FSM PARA EL FLUJO DE ADMINISTRACIÓN
 # ... (el resto del archivo)
 
@@ -71,19 +68,20 @@ def admin_command(message):
 def get_admin_main_menu_keyboard(nivel):
     """Genera el teclado principal del panel de administración."""
     markup = InlineKeyboardMarkup(row_width=1)
+    permisos = ADMIN_PERMISSIONS.get(nivel, frozenset())
 
     # Menú de Creación Geográfica (Abierto al Supremo/Supremo 2 y admins regionales)
-    if nivel in ('supremo', 'supremo_2'):
+    if 'crear_pais' in permisos:
         markup.add(InlineKeyboardButton("🌍 Crear País", callback_data="admin_create_country"))
 
-    if nivel in ('supremo', 'supremo_2', 'pais'):
+    if 'crear_provincia' in permisos:
         markup.add(InlineKeyboardButton("📍 Crear Provincia", callback_data="admin_create_provincia"))
 
-    if nivel in ('supremo', 'supremo_2', 'pais', 'provincia'):
+    if 'crear_zona' in permisos:
         markup.add(InlineKeyboardButton("🗺️ Crear Zona/Municipio", callback_data="admin_create_zona"))
 
     # Menú de Gestión de Admins (Solo Supremo/Supremo 2)
-    if nivel in ('supremo', 'supremo_2'):
+    if 'gestionar_admins' in permisos:
         markup.add(InlineKeyboardButton("👑 Gestionar Administradores", callback_data="admin_manage_admins"))
 
     # Botones de utilidad
@@ -126,18 +124,11 @@ def admin_panel(message):
             bot.reply_to(message, get_message('error_no_permission', user.id))
             return
 
-        # Obtener estadísticas (Lógica mantenida de la versión anterior)
-        with sqlite3.connect(DATABASE_FILE, timeout=10) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT COUNT(*) FROM usuarios")
-            total_usuarios = cursor.fetchone()[0]
-            cursor.execute("SELECT COUNT(*) FROM usuarios WHERE estado = 'activo'")
-            usuarios_activos = cursor.fetchone()[0]
-            cursor.execute("SELECT COUNT(*) FROM solicitudes")
-            total_solicitudes = cursor.fetchone()[0]
-            cursor.execute("SELECT COUNT(*) FROM solicitudes WHERE estado = 'activa'")
-            solicitudes_activas = cursor.fetchone()[0]
-            
+        # Obtener estadísticas (contadores materializados, una sola lectura)
+        stats = get_stats_counters()
+        total_usuarios = stats['usuarios_total']
+        solicitudes_activas = stats['solicitudes_activas']
+
         admin_text = get_message('admin_panel_welcome', user.id) + f"""
 *Tu Nivel:* {nivel.title()}
 *Tu Jurisdicción:* {region}
@@ -157,6 +148,58 @@ def admin_panel(message):
     except Exception as e:
         logger.error(f"Error en panel admin: {e}")
         bot.reply_to(message, "❌ Error al cargar el panel de administración.")
+
+@bot.message_handler(commands=['verificar_estadisticas'])
+def verificar_estadisticas_command(message):
+    """Comprueba los contadores materializados contra COUNT(*) y los recalcula si hay desvío."""
+    user = message.from_user
+
+    if not admin_has_permission(user.id, 'verificar_estadisticas'):
+        bot.reply_to(message, get_message('error_no_permission', user.id))
+        return
+
+    try:
+        drift = verify_stats_counters()
+        if not drift:
+            bot.reply_to(message, "✅ Los contadores de estadísticas son exactos.")
+            return
+
+        rebuild_stats_counters()
+        detalle = "\n".join(f"- {campo}: {guardado} → {real}" for campo, (guardado, real) in drift.items())
+        bot.reply_to(message, f"⚠️ Contadores corregidos:\n{detalle}")
+        log_audit("stats_counters_rebuilt", user.id, detalle)
+    except Exception as e:
+        logger.error(f"Error verificando contadores de estadísticas: {e}")
+        bot.reply_to(message, "❌ Error al verificar las estadísticas.")
+
+@bot.message_handler(commands=['centroide'])
+def centroide_command(message):
+    """/centroide <zona_id> <lat> <lon>: fija el centroide usado para el radio de trabajo."""
+    user = message.from_user
+
+    if not admin_has_permission(user.id, 'asignar_centroides'):
+        bot.reply_to(message, get_message('error_no_permission', user.id))
+        return
+
+    try:
+        _, zona_id, lat, lon = message.text.split()
+        zona_id, lat, lon = int(zona_id), float(lat), float(lon)
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            raise ValueError
+    except ValueError:
+        bot.reply_to(message, "❌ Uso: /centroide <zona_id> <latitud> <longitud>\nEj: /centroide 12 23.1136 -82.3666")
+        return
+
+    result = geography_db.set_zone_centroid(zona_id, lat, lon)
+    if result == "success":
+        nombre = geography_db.get_geographic_level_name('zona', zona_id)
+        bot.reply_to(message, f"✅ Centroide de <b>{html.escape(nombre)}</b> guardado: {lat:.5f}, {lon:.5f}")
+        log_audit("zone_centroid_set", user.id, f"zona {zona_id}: {lat}, {lon}")
+    elif result == "error_not_found":
+        bot.reply_to(message, f"❌ No existe la zona {zona_id}.")
+    else:
+        bot.reply_to(message, "❌ Error al guardar el centroide.")
+
 # ... (Código anterior - Parte 1) ...
 
 # --- HANDLERS DE INTERACCIÓN DEL MENÚ DE ADMIN ---
@@ -168,19 +211,18 @@ def handle_admin_menu_callbacks(call):
     chat_id = call.message.chat.id
     action = call.data
     
-    # 1. Verificar si el usuario es administrador
-    admin_data = get_admin_data(user.id)
-    is_supremo = user.id == ADMIN_SUPREMO_ID
-    
-    if not admin_data and not is_supremo:
+    # 1. Verificar si el usuario es administrador (permisos precalculados por nivel)
+    nivel = get_admin_level(user.id)
+    if not nivel:
         bot.answer_callback_query(call.id, get_message('error_no_permission', user.id))
         return
+    permisos = ADMIN_PERMISSIONS.get(nivel, frozenset())
 
     # 2. Manejar la acción
     try:
         if action == 'admin_create_country':
             # Solo Supremo/Supremo 2
-            if not is_supremo and admin_data['nivel'] not in ('supremo', 'supremo_2'):
+            if 'crear_pais' not in permisos:
                 bot.answer_callback_query(call.id, "❌ No tienes permiso para crear países.", show_alert=True)
                 return
 
@@ -195,7 +237,7 @@ def handle_admin_menu_callbacks(call):
             
         elif action == 'admin_create_provincia':
             # Solo Supremo/Supremo 2/País
-            if not is_supremo and admin_data['nivel'] not in ('supremo', 'supremo_2', 'pais'):
+            if 'crear_provincia' not in permisos:
                 bot.answer_callback_query(call.id, "❌ No tienes permiso para crear provincias.", show_alert=True)
                 return
 
@@ -219,7 +261,7 @@ def handle_admin_menu_callbacks(call):
             
         elif action == 'admin_create_zona':
             # Solo Supremo/Supremo 2/País/Provincia
-            if not is_supremo and admin_data['nivel'] not in ('supremo', 'supremo_2', 'pais', 'provincia'):
+            if 'crear_zona' not in permisos:
                 bot.answer_callback_query(call.id, "❌ No tienes permiso para crear zonas.", show_alert=True)
                 return
 
@@ -242,6 +284,9 @@ def handle_admin_menu_callbacks(call):
             )
 
         elif action == 'admin_manage_admins':
+             if 'gestionar_admins' not in permisos:
+                 bot.answer_callback_query(call.id, "❌ No tienes permiso para gestionar administradores.", show_alert=True)
+                 return
              # Manejar la designación de admins
              user_states[user.id] = {'step': ADMIN_FSM['designar_admin_id'], 'data': {}}
              bot.edit_message_text(
@@ -278,10 +323,11 @@ def get_provincia_selection_keyboard(provincias, prefix):
     """Genera teclado de selección de provincias para los flujos de administración."""
     markup = InlineKeyboardMarkup(row_width=2)
     # Se agrupan por país para mejor visualización (solo si se necesita)
+    pais_names = geography_db.get_geographic_names({'pais': [p['pais_id'] for p in provincias]})['pais']
     
     for provincia in provincias:
         # Se muestra el nombre del país para contexto si el admin gestiona varios
-        nombre_display = f"[{geography_db.get_geographic_level_name('pai', provincia['pais_id'])}] {provincia['nombre']}"
+        nombre_display = f"[{pais_names.get(provincia['pais_id'], 'Desconocido')}] {provincia['nombre']}"
         markup.add(InlineKeyboardButton(nombre_display, callback_data=f"{prefix}{provincia['id']}"))
         
     markup.add(InlineKeyboardButton("❌ Cancelar", callback_data="menu_back_admin"))
@@ -330,7 +376,7 @@ def handle_admin_creation_text(message):
                 chat_id, 
                 f"✅ *País Creado:* {country_name} ({country_code}). ID: #{new_id}",
                 parse_mode='Markdown',
-                reply_markup=get_admin_main_menu_keyboard(get_admin_data(user.id)['nivel'] if get_admin_data(user.id) else 'supremo')
+                reply_markup=get_admin_main_menu_keyboard(get_admin_level(user.id) or 'supremo')
             )
             log_audit("country_created", user.id, f"País: {country_name}, Código: {country_code}")
             del user_states[user.id]
@@ -352,12 +398,12 @@ def handle_admin_creation_text(message):
         result, new_id = geography_db.create_provincia(user.id, pais_id, provincia_name)
         
         if result == "success":
-            pais_name = geography_db.get_geographic_level_name('pai', pais_id)
+            pais_name = geography_db.get_geographic_level_name('pais', pais_id)
             bot.send_message(
                 chat_id, 
                 f"✅ *Provincia Creada:* {provincia_name} en {pais_name}. ID: #{new_id}",
                 parse_mode='Markdown',
-                reply_markup=get_admin_main_menu_keyboard(get_admin_data(user.id)['nivel'] if get_admin_data(user.id) else 'supremo')
+                reply_markup=get_admin_main_menu_keyboard(get_admin_level(user.id) or 'supremo')
             )
             log_audit("provincia_created", user.id, f"Provincia: {provincia_name}, País ID: {pais_id}")
             del user_states[user.id]
@@ -379,12 +425,12 @@ def handle_admin_creation_text(message):
         result, new_id = geography_db.create_zona(user.id, provincia_id, zona_name)
         
         if result == "success":
-            provincia_name = geography_db.get_geographic_level_name('provinci', provincia_id)
+            provincia_name = geography_db.get_geographic_level_name('provincia', provincia_id)
             bot.send_message(
                 chat_id, 
                 f"✅ *Zona Creada:* {zona_name} en {provincia_name}. ID: #{new_id}",
                 parse_mode='Markdown',
-                reply_markup=get_admin_main_menu_keyboard(get_admin_data(user.id)['nivel'] if get_admin_data(user.id) else 'supremo')
+                reply_markup=get_admin_main_menu_keyboard(get_admin_level(user.id) or 'supremo')
             )
             log_audit("zona_created", user.id, f"Zona: {zona_name}, Provincia ID: {provincia_id}")
             del user_states[user.id]
@@ -396,7 +442,7 @@ def handle_admin_creation_text(message):
     
     else:
         # En caso de que se pierda el paso
-        bot.send_message(chat_id, "❌ Error de estado FSM. Volviendo al panel...", reply_markup=get_admin_main_menu_keyboard(get_admin_data(user.id)['nivel'] if get_admin_data(user.id) else 'supremo'))
+        bot.send_message(chat_id, "❌ Error de estado FSM. Volviendo al panel...", reply_markup=get_admin_main_menu_keyboard(get_admin_level(user.id) or 'supremo'))
         if user.id in user_states:
             del user_states[user.id]
 
@@ -417,7 +463,10 @@ def handle_admin_selection_callbacks(call):
     # 1. Selección de País para la Provincia (admin_prov_PAIS_ID)
     if call.data.startswith('admin_prov_') and user_data['step'] == ADMIN_FSM['crear_prov_select_pais']:
         pais_id = int(call.data.split('_')[2])
-        pais_name = geography_db.get_geographic_level_name('pai', pais_id)
+        if not geography_db.is_in_jurisdiction(user.id, 'pais', pais_id):
+            bot.answer_callback_query(call.id, "❌ Ese país está fuera de tu jurisdicción.", show_alert=True)
+            return
+        pais_name = geography_db.get_geographic_level_name('pais', pais_id)
         
         user_data['data']['pais_id'] = pais_id
         user_data['step'] = ADMIN_FSM['crear_prov_nombre']
@@ -433,7 +482,10 @@ def handle_admin_selection_callbacks(call):
     # 2. Selección de Provincia para la Zona (admin_zona_PROVINCIA_ID)
     elif call.data.startswith('admin_zona_') and user_data['step'] == ADMIN_FSM['crear_zona_select_prov']:
         provincia_id = int(call.data.split('_')[2])
-        provincia_name = geography_db.get_geographic_level_name('provinci', provincia_id)
+        if not geography_db.is_in_jurisdiction(user.id, 'provincia', provincia_id):
+            bot.answer_callback_query(call.id, "❌ Esa provincia está fuera de tu jurisdicción.", show_alert=True)
+            return
+        provincia_name = geography_db.get_geographic_level_name('provincia', provincia_id)
         
         user_data['data']['provincia_id'] = provincia_id
         user_data['step'] = ADMIN_FSM['crear_zona_nombre']
@@ -600,6 +652,9 @@ def handle_admin_level_selection(call):
 def get_admin_region_selection_keyboard(regions, type_, back_data=None):
     """Genera teclado de selección de región (País, Provincia, o primer paso de Zona)."""
     markup = InlineKeyboardMarkup(row_width=2)
+    pais_names = {}
+    if type_ in ("provincia", "zone_prov_select"):
+        pais_names = geography_db.get_geographic_names({'pais': [r['pais_id'] for r in regions]})['pais']
     
     if type_ == "country":
         for region in regions:
@@ -609,7 +664,7 @@ def get_admin_region_selection_keyboard(regions, type_, back_data=None):
     elif type_ == "provincia":
          for region in regions:
              # Nota: Se asume que las regiones de 'provincia' tienen 'pais_id'
-             pais_name = geography_db.get_geographic_level_name('pai', region['pais_id'])
+             pais_name = pais_names.get(region['pais_id'], 'Desconocido')
              markup.add(InlineKeyboardButton(f"[{pais_name}] {region['nombre']}", callback_data=f"admin_region_provincia_{region['id']}"))
 
     elif type_ == "zone_country_select":
@@ -621,7 +676,7 @@ def get_admin_region_selection_keyboard(regions, type_, back_data=None):
     elif type_ == "zone_prov_select":
         # Se usa este tipo para la selección de provincia en el flujo de zona: lleva a la selección de zona
         for region in regions:
-            pais_name = geography_db.get_geographic_level_name('pai', region['pais_id'])
+            pais_name = pais_names.get(region['pais_id'], 'Desconocido')
             # admin_region_zone_provincia_ID (No asigna, solo navega)
             markup.add(InlineKeyboardButton(f"[{pais_name}] {region['nombre']}", callback_data=f"admin_region_zone_provincia_{region['id']}"))
             
@@ -662,10 +717,10 @@ def handle_admin_region_selection(call):
         # Capturar la región seleccionada para País, Provincia o Zona
         if call.data.startswith('admin_region_country_'):
             region_id = int(call.data.split('_')[3])
-            region_name = geography_db.get_geographic_level_name('pai', region_id)
+            region_name = geography_db.get_geographic_level_name('pais', region_id)
         elif call.data.startswith('admin_region_provincia_'):
             region_id = int(call.data.split('_')[3])
-            region_name = geography_db.get_geographic_level_name('provinci', region_id)
+            region_name = geography_db.get_geographic_level_name('provincia', region_id)
         elif call.data.startswith('admin_region_zona_'):
             region_id = int(call.data.split('_')[3])
             zone_data = geography_db.get_zone_data(region_id)
@@ -681,7 +736,7 @@ def handle_admin_region_selection(call):
                 chat_id,
                 call.message.message_id,
                 parse_mode='Markdown',
-                reply_markup=get_admin_main_menu_keyboard(get_admin_data(user.id)['nivel'] if get_admin_data(user.id) else 'supremo')
+                reply_markup=get_admin_main_menu_keyboard(get_admin_level(user.id) or 'supremo')
             )
             log_audit("admin_role_assigned", user.id, f"Target: {target_telegram_id}, Nivel: {admin_level}, Región ID: {region_id}")
         else:
@@ -689,7 +744,7 @@ def handle_admin_region_selection(call):
                 f"❌ Error crítico al guardar el rol de administrador en la base de datos.",
                 chat_id,
                 call.message.message_id,
-                reply_markup=get_admin_main_menu_keyboard(get_admin_data(user.id)['nivel'] if get_admin_data(user.id) else 'supremo')
+                reply_markup=get_admin_main_menu_keyboard(get_admin_level(user.id) or 'supremo')
             )
             
         del user_states[user.id]
@@ -699,9 +754,8 @@ def handle_admin_region_selection(call):
     # 2. NAVEGACIÓN ZONA: Selección de Provincia (admin_region_zone_country_ID)
     elif call.data.startswith('admin_region_zone_country_'):
         country_id = int(call.data.split('_')[4])
-        provincias = geography_db.get_admin_creatable_provincias(user.id)
-        # Filtrar provincias que pertenecen al país seleccionado
-        provincias_filtradas = [p for p in provincias if p['pais_id'] == country_id]
+        # Provincias del país seleccionado dentro de la jurisdicción del admin
+        provincias_filtradas = geography_db.get_admin_creatable_provincias(user.id, pais_id=country_id)
         
         if not provincias_filtradas:
             bot.answer_callback_query(call.id, "❌ No hay provincias para seleccionar Zona en este país.", show_alert=True)
@@ -745,7 +799,7 @@ def handle_admin_region_selection(call):
 def set_admin_role(user_internal_id, nivel, region_id):
     """Asigna o modifica un rol de administrador en la tabla administradores."""
     try:
-        with sqlite3.connect(DATABASE_FILE, timeout=10) as conn:
+        with db_connection() as conn:
             cursor = conn.cursor()
             
             # 1. Desactivar roles anteriores (si existen)
@@ -790,9 +844,13 @@ def set_admin_role(user_internal_id, nivel, region_id):
                 
                 sql_insert = f"INSERT INTO administradores ({', '.join(columns)}) VALUES ({', '.join(placeholders)})"
                 cursor.execute(sql_insert, values)
-                
-            conn.commit()
-            return True
+
+            cursor.execute("SELECT telegram_id FROM usuarios WHERE id = ?", (user_internal_id,))
+            target = cursor.fetchone()
+
+        # El nuevo rol debe verse ya en el siguiente update, sin esperar al TTL
+        invalidate_admin_cache(target[0] if target else None)
+        return True
             
     except Exception as e:
         logger.error(f"Error asignando rol de admin a usuario {user_internal_id}: {e}")
@@ -4,7 +4,7 @@ from config import (
     logger, STATE_WAITING_LANGUAGE, STATE_WAITING_ROLE, STATE_ACTIVE, 
     ROLE_PENDIENTE, ROLE_SOLICITANTE, ROLE_TRANSPORTISTA, ROLE_AMBOS
 )
-from db import get_user_by_telegram_id, set_user_registration_data, get_user_state, set_user_state
+from db import get_user_by_telegram_id, set_user_registration_data, upsert_user
 import telebot
 import keyboards
 
@@ -43,21 +43,20 @@ def handle_language_selection(call):
     chat_id = call.message.chat.id
     lang = call.data.split('_')[1]  # 'es' o 'en'
     
-    # Guardar idioma y pedir nombre
-    set_user_registration_data(
-        telegram_id=user.id,
+    # Guardar idioma y estado en una sola escritura, y pedir tipo de usuario
+    upsert_user(
+        user.id,
         username=user.username,
-        name=user.first_name or "Usuario",
-        phone="",
-        user_type=ROLE_PENDIENTE,
+        nombre_completo=user.first_name or "Usuario",
+        telefono="",
+        tipo=ROLE_PENDIENTE,
         pais_id=None,
         provincia_id=None,
         zona_id=None,
-        lang=lang
+        idioma=lang,
+        estado=STATE_WAITING_ROLE
     )
     
-    set_user_state(user.id, STATE_WAITING_ROLE)
-    
     bot.edit_message_text(
         "👤 **Paso 2: Tipo de Usuario**\n\n¿Qué tipo de usuario serás?",
         chat_id,
@@ -186,23 +185,10 @@ def handle_zona_selection(call):
         
     zona_id = int(call.data.split('_')[2])
     
-    # Actualizar usuario con zona y activar
+    # Actualizar usuario con zona y activarlo (una sola escritura parcial)
     user_data = get_user_by_telegram_id(user.id)
     if user_data:
-        set_user_registration_data(
-            telegram_id=user.id,
-            username=user.username,
-            name=user_data['nombre_completo'],
-            phone=user_data['telefono'],
-            user_type=user_data['tipo'],
-            pais_id=user_data['pais_id'],
-            provincia_id=user_data['provincia_id'],
-            zona_id=zona_id,
-            lang=user_data['idioma']
-        )
-        
-        # Activar usuario
-        set_user_state(user.id, STATE_ACTIVE)
+        upsert_user(user.id, username=user.username, zona_id=zona_id, estado=STATE_ACTIVE)
     
     # Mensaje de finalización
     bot.edit_message_text(
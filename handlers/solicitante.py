@@ -36,12 +36,14 @@ def perfil_solicitante_command(message):
         bot.send_message(chat_id, "❌ Primero completa tu registro con /start")
         return
     
-    from geography_db import get_geographic_level_name
-    
-    # Obtener nombres geográficos
-    pais_nombre = get_geographic_level_name('pais', user_data.get('pais_id'))
-    provincia_nombre = get_geographic_level_name('provincia', user_data.get('provincia_id'))
-    zona_nombre = get_geographic_level_name('zona', user_data.get('zona_id'))
+    from geography_db import get_geographic_names
+    
+    # Obtener nombres geográficos (una sola resolución para los tres niveles)
+    ids = {level: user_data.get(f'{level}_id') for level in ('pais', 'provincia', 'zona')}
+    names = get_geographic_names({level: [id_] for level, id_ in ids.items()})
+    pais_nombre, provincia_nombre, zona_nombre = (
+        names[level].get(id_, "N/A") for level, id_ in ids.items()
+    )
     
     msg = "👤 **Mi Perfil**\n\n"
     msg += f"**Nombre:** {user_data['nombre_completo']}\n"
@@ -1,78 +1,172 @@
 # handlers/solicitudes.py
-from bot_instance import bot
+import html
+from bot_instance import bot, user_states
 from config import logger, CATEGORIES
-from db import get_user_by_telegram_id
-import telebot
+from db import get_user_by_telegram_id, create_solicitud
+from digest import notify_new_solicitud
+from utils import get_message
+import keyboards
+
+# Pasos del flujo de nueva solicitud (en user_states)
+STEP_REQUEST_VEHICLE = 'solicitud_vehiculo'
+STEP_REQUEST_CARGO = 'solicitud_carga'
+STEP_REQUEST_DESCRIPTION = 'solicitud_descripcion'
+STEP_REQUEST_PICKUP = 'solicitud_recogida'
+STEP_REQUEST_DELIVERY = 'solicitud_entrega'
+STEP_REQUEST_BUDGET = 'solicitud_presupuesto'
+STEP_REQUEST_REVIEW = 'solicitud_revision'
+# Pasos que esperan texto
+REQUEST_TEXT_STEPS = (STEP_REQUEST_DESCRIPTION, STEP_REQUEST_PICKUP, STEP_REQUEST_DELIVERY, STEP_REQUEST_BUDGET)
+REQUEST_TEXT_MAX_LEN = 500
 
 @bot.message_handler(commands=['nueva_solicitud'])
 def nueva_solicitud_command(message):
     user = message.from_user
     chat_id = message.chat.id
-    
+
     user_data = get_user_by_telegram_id(user.id)
     if not user_data:
         bot.send_message(chat_id, "❌ Primero completa tu registro con /start")
         return
-    
+
     # Verificar que sea solicitante
     if user_data['tipo'] not in ['solicitante', 'ambos']:
-        bot.send_message(chat_id, "❌ Esta función es solo para solicitantes")
+        bot.send_message(chat_id, get_message('error_not_solicitante', user.id), parse_mode='Markdown')
         return
-    
-    msg = "📦 **NUEVA SOLICITUD**\n\n"
-    msg += "Vamos a crear una nueva solicitud de transporte.\n\n"
-    msg += "**Paso 1: Tipo de Vehículo**\n"
-    msg += "Selecciona el tipo de vehículo que necesitas:"
-    
-    # Usar teclado de tipos de vehículo
-    from keyboards import get_vehicle_type_keyboard
-    markup = get_vehicle_type_keyboard()
-    
-    bot.send_message(chat_id, msg, reply_markup=markup)
+
+    # La solicitud se publica en la zona de registro
+    if not user_data['zona_id']:
+        bot.send_message(chat_id, "❌ Tu perfil no tiene zona. Completa tu registro con /registro")
+        return
+
+    user_states[user.id] = {'step': STEP_REQUEST_VEHICLE, 'data': {}}
+    bot.send_message(chat_id, get_message('request_vehicle_type', user.id), reply_markup=keyboards.get_vehicle_type_keyboard())
+
+def _request_state(user_id, step):
+    """Datos del flujo si el usuario está en `step`; None si no (botón antiguo)."""
+    state = user_states.get(user_id)
+    if not state or state.get('step') != step:
+        return None
+    return state['data']
 
 # Handler para selección de tipo de vehículo
 @bot.callback_query_handler(func=lambda call: call.data.startswith('vehicle_'))
 def handle_vehicle_selection(call):
     user = call.from_user
-    chat_id = call.message.chat.id
-    
-    vehicle_type = call.data.split('_')[1]
-    
-    msg = "🚚 **Tipo de Vehículo Seleccionado**\n\n"
-    msg += f"Vehículo: {vehicle_type.title()}\n\n"
-    msg += "**Paso 2: Tipo de Carga**\n"
-    msg += "Selecciona el tipo de carga:"
-    
-    from keyboards import get_cargo_type_keyboard
-    markup = get_cargo_type_keyboard()
-    
+    data = _request_state(user.id, STEP_REQUEST_VEHICLE)
+    try:
+        vehicle_type = CATEGORIES['VEHICLE_TYPES'][int(call.data[len('vehicle_'):])]
+    except (ValueError, IndexError):
+        data = None
+    if data is None:
+        bot.answer_callback_query(call.id, "❌ Usa /nueva_solicitud para empezar de nuevo")
+        return
+
+    data['vehicle_type'] = vehicle_type
+    user_states[user.id]['step'] = STEP_REQUEST_CARGO
     bot.edit_message_text(
-        msg,
-        chat_id,
+        f"🚚 {html.escape(vehicle_type)}\n\n{get_message('request_cargo_type', user.id)}",
+        call.message.chat.id,
         call.message.message_id,
-        reply_markup=markup
+        reply_markup=keyboards.get_cargo_type_keyboard()
     )
+    bot.answer_callback_query(call.id)
 
 # Handler para selección de tipo de carga
 @bot.callback_query_handler(func=lambda call: call.data.startswith('cargo_'))
 def handle_cargo_selection(call):
     user = call.from_user
-    chat_id = call.message.chat.id
-    
-    cargo_type = call.data.split('_')[1]
-    
-    msg = "📦 **Tipo de Carga Seleccionado**\n\n"
-    msg += f"Carga: {cargo_type.replace('_', ' ').title()}\n\n"
-    msg += "**Paso 3: Descripción**\n"
-    msg += "Por favor, describe brevemente lo que necesitas transportar:\n"
-    msg += "(Ej: '2 cajas de ropa', '1 mueble de 2 metros', etc.)"
-    
-    # Aquí deberías guardar el estado FSM para esperar la descripción
-    # Por ahora solo mostramos el mensaje
+    data = _request_state(user.id, STEP_REQUEST_CARGO)
+    try:
+        cargo_type = CATEGORIES['CARGO_TYPES'][int(call.data[len('cargo_'):])]
+    except (ValueError, IndexError):
+        data = None
+    if data is None:
+        bot.answer_callback_query(call.id, "❌ Usa /nueva_solicitud para empezar de nuevo")
+        return
+
+    data['cargo_type'] = cargo_type
+    user_states[user.id]['step'] = STEP_REQUEST_DESCRIPTION
     bot.edit_message_text(
-        msg,
-        chat_id,
+        f"🚚 {html.escape(data['vehicle_type'])}\n📦 {html.escape(cargo_type)}\n\n{get_message('request_description', user.id)}",
+        call.message.chat.id,
         call.message.message_id
     )
-    
-    # En un flujo completo, aquí cambiarías el estado del usuario para esperar la descripción
\ No newline at end of file
+    bot.answer_callback_query(call.id)
+
+# Descripción, recogida, entrega y presupuesto. Los comandos no se toman como
+# respuesta: siguen a su propio handler
+@bot.message_handler(func=lambda message: user_states.get(message.from_user.id, {}).get('step') in REQUEST_TEXT_STEPS
+                     and not (message.text or '').startswith('/'))
+def handle_request_text_step(message):
+    user = message.from_user
+    state = user_states[user.id]
+    text = (message.text or '').strip()
+    if not text:
+        bot.reply_to(message, "❌ Escribe una respuesta en texto.")
+        return
+    if len(text) > REQUEST_TEXT_MAX_LEN:
+        bot.reply_to(message, f"❌ Máximo {REQUEST_TEXT_MAX_LEN} caracteres.")
+        return
+
+    step, data = state['step'], state['data']
+    if step == STEP_REQUEST_DESCRIPTION:
+        data['description'] = text
+        state['step'] = STEP_REQUEST_PICKUP
+        bot.send_message(message.chat.id, get_message('request_pickup_address', user.id), parse_mode='Markdown')
+    elif step == STEP_REQUEST_PICKUP:
+        data['pickup'] = text
+        state['step'] = STEP_REQUEST_DELIVERY
+        bot.send_message(message.chat.id, get_message('request_delivery_address', user.id), parse_mode='Markdown')
+    elif step == STEP_REQUEST_DELIVERY:
+        data['delivery'] = text
+        state['step'] = STEP_REQUEST_BUDGET
+        bot.send_message(message.chat.id, get_message('request_budget', user.id))
+    else:
+        try:
+            budget = float(text.split()[0].replace(',', '.'))
+            if budget < 0:
+                raise ValueError
+        except ValueError:
+            bot.reply_to(message, "❌ Escribe el presupuesto como un número (ej: 500).")
+            return
+        data['budget'] = budget
+        state['step'] = STEP_REQUEST_REVIEW
+        # Revisión en HTML (modo por defecto del bot); el texto libre se escapa
+        bot.send_message(message.chat.id, get_message(
+            'request_review', user.id,
+            vehicle=html.escape(data['vehicle_type']), cargo=html.escape(data['cargo_type']),
+            description=html.escape(data['description']), pickup=html.escape(data['pickup']),
+            delivery=html.escape(data['delivery']), budget=budget
+        ), reply_markup=keyboards.get_request_review_keyboard())
+
+@bot.callback_query_handler(func=lambda call: call.data in ['sol_publicar', 'sol_cancelar'])
+def handle_request_review(call):
+    user = call.from_user
+    data = _request_state(user.id, STEP_REQUEST_REVIEW)
+    if data is None:
+        bot.answer_callback_query(call.id, "❌ Usa /nueva_solicitud para empezar de nuevo")
+        return
+    user_states.pop(user.id, None)
+    bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
+
+    if call.data == 'sol_cancelar':
+        bot.answer_callback_query(call.id, "Solicitud cancelada")
+        return
+
+    solicitud = create_solicitud(
+        user.id, data['vehicle_type'], data['cargo_type'], data['description'],
+        data['pickup'], data['delivery'], data['budget']
+    )
+    if solicitud is None:
+        bot.answer_callback_query(call.id, "❌ Error al publicar la solicitud", show_alert=True)
+        return
+
+    bot.answer_callback_query(call.id)
+    bot.send_message(call.message.chat.id, get_message('request_published', user.id), parse_mode='Markdown')
+    try:
+        # Aviso inmediato o al resumen según el modo de cada transportista
+        direct, digest = notify_new_solicitud(solicitud, exclude=user.id)
+        logger.info(f"📦 Solicitud {solicitud['id']} publicada: {direct} avisos directos, {digest} en resumen")
+    except Exception as e:
+        logger.error(f"Error notificando la solicitud {solicitud['id']}: {e}")
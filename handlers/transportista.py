@@ -1,8 +1,30 @@
 # handlers/transportista.py
-from bot_instance import bot
-from config import logger
-from db import get_user_by_telegram_id
+import calendar
+import html
+import time
+from bot_instance import bot, user_states
+from config import logger, ROLE_TRANSPORTISTA, ROLE_AMBOS, STATE_BANNED, REQUEST_CONFIRM_MINUTES
+from db import (
+    get_user_by_telegram_id, get_requests_for_transportista, set_user_work_radius, get_solicitudes_by_ids,
+    claim_solicitud, get_work_zone_ids
+)
+from expirations import schedule_expiration, format_db_timestamp
+from outbound import send_bulk
+from utils import get_message
+from digest import set_digest_mode
+import geography_db
+from telebot.types import InlineQueryResultArticle, InputTextMessageContent, InlineKeyboardMarkup, InlineKeyboardButton
 import keyboards
+from presence import update_location
+from search import search_active_solicitudes, SEARCH_CACHE_TTL, SEARCH_RESULTS_LIMIT
+from ranking import rank_requests_for_transportista
+
+# Solicitudes por página en "Ver Solicitudes"
+SOLICITUDES_PAGE_SIZE = 5
+
+# Radio de trabajo máximo aceptado (km)
+WORK_RADIUS_MAX_KM = 500
+STEP_WORK_RADIUS = 'transportista_radio_km'
 
 # Implementación de la acción para el botón "Mis Vehículos"
 def mis_vehiculos_command(message):
@@ -49,6 +71,72 @@ def mis_zonas_command(message):
     else:
         bot.send_message(chat_id, "❌ Error al cargar el menú de zonas")
 
+# --- Paginación por cursor del listado de solicitudes ---
+# callback_data: "solpg_<n|p>_<creado_en en base36>_<id en base36>" (< 64 bytes)
+
+def _to_base36(number):
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    encoded = ""
+    while True:
+        number, remainder = divmod(number, 36)
+        encoded = digits[remainder] + encoded
+        if number == 0:
+            return encoded
+
+def encode_page_cursor(direction, solicitud):
+    """Codifica (creado_en, id) de una solicitud como callback_data compacto."""
+    timestamp = calendar.timegm(time.strptime(solicitud['creado_en'][:19], "%Y-%m-%d %H:%M:%S"))
+    return f"solpg_{direction[0]}_{_to_base36(timestamp)}_{_to_base36(solicitud['id'])}"
+
+def decode_page_cursor(data):
+    """Devuelve (direction, (creado_en, id)) a partir del callback_data."""
+    _, direction, timestamp, solicitud_id = data.split('_')
+    creado_en = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(int(timestamp, 36)))
+    return ('prev' if direction == 'p' else 'next'), (creado_en, int(solicitud_id, 36))
+
+def build_solicitudes_page(user_data, cursor=None, direction='next'):
+    """Texto y teclado de una página del listado de solicitudes del transportista."""
+    # Se pide una fila extra para saber si hay más en la dirección de avance
+    solicitudes = get_requests_for_transportista(
+        user_data, limit=SOLICITUDES_PAGE_SIZE + 1, cursor=cursor, direction=direction
+    )
+    has_more = len(solicitudes) > SOLICITUDES_PAGE_SIZE
+    if direction == 'prev' and cursor is not None:
+        solicitudes = solicitudes[-SOLICITUDES_PAGE_SIZE:]
+        has_prev, has_next = has_more, True
+    else:
+        solicitudes = solicitudes[:SOLICITUDES_PAGE_SIZE]
+        has_prev, has_next = cursor is not None, has_more
+
+    msg = "🔎 **Solicitudes Disponibles**\n\n"
+    if not solicitudes:
+        msg += "😔 No hay solicitudes activas en tus zonas de trabajo."
+        return msg, None
+
+    msg += "📦 **Solicitudes en tus zonas de trabajo:**\n\n"
+    for solicitud in solicitudes:
+        msg += f"• #{solicitud['id']} - {solicitud['cargo_type']}\n"
+
+    markup = keyboards.get_solicitudes_pagination_keyboard(
+        prev_data=encode_page_cursor('prev', solicitudes[0]) if has_prev else None,
+        next_data=encode_page_cursor('next', solicitudes[-1]) if has_next else None
+    )
+    return msg, markup
+
+def build_ranked_page(user_data):
+    """Texto y teclado de las mejores solicitudes para el transportista según el ranking."""
+    ranked = rank_requests_for_transportista(user_data, n=SOLICITUDES_PAGE_SIZE)
+    msg = "🔎 **Solicitudes Disponibles**\n\n"
+    if not ranked:
+        msg += "😔 No hay solicitudes activas en tus zonas de trabajo."
+        return msg, None
+
+    msg += "⭐ **Las más adecuadas para ti:**\n\n"
+    for _, solicitud in ranked:
+        presupuesto = f" - 💰 {solicitud['budget']:g}" if solicitud['budget'] else ""
+        msg += f"• #{solicitud['id']} - {solicitud['cargo_type']}{presupuesto}\n"
+    return msg, keyboards.get_ranked_solicitudes_keyboard()
+
 # Nueva función para el botón "Ver Solicitudes"
 def ver_solicitudes_command(message):
     user = message.from_user
@@ -64,22 +152,232 @@ def ver_solicitudes_command(message):
         bot.send_message(chat_id, "❌ Esta función es solo para transportistas")
         return
     
-    msg = "🔎 **Solicitudes Disponibles**\n\n"
-    msg += "Buscando solicitudes en tus zonas de trabajo...\n\n"
-    
-    from db import get_requests_for_transportista
-    solicitudes = get_requests_for_transportista(user_data)
-    
-    if solicitudes:
-        msg += f"📦 **Encontradas {len(solicitudes)} solicitudes:**\n\n"
-        for i, solicitud in enumerate(solicitudes[:5], 1):  # Mostrar máximo 5
-            msg += f"{i}. #{solicitud['id']} - {solicitud['cargo_type']}\n"
-        if len(solicitudes) > 5:
-            msg += f"\n... y {len(solicitudes) - 5} más"
+    msg, markup = build_ranked_page(user_data)
+    bot.send_message(chat_id, msg, reply_markup=markup)
+
+# "🕒 Ver todas por fecha": primera página del listado cronológico
+@bot.callback_query_handler(func=lambda call: call.data == 'solrk_fecha')
+def handle_solicitudes_chronological(call):
+    user_data = get_user_by_telegram_id(call.from_user.id)
+    if not user_data or user_data['tipo'] not in [ROLE_TRANSPORTISTA, ROLE_AMBOS]:
+        bot.answer_callback_query(call.id, "❌ Esta función es solo para transportistas")
+        return
+
+    msg, markup = build_solicitudes_page(user_data)
+    bot.edit_message_text(msg, call.message.chat.id, call.message.message_id, reply_markup=markup)
+    bot.answer_callback_query(call.id)
+
+# Navegación "◀ Anteriores" / "Siguientes ▶"
+@bot.callback_query_handler(func=lambda call: call.data.startswith('solpg_'))
+def handle_solicitudes_page(call):
+    user_data = get_user_by_telegram_id(call.from_user.id)
+    if not user_data or user_data['tipo'] not in [ROLE_TRANSPORTISTA, ROLE_AMBOS]:
+        bot.answer_callback_query(call.id, "❌ Esta función es solo para transportistas")
+        return
+
+    try:
+        direction, cursor = decode_page_cursor(call.data)
+    except ValueError:
+        bot.answer_callback_query(call.id, "❌ Página no válida.")
+        return
+
+    msg, markup = build_solicitudes_page(user_data, cursor, direction)
+    bot.edit_message_text(msg, call.message.chat.id, call.message.message_id, reply_markup=markup)
+    bot.answer_callback_query(call.id)
+
+# --- Radio de trabajo ---
+
+@bot.callback_query_handler(func=lambda call: call.data == 'filter_set_radius')
+def handle_set_radius(call):
+    user_data = get_user_by_telegram_id(call.from_user.id)
+    if not user_data or user_data['tipo'] not in [ROLE_TRANSPORTISTA, ROLE_AMBOS]:
+        bot.answer_callback_query(call.id, "❌ Esta función es solo para transportistas")
+        return
+
+    user_states[call.from_user.id] = {'step': STEP_WORK_RADIUS, 'data': {}}
+    bot.send_message(
+        call.message.chat.id,
+        "📏 *Radio de Trabajo*\n\n"
+        "Además de tus zonas, verás las solicitudes de las zonas a menos de esta distancia.\n"
+        f"Escribe los kilómetros (0 para desactivarlo, máximo {WORK_RADIUS_MAX_KM}).",
+        parse_mode='Markdown'
+    )
+    bot.answer_callback_query(call.id)
+
+# Los comandos no se toman como radio: siguen a su propio handler
+@bot.message_handler(func=lambda message: user_states.get(message.from_user.id, {}).get('step') == STEP_WORK_RADIUS
+                     and not (message.text or '').startswith('/'))
+def handle_radius_input(message):
+    user = message.from_user
+    try:
+        radio_km = float((message.text or '').strip().replace(',', '.'))
+        if not 0 <= radio_km <= WORK_RADIUS_MAX_KM:
+            raise ValueError
+    except ValueError:
+        bot.reply_to(message, f"❌ Escribe un número de kilómetros entre 0 y {WORK_RADIUS_MAX_KM}.")
+        return
+
+    user_states.pop(user.id, None)
+    if not set_user_work_radius(user.id, radio_km):
+        bot.reply_to(message, "❌ Error al guardar el radio de trabajo.")
+        return
+
+    if radio_km > 0:
+        bot.reply_to(message, f"✅ Radio de trabajo: {radio_km:g} km alrededor de tus zonas.")
     else:
-        msg += "😔 No hay solicitudes activas en tus zonas de trabajo."
-    
-    bot.send_message(chat_id, msg)
+        bot.reply_to(message, "✅ Radio de trabajo desactivado: solo verás tus zonas.")
+
+# --- Modo resumen ---
+
+@bot.callback_query_handler(func=lambda call: call.data == 'filter_toggle_digest')
+def handle_toggle_digest(call):
+    user_data = get_user_by_telegram_id(call.from_user.id)
+    if not user_data or user_data['tipo'] not in [ROLE_TRANSPORTISTA, ROLE_AMBOS]:
+        bot.answer_callback_query(call.id, "❌ Esta función es solo para transportistas")
+        return
+
+    enabled = not user_data['modo_resumen']
+    if not set_digest_mode(call.from_user.id, enabled):
+        bot.answer_callback_query(call.id, "❌ Error al guardar la preferencia")
+        return
+
+    bot.edit_message_reply_markup(
+        call.message.chat.id, call.message.message_id, reply_markup=keyboards.get_work_zones_menu(call.from_user.id)
+    )
+    if enabled:
+        bot.answer_callback_query(call.id, "📬 Recibirás un resumen agrupado de las nuevas solicitudes")
+    else:
+        bot.answer_callback_query(call.id, "🔔 Recibirás cada nueva solicitud al momento")
+
+# --- Detalle de una solicitud (botones 'sol_ver_<id>' de avisos y resúmenes) ---
+
+def format_solicitud_detail(solicitud):
+    """Ficha de una solicitud en HTML (modo por defecto del bot); el texto libre se escapa."""
+    msg = f"📦 <b>Solicitud #{solicitud['id']}</b>\n\n"
+    msg += f"📍 Zona: {html.escape(geography_db.get_geographic_level_name('zona', solicitud['zona_id']))}\n"
+    msg += f"🚚 Vehículo: {html.escape(solicitud['vehicle_type'] or '')}\n"
+    msg += f"📦 Carga: {html.escape(solicitud['cargo_type'] or '')}\n"
+    if solicitud['description']:
+        msg += f"📝 {html.escape(solicitud['description'])}\n"
+    if solicitud['pickup']:
+        msg += f"⬆️ Recogida: {html.escape(solicitud['pickup'])}\n"
+    if solicitud['delivery']:
+        msg += f"⬇️ Entrega: {html.escape(solicitud['delivery'])}\n"
+    if solicitud['budget']:
+        msg += f"💰 Presupuesto: {solicitud['budget']:g}\n"
+    return msg
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('sol_ver_'))
+def handle_ver_solicitud(call):
+    try:
+        solicitud_id = int(call.data[len('sol_ver_'):])
+    except ValueError:
+        bot.answer_callback_query(call.id)
+        return
+
+    solicitudes = get_solicitudes_by_ids([solicitud_id])
+    if not solicitudes or solicitudes[0]['estado'] != 'activa':
+        bot.answer_callback_query(call.id, "❌ Esta solicitud ya no está disponible")
+        return
+
+    markup = InlineKeyboardMarkup()
+    markup.add(InlineKeyboardButton("✅ Aceptar solicitud", callback_data=f"sol_aceptar_{solicitud_id}"))
+    bot.send_message(call.message.chat.id, format_solicitud_detail(solicitudes[0]), reply_markup=markup)
+    bot.answer_callback_query(call.id)
+
+# --- Aceptar una solicitud: gana el primer transportista, sin lectura previa ---
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('sol_aceptar_'))
+def handle_aceptar_solicitud(call):
+    user = call.from_user
+    user_data = get_user_by_telegram_id(user.id)
+    if not user_data or user_data['tipo'] not in [ROLE_TRANSPORTISTA, ROLE_AMBOS] or user_data['estado'] == STATE_BANNED:
+        bot.answer_callback_query(call.id, "❌ Esta función es solo para transportistas")
+        return
+
+    try:
+        solicitud_id = int(call.data[len('sol_aceptar_'):])
+    except ValueError:
+        bot.answer_callback_query(call.id)
+        return
+
+    # Zonas y capacidad se comprueban en la propia UPDATE: un botón reenviado o
+    # un callback fabricado no sirve para aceptar solicitudes que no vería
+    deadline = time.time() + REQUEST_CONFIRM_MINUTES * 60
+    claimed, solicitante_id = claim_solicitud(
+        solicitud_id, user.id, format_db_timestamp(deadline), get_work_zone_ids(user_data)
+    )
+    if not claimed:
+        bot.answer_callback_query(call.id, get_message('request_not_available', user.id), show_alert=True)
+        return
+
+    schedule_expiration(solicitud_id, deadline)
+    bot.answer_callback_query(call.id)
+    bot.send_message(user.id, get_message('confirmation_sent', user.id))
+    if solicitante_id is None:
+        # La asignación queda hecha y vence sola si nadie la confirma
+        logger.warning(f"⚠️ Solicitud {solicitud_id} asignada sin solicitante al que avisar")
+        return
+    try:
+        send_bulk(bot, solicitante_id, get_message(
+            'request_claimed_solicitante', solicitante_id,
+            name=html.escape(user_data['nombre_completo'] or ''), id=solicitud_id, minutes=REQUEST_CONFIRM_MINUTES
+        ), parse_mode='HTML')
+    except Exception as e:
+        logger.error(f"Error avisando al solicitante de la solicitud {solicitud_id}: {e}")
+
+# --- Búsqueda inline ("@bot colchón Habana") ---
+# answer_inline_query no pasa por la cola de salida: Telegram espera la respuesta
+
+@bot.inline_handler(func=lambda query: True)
+def handle_inline_search(query):
+    user_data = get_user_by_telegram_id(query.from_user.id)
+    if not user_data or user_data['tipo'] not in [ROLE_TRANSPORTISTA, ROLE_AMBOS]:
+        bot.answer_inline_query(query.id, [], cache_time=SEARCH_CACHE_TTL, is_personal=True)
+        return
+
+    try:
+        offset = int(query.offset or 0)
+    except ValueError:
+        offset = 0
+    solicitudes = search_active_solicitudes(query.query, offset)
+
+    results = []
+    for solicitud in solicitudes:
+        ruta = " → ".join(part for part in (solicitud['pickup'], solicitud['delivery']) if part)
+        presupuesto = f"💰 {solicitud['budget']:g}" if solicitud['budget'] else ""
+        results.append(InlineQueryResultArticle(
+            id=str(solicitud['id']),
+            title=f"#{solicitud['id']} - {solicitud['cargo_type']}",
+            description=" · ".join(part for part in (solicitud['description'], ruta, presupuesto) if part)[:200],
+            input_message_content=InputTextMessageContent(format_solicitud_detail(solicitud), parse_mode='HTML'),
+        ))
+
+    next_offset = str(offset + len(solicitudes)) if len(solicitudes) == SEARCH_RESULTS_LIMIT else ''
+    bot.answer_inline_query(query.id, results, cache_time=SEARCH_CACHE_TTL, next_offset=next_offset)
+
+# --- Ubicación en tiempo real ---
+# Las actualizaciones llegan como edited_message cada pocos segundos: solo
+# tocan el índice de presencia en memoria, nunca SQLite.
+
+def _location_expiry(message):
+    """Fin de la ubicación en tiempo real (epoch) o None si es una ubicación fija."""
+    live_period = getattr(message.location, 'live_period', None)
+    return message.date + live_period if live_period else None
+
+@bot.message_handler(content_types=['location'])
+def handle_location(message):
+    location = message.location
+    if update_location(message.from_user.id, location.latitude, location.longitude, _location_expiry(message)):
+        if getattr(location, 'live_period', None):
+            bot.reply_to(message, "📡 Ubicación en tiempo real activada: te avisaremos de solicitudes cercanas.")
+        else:
+            bot.reply_to(message, "📍 Ubicación recibida. Comparte tu ubicación en tiempo real para mantenerla al día.")
+
+@bot.edited_message_handler(content_types=['location'])
+def handle_live_location_update(message):
+    location = message.location
+    update_location(message.from_user.id, location.latitude, location.longitude, _location_expiry(message))
 
 # Comandos de Configuración Post-Registro
 @bot.message_handler(commands=['config_transportista'])
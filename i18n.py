@@ -0,0 +1,102 @@
+# i18n.py
+import json
+import os
+import re
+import string
+import threading
+from types import MappingProxyType
+from config import logger
+
+LOCALES_DIR = os.getenv('LOCALES_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'locales'))
+DEFAULT_LANGUAGE = 'es'
+LANGUAGE_CODE_RE = re.compile(r'^[a-z]{2,3}(_[A-Z]{2})?$')
+
+_catalogs = {}
+# Reentrante: cargar un idioma carga antes el de por defecto
+_catalogs_lock = threading.RLock()
+_formatter = string.Formatter()
+
+
+def _placeholders(template):
+    return {field for _, field, _, _ in _formatter.parse(template) if field is not None}
+
+
+def _read_locale(lang):
+    path = os.path.join(LOCALES_DIR, f"{lang}.json")
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    if not isinstance(data, dict):
+        raise ValueError(f"{path} debe contener un objeto JSON")
+    return data
+
+
+def _validate(lang, data, base):
+    """
+    Descarta las entradas inválidas de un catálogo: valores que no son texto,
+    plantillas mal formadas o con campos que el idioma base no proporciona.
+    """
+    valid = {}
+    for key, text in data.items():
+        if not isinstance(text, str) or not text:
+            logger.warning(f"⚠️ [{lang}] '{key}' vacío o no es texto; se usará '{DEFAULT_LANGUAGE}'")
+            continue
+        try:
+            fields = _placeholders(text)
+        except ValueError as e:
+            logger.warning(f"⚠️ [{lang}] '{key}' tiene un formato inválido ({e}); se usará '{DEFAULT_LANGUAGE}'")
+            continue
+        if base is not None:
+            if key not in base:
+                logger.warning(f"⚠️ [{lang}] clave desconocida '{key}' ignorada")
+                continue
+            extra = fields - _placeholders(base[key])
+            if extra:
+                logger.warning(f"⚠️ [{lang}] '{key}' usa campos desconocidos {sorted(extra)}; se usará '{DEFAULT_LANGUAGE}'")
+                continue
+        valid[key] = text
+    return valid
+
+
+def _load(lang):
+    base = None if lang == DEFAULT_LANGUAGE else get_catalog(DEFAULT_LANGUAGE)
+    try:
+        data = _validate(lang, _read_locale(lang), base)
+    except FileNotFoundError:
+        if base is None:
+            raise
+        logger.warning(f"⚠️ No existe el catálogo '{lang}'; se usará '{DEFAULT_LANGUAGE}'")
+        return base
+    except (OSError, ValueError) as e:
+        if base is None:
+            raise
+        logger.error(f"❌ Catálogo '{lang}' ilegible ({e}); se usará '{DEFAULT_LANGUAGE}'")
+        return base
+
+    if base is not None:
+        missing = base.keys() - data.keys()
+        if missing:
+            logger.info(f"🌐 [{lang}] {len(missing)} mensajes sin traducir usan '{DEFAULT_LANGUAGE}'")
+        # Fallback resuelto al cargar: renderizar es una sola búsqueda
+        data = {**base, **data}
+    logger.info(f"🌐 Catálogo '{lang}' cargado ({len(data)} mensajes)")
+    return MappingProxyType(data)
+
+
+def get_catalog(lang):
+    """Catálogo inmutable del idioma, cargado y validado en el primer uso."""
+    if not lang or not LANGUAGE_CODE_RE.match(lang):
+        lang = DEFAULT_LANGUAGE
+    catalog = _catalogs.get(lang)
+    if catalog is not None:
+        return catalog
+
+    with _catalogs_lock:
+        catalog = _catalogs.get(lang)
+        if catalog is None:
+            catalog = _load(lang)
+            _catalogs[lang] = catalog
+        return catalog
+
+
+def available_languages():
+    return sorted(name[:-5] for name in os.listdir(LOCALES_DIR) if name.endswith('.json'))
@@ -4,6 +4,7 @@ from telebot.types import (
     InlineKeyboardMarkup, InlineKeyboardButton,
     ReplyKeyboardRemove
 )
+from config import CATEGORIES
 import geography_db
 import db  # ✅ AÑADIR ESTA IMPORTACIÓN CRÍTICA
 
@@ -26,6 +27,15 @@ def get_work_zones_menu(user_id):
     
     # 1. Configurar capacidad de carga
     markup.add(InlineKeyboardButton("⚖️ Configurar Carga Máxima (Toneladas)", callback_data="filter_set_capacity"))
+
+    # 1b. Radio de trabajo: amplía las zonas elegidas a las cercanas
+    radio_km = (user_data['radio_trabajo_km'] if user_data else 0) or 0
+    radio_label = f"{radio_km:g} km" if radio_km > 0 else "desactivado"
+    markup.add(InlineKeyboardButton(f"📏 Radio de Trabajo ({radio_label})", callback_data="filter_set_radius"))
+
+    # 1c. Modo resumen: un mensaje agrupado en lugar de uno por solicitud
+    resumen = "activado" if user_data and user_data['modo_resumen'] else "desactivado"
+    markup.add(InlineKeyboardButton(f"📬 Modo Resumen ({resumen})", callback_data="filter_toggle_digest"))
     
     # 2. Seleccionar Países (para filtrar las solicitudes)
     countries = geography_db.get_available_countries_for_registration()
@@ -37,4 +47,46 @@ def get_work_zones_menu(user_id):
         markup.add(InlineKeyboardButton("❌ No hay países para seleccionar zonas", callback_data="filter_no_zones"))
     
     markup.add(InlineKeyboardButton("↩️ Volver al Menú Principal", callback_data="menu_back_main"))
-    return markup
\ No newline at end of file
+    return markup
+
+def get_solicitudes_pagination_keyboard(prev_data=None, next_data=None):
+    """Botones de navegación del listado de solicitudes (None oculta el botón)."""
+    buttons = []
+    if prev_data:
+        buttons.append(InlineKeyboardButton("◀ Anteriores", callback_data=prev_data))
+    if next_data:
+        buttons.append(InlineKeyboardButton("Siguientes ▶", callback_data=next_data))
+    if not buttons:
+        return None
+
+    markup = InlineKeyboardMarkup(row_width=2)
+    markup.row(*buttons)
+    return markup
+
+def get_ranked_solicitudes_keyboard():
+    """Acceso al listado cronológico completo desde las solicitudes recomendadas."""
+    markup = InlineKeyboardMarkup(row_width=1)
+    markup.add(InlineKeyboardButton("🕒 Ver todas por fecha", callback_data="solrk_fecha"))
+    return markup
+
+def get_vehicle_type_keyboard():
+    """Tipos de vehículo de una nueva solicitud ('vehicle_<índice>' en CATEGORIES)."""
+    markup = InlineKeyboardMarkup(row_width=1)
+    for i, vehicle_type in enumerate(CATEGORIES['VEHICLE_TYPES']):
+        markup.add(InlineKeyboardButton(vehicle_type, callback_data=f"vehicle_{i}"))
+    return markup
+
+def get_cargo_type_keyboard():
+    """Tipos de carga de una nueva solicitud ('cargo_<índice>' en CATEGORIES)."""
+    markup = InlineKeyboardMarkup(row_width=1)
+    for i, cargo_type in enumerate(CATEGORIES['CARGO_TYPES']):
+        markup.add(InlineKeyboardButton(cargo_type, callback_data=f"cargo_{i}"))
+    return markup
+
+def get_request_review_keyboard():
+    markup = InlineKeyboardMarkup(row_width=2)
+    markup.add(
+        InlineKeyboardButton("✅ Publicar", callback_data="sol_publicar"),
+        InlineKeyboardButton("❌ Cancelar", callback_data="sol_cancelar")
+    )
+    return markup
@@ -1,22 +1,29 @@
 # main.py
 import os
+import signal
+import sys
 import time
 from flask import Flask, request, abort 
 import telebot 
 from telebot.types import Update 
 
 from config import logger
-from db import init_db
+from db import init_db, flush_audit_log, close_pool
 from scheduler import init_scheduler
+from matching import init_matching
+from presence import init_presence
+from digest import init_digest
 from bot_instance import bot
+from outbound import install_outbound
 
 # --- Importar Handlers (Esto registra las funciones con el bot) ---
 import handlers.registro
-import handlers.general
 import handlers.solicitudes
 import handlers.transportista
 import handlers.solicitante
 import handlers.admin
+# Último: contiene el handler de texto genérico que captura cualquier mensaje
+import handlers.general
 
 # === CONFIGURACIÓN DE WEBHOOKS Y FLASK ===
 
@@ -62,6 +69,11 @@ def main_webhook():
         logger.error("❌ Error crítico con base de datos. Saliendo.")
         return
 
+    # Envíos con límite de Telegram (global y por chat) fuera del hilo del webhook
+    install_outbound(bot)
+    init_matching()
+    init_presence()
+    init_digest()
     init_scheduler()
 
     if KOYEB_URL:
@@ -74,11 +86,17 @@ def main_webhook():
             logger.error(f"❌ Fallo al configurar Webhook en Telegram.")
             return
 
+    # SIGTERM (parada del contenedor) sale limpiamente para ejecutar los atexit
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
     logger.info(f"🤖 Bot iniciado - Escuchando en 0.0.0.0:{PORT}...")
     try:
         app.run(host="0.0.0.0", port=PORT, debug=False) 
     except Exception as e:
         logger.error(f"❌ Error crítico al iniciar servidor Flask: {e}")
+    finally:
+        flush_audit_log()
+        close_pool()
 
 if __name__ == '__main__':
     main_webhook()
@@ -0,0 +1,201 @@
+# matching.py
+import bisect
+import threading
+from config import logger
+from db import add_user_change_listener, get_carrier_index_rows, get_carrier_profile, get_capacity_requirements
+from geography_db import get_zones_around
+
+# Transportistas sin vehículos registrados: capacidad desconocida, no se les filtra
+UNKNOWN_CAPACITY = float('inf')
+
+
+class CarrierIndex:
+    """
+    Índice invertido zona_id → {telegram_id} de los transportistas que pueden
+    recibir solicitudes (tipo transportista/ambos, no baneados).
+
+    Además mantiene por zona una lista ordenada (capacidad, telegram_id) con
+    la capacidad máxima de sus vehículos activos, de modo que "transportistas
+    de la zona Z que cargan ≥ X t" es un bisect y no un recorrido. El radio de
+    trabajo se guarda aparte y se aplica al consultar (carriers_within_radius):
+    así un cambio de centroides no deja el índice desfasado.
+
+    Se carga entero al arrancar y después se actualiza usuario a usuario con
+    refresh_user(), que db invoca tras cada cambio de rol, estado, zonas o
+    vehículos.
+    """
+
+    def __init__(self):
+        self._by_zone = {}
+        self._capacity_by_zone = {}
+        self._zones_by_user = {}
+        self._capacity_by_user = {}
+        self._radius_by_user = {}  # solo transportistas con radio > 0
+        self._lock = threading.Lock()
+        self.started = False
+        self.loaded = False
+
+    def load(self):
+        # El lock cubre también la lectura: un refresh concurrente se aplica
+        # después y nunca queda pisado por una foto más antigua
+        with self._lock:
+            self.started = True
+            rows = get_carrier_index_rows()
+            by_zone, zones_by_user, capacity_by_user, radius_by_user = {}, {}, {}, {}
+            for telegram_id, zona_id, capacidad, radio_km in rows:
+                by_zone.setdefault(zona_id, set()).add(telegram_id)
+                zones_by_user.setdefault(telegram_id, set()).add(zona_id)
+                capacity_by_user[telegram_id] = UNKNOWN_CAPACITY if capacidad is None else capacidad
+                if radio_km and radio_km > 0:
+                    radius_by_user[telegram_id] = radio_km
+            self._by_zone = by_zone
+            self._zones_by_user = {tid: frozenset(zonas) for tid, zonas in zones_by_user.items()}
+            self._capacity_by_user = capacity_by_user
+            self._radius_by_user = radius_by_user
+            self._capacity_by_zone = {
+                zona_id: sorted((capacity_by_user[tid], tid) for tid in members)
+                for zona_id, members in by_zone.items()
+            }
+            self.loaded = True
+        logger.info(f"✅ Índice de matching cargado: {len(zones_by_user)} transportistas en {len(by_zone)} zonas")
+
+    def set_user(self, telegram_id, zonas, capacidad=None, radio_km=0):
+        """Sustituye zonas, capacidad y radio del transportista (sin zonas = fuera del índice)."""
+        zonas = frozenset(zonas)
+        capacidad = UNKNOWN_CAPACITY if capacidad is None else capacidad
+        with self._lock:
+            previous = self._zones_by_user.pop(telegram_id, frozenset())
+            previous_capacity = self._capacity_by_user.pop(telegram_id, None)
+            self._radius_by_user.pop(telegram_id, None)
+
+            for zona_id in previous:
+                self._remove_capacity(zona_id, (previous_capacity, telegram_id))
+                if zona_id not in zonas:
+                    members = self._by_zone.get(zona_id)
+                    if members is not None:
+                        members.discard(telegram_id)
+                        if not members:
+                            del self._by_zone[zona_id]
+            for zona_id in zonas:
+                self._by_zone.setdefault(zona_id, set()).add(telegram_id)
+                bisect.insort(self._capacity_by_zone.setdefault(zona_id, []), (capacidad, telegram_id))
+
+            if zonas:
+                self._zones_by_user[telegram_id] = zonas
+                self._capacity_by_user[telegram_id] = capacidad
+                if radio_km and radio_km > 0:
+                    self._radius_by_user[telegram_id] = radio_km
+
+    def _remove_capacity(self, zona_id, entry):
+        entries = self._capacity_by_zone.get(zona_id)
+        if not entries:
+            return
+        i = bisect.bisect_left(entries, entry)
+        if i < len(entries) and entries[i] == entry:
+            del entries[i]
+        if not entries:
+            del self._capacity_by_zone[zona_id]
+
+    def carriers_in_zone(self, zona_id):
+        with self._lock:
+            return frozenset(self._by_zone.get(zona_id, ()))
+
+    def carriers_with_capacity(self, zona_id, min_toneladas):
+        """Transportistas de la zona cuya capacidad máxima es ≥ min_toneladas."""
+        with self._lock:
+            entries = self._capacity_by_zone.get(zona_id, ())
+            start = bisect.bisect_left(entries, (min_toneladas,))
+            return frozenset(tid for _, tid in entries[start:])
+
+    def max_radius(self):
+        with self._lock:
+            return max(self._radius_by_user.values(), default=0)
+
+    def carriers_within_radius(self, zones_around, min_toneladas=0):
+        """
+        Transportistas con capacidad ≥ min_toneladas que tienen alguna zona a
+        una distancia dentro de su radio. `zones_around` es {zona_id: km} desde
+        la zona de la solicitud (geography_db.get_zones_around).
+        """
+        with self._lock:
+            return frozenset(
+                tid
+                for zona_id, km in zones_around.items()
+                for tid in self._by_zone.get(zona_id, ())
+                if self._radius_by_user.get(tid, 0) >= km and self._capacity_by_user[tid] >= min_toneladas
+            )
+
+    def zones_of(self, telegram_id):
+        with self._lock:
+            return self._zones_by_user.get(telegram_id, frozenset())
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'carriers': len(self._zones_by_user), 'zones': len(self._by_zone),
+                'with_radius': len(self._radius_by_user),
+            }
+
+
+carrier_index = CarrierIndex()
+
+# Requisitos de capacidad (tabla pequeña y estática: se carga una vez)
+_requirements = None
+
+
+def required_capacity(vehicle_type, cargo_type):
+    """Toneladas mínimas para una solicitud: máximo de los requisitos que le aplican."""
+    global _requirements
+    if _requirements is None:
+        _requirements = get_capacity_requirements()
+    return max(
+        (_requirements.get((v, c), 0) for v in (vehicle_type, '*') for c in (cargo_type, '*')),
+        default=0
+    )
+
+
+def refresh_user(telegram_id):
+    """Relee de la BD la elegibilidad, zonas y capacidad de un usuario y actualiza el índice."""
+    if not carrier_index.started:
+        return
+    try:
+        zonas, capacidad, radio_km = get_carrier_profile(telegram_id)
+        carrier_index.set_user(telegram_id, zonas, capacidad, radio_km)
+    except Exception as e:
+        logger.error(f"Error actualizando el índice de matching para {telegram_id}: {e}")
+
+
+def get_candidate_carriers(solicitud, exclude=None):
+    """
+    Telegram IDs de los transportistas cuyas zonas de trabajo (ampliadas con
+    su radio, como en el feed) incluyen la zona de la solicitud y cuyo
+    vehículo más grande cumple el requisito de capacidad de su tipo de
+    vehículo/carga. `exclude` permite quitar al propio solicitante (usuarios
+    con rol 'ambos').
+    """
+    if not carrier_index.loaded:
+        init_matching()
+    min_toneladas = required_capacity(solicitud['vehicle_type'], solicitud['cargo_type'])
+    if min_toneladas > 0:
+        candidates = carrier_index.carriers_with_capacity(solicitud['zona_id'], min_toneladas)
+    else:
+        candidates = carrier_index.carriers_in_zone(solicitud['zona_id'])
+    max_radius = carrier_index.max_radius()
+    if max_radius > 0:
+        zones_around = get_zones_around(solicitud['zona_id'], max_radius)
+        candidates = candidates | carrier_index.carriers_within_radius(zones_around, min_toneladas)
+    if exclude is not None:
+        candidates = candidates - {exclude}
+    return candidates
+
+
+def init_matching():
+    global _requirements
+    try:
+        _requirements = get_capacity_requirements()
+        carrier_index.load()
+    except Exception as e:
+        logger.error(f"❌ Error cargando el índice de matching: {e}")
+
+
+add_user_change_listener(refresh_user)
@@ -0,0 +1,385 @@
+# migrations.py
+"""
+Migraciones versionadas del esquema.
+
+Cada migración es una función que recibe un cursor y se identifica por un
+número de versión creciente. Las versiones aplicadas quedan registradas en
+`schema_version`, así que init_db() solo ejecuta las pendientes y en orden.
+Cada migración y su fila de versión se aplican juntas dentro de un SAVEPOINT.
+Las migraciones deben ser idempotentes (IF NOT EXISTS, INSERT OR IGNORE...).
+"""
+from config import logger
+
+
+def _m001_transportista_zonas(cursor):
+    """Tabla muchos a muchos de zonas de trabajo, rellenada desde el JSON heredado."""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'transportista_zonas'")
+    work_zones_exist = cursor.fetchone() is not None
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS transportista_zonas (
+            usuario_id INTEGER NOT NULL,
+            zona_id INTEGER NOT NULL,
+            PRIMARY KEY (usuario_id, zona_id),
+            FOREIGN KEY(usuario_id) REFERENCES usuarios(id),
+            FOREIGN KEY(zona_id) REFERENCES zonas(id)
+        ) WITHOUT ROWID
+    ''')
+    # Índice inverso para "¿qué transportistas cubren la zona X?"
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transportista_zonas_zona ON transportista_zonas(zona_id, usuario_id)")
+
+    if not work_zones_exist:
+        cursor.execute('''
+            INSERT OR IGNORE INTO transportista_zonas (usuario_id, zona_id)
+            SELECT u.id, CAST(j.value AS INTEGER)
+            FROM usuarios u,
+                 json_each(CASE WHEN json_valid(u.zonas_trabajo_ids) THEN u.zonas_trabajo_ids ELSE '[]' END) j
+            WHERE j.value IS NOT NULL
+        ''')
+        logger.info(f"✅ Zonas de trabajo migradas a transportista_zonas: {cursor.rowcount} filas")
+
+
+def _m002_indices_secundarios(cursor):
+    """Índices para los filtros habituales de solicitudes, administradores y auditoría."""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_solicitudes_estado_zona_creado ON solicitudes(estado, zona_id, creado_en DESC)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_solicitudes_usuario ON solicitudes(usuario_id, creado_en DESC)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_administradores_usuario_estado ON administradores(usuario_id, estado)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_auditoria_timestamp ON auditoria(timestamp)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_vehiculos_usuario ON vehiculos(usuario_id, estado)")
+
+
+def _m003_indice_feed_solicitudes(cursor):
+    """Índice para la paginación por cursor (creado_en, id) del feed de transportistas."""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_solicitudes_feed ON solicitudes(estado, zona_id, creado_en DESC, id DESC)")
+    # Queda cubierto por el índice anterior
+    cursor.execute("DROP INDEX IF EXISTS idx_solicitudes_estado_zona_creado")
+
+
+def _m004_stats_counters(cursor):
+    """Contadores materializados del panel de administración, mantenidos por triggers."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            usuarios_total INTEGER NOT NULL DEFAULT 0,
+            usuarios_activos INTEGER NOT NULL DEFAULT 0,
+            solicitudes_total INTEGER NOT NULL DEFAULT 0,
+            solicitudes_activas INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO stats_counters (id) VALUES (1)")
+
+    # `IS` en lugar de `=` para que un estado NULL cuente como 0 y no como NULL
+    for tabla, activo, total_col, activos_col in (
+        ('usuarios', 'activo', 'usuarios_total', 'usuarios_activos'),
+        ('solicitudes', 'activa', 'solicitudes_total', 'solicitudes_activas'),
+    ):
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_stats_{tabla}_insert AFTER INSERT ON {tabla}
+            BEGIN
+                UPDATE stats_counters
+                SET {total_col} = {total_col} + 1,
+                    {activos_col} = {activos_col} + (NEW.estado IS '{activo}')
+                WHERE id = 1;
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_stats_{tabla}_delete AFTER DELETE ON {tabla}
+            BEGIN
+                UPDATE stats_counters
+                SET {total_col} = {total_col} - 1,
+                    {activos_col} = {activos_col} - (OLD.estado IS '{activo}')
+                WHERE id = 1;
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_stats_{tabla}_estado AFTER UPDATE OF estado ON {tabla}
+            WHEN OLD.estado IS NOT NEW.estado
+            BEGIN
+                UPDATE stats_counters
+                SET {activos_col} = {activos_col} + (NEW.estado IS '{activo}') - (OLD.estado IS '{activo}')
+                WHERE id = 1;
+            END
+        ''')
+
+    # Valores iniciales exactos a partir de los datos existentes
+    cursor.execute(STATS_COUNTERS_REBUILD_SQL)
+
+
+# Columnas de `solicitudes` copiadas a `solicitudes_archivo`
+SOLICITUDES_COLUMNS = (
+    'id', 'usuario_id', 'pais_id', 'provincia_id', 'zona_id', 'vehicle_type', 'cargo_type',
+    'description', 'pickup', 'delivery', 'budget', 'estado', 'transportista_asignado',
+    'pending_confirm_until', 'creado_en',
+)
+
+
+def _m005_solicitudes_archivo(cursor):
+    """Tabla de archivo para solicitudes finalizadas y antiguas."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS solicitudes_archivo (
+            id INTEGER PRIMARY KEY,
+            usuario_id INTEGER,
+            pais_id INTEGER,
+            provincia_id INTEGER,
+            zona_id INTEGER,
+            vehicle_type TEXT,
+            cargo_type TEXT,
+            description TEXT,
+            pickup TEXT,
+            delivery TEXT,
+            budget REAL,
+            estado TEXT,
+            transportista_asignado INTEGER,
+            pending_confirm_until TIMESTAMP,
+            creado_en TIMESTAMP,
+            archivado_en TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_solicitudes_archivo_usuario ON solicitudes_archivo(usuario_id, creado_en)")
+    # Selección de candidatas a archivar: estado final + antigüedad
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_solicitudes_estado_creado ON solicitudes(estado, creado_en)")
+
+
+def _m006_indice_confirmaciones(cursor):
+    """Índice parcial para reconstruir el planificador de expiraciones al arrancar."""
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_solicitudes_pending_confirm
+        ON solicitudes(pending_confirm_until)
+        WHERE estado = 'pendiente_confirmacion'
+    ''')
+
+
+# (nivel, tabla, nivel del padre, columna del padre) en orden descendente del árbol
+GEO_HIERARCHY = (
+    ('pais', 'paises', None, None),
+    ('provincia', 'provincias', 'pais', 'pais_id'),
+    ('zona', 'zonas', 'provincia', 'provincia_id'),
+)
+
+
+def _m007_geo_ancestros(cursor):
+    """
+    Closure table de la geografía: una fila por par (ancestro, nodo), incluido
+    el propio nodo con profundidad 0. Se mantiene con triggers al insertar.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS geo_ancestros (
+            ancestro_nivel TEXT NOT NULL,
+            ancestro_id INTEGER NOT NULL,
+            nodo_nivel TEXT NOT NULL,
+            nodo_id INTEGER NOT NULL,
+            profundidad INTEGER NOT NULL,
+            PRIMARY KEY (ancestro_nivel, ancestro_id, nodo_nivel, nodo_id)
+        ) WITHOUT ROWID
+    ''')
+    # Consultas hacia arriba ("¿está Z bajo A?", ruta de una zona)
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_geo_ancestros_nodo
+        ON geo_ancestros(nodo_nivel, nodo_id, ancestro_nivel, ancestro_id)
+    ''')
+
+    for nivel, tabla, padre_nivel, padre_col in GEO_HIERARCHY:
+        inherit_sql = f'''
+            INSERT OR IGNORE INTO geo_ancestros (ancestro_nivel, ancestro_id, nodo_nivel, nodo_id, profundidad)
+            SELECT a.ancestro_nivel, a.ancestro_id, '{nivel}', n.id, a.profundidad + 1
+            FROM {tabla} n
+            JOIN geo_ancestros a ON a.nodo_nivel = '{padre_nivel}' AND a.nodo_id = n.{padre_col}
+        ''' if padre_nivel else None
+
+        # Relleno de los nodos existentes (los padres ya están: se recorre de arriba abajo)
+        cursor.execute(f'''
+            INSERT OR IGNORE INTO geo_ancestros (ancestro_nivel, ancestro_id, nodo_nivel, nodo_id, profundidad)
+            SELECT '{nivel}', id, '{nivel}', id, 0 FROM {tabla}
+        ''')
+        if inherit_sql:
+            cursor.execute(inherit_sql)
+
+        trigger_inherit = f'''
+                INSERT OR IGNORE INTO geo_ancestros (ancestro_nivel, ancestro_id, nodo_nivel, nodo_id, profundidad)
+                SELECT ancestro_nivel, ancestro_id, '{nivel}', NEW.id, profundidad + 1
+                FROM geo_ancestros WHERE nodo_nivel = '{padre_nivel}' AND nodo_id = NEW.{padre_col};
+        ''' if padre_nivel else ''
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_geo_{tabla}_insert AFTER INSERT ON {tabla}
+            BEGIN
+                INSERT OR IGNORE INTO geo_ancestros (ancestro_nivel, ancestro_id, nodo_nivel, nodo_id, profundidad)
+                VALUES ('{nivel}', NEW.id, '{nivel}', NEW.id, 0);{trigger_inherit}
+            END
+        ''')
+
+
+# Toneladas mínimas que exige cada tipo de vehículo o de carga ('*' = cualquiera).
+# El requisito de una solicitud es el máximo de las filas que le aplican.
+CAPACITY_REQUIREMENTS_SEED = (
+    ('Moto/Bicicleta', '*', 0),
+    ('Auto/Camioneta', '*', 0.5),
+    ('Camión pequeño (hasta 2T)', '*', 1),
+    ('Camión grande (más de 2T)', '*', 2),
+    ('*', 'Mueble grande', 0.5),
+    ('*', 'Material de construcción', 1),
+)
+
+
+def _m008_requisitos_capacidad(cursor):
+    """Requisitos de capacidad por tipo de vehículo/carga e índice de capacidad de vehículos."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS requisitos_capacidad (
+            vehicle_type TEXT NOT NULL DEFAULT '*',
+            cargo_type TEXT NOT NULL DEFAULT '*',
+            min_toneladas REAL NOT NULL,
+            PRIMARY KEY (vehicle_type, cargo_type)
+        ) WITHOUT ROWID
+    ''')
+    cursor.executemany(
+        "INSERT OR IGNORE INTO requisitos_capacidad (vehicle_type, cargo_type, min_toneladas) VALUES (?, ?, ?)",
+        CAPACITY_REQUIREMENTS_SEED
+    )
+    # MAX(capacidad_toneladas) por transportista sale del propio índice
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_vehiculos_capacidad
+        ON vehiculos(usuario_id, estado, capacidad_toneladas)
+    ''')
+    cursor.execute("DROP INDEX IF EXISTS idx_vehiculos_usuario")
+
+
+def _add_column_if_missing(cursor, table, column, definition):
+    """ALTER TABLE ... ADD COLUMN idempotente (SQLite no admite IF NOT EXISTS)."""
+    cursor.execute(f"PRAGMA table_info({table})")
+    if column not in {row[1] for row in cursor.fetchall()}:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+def _m009_centroides_zonas(cursor):
+    """Centroide (lat/lon) de cada zona y radio de trabajo de los transportistas."""
+    _add_column_if_missing(cursor, 'zonas', 'lat', 'REAL')
+    _add_column_if_missing(cursor, 'zonas', 'lon', 'REAL')
+    # 0 = solo las zonas elegidas, sin ampliar por distancia
+    _add_column_if_missing(cursor, 'usuarios', 'radio_trabajo_km', 'REAL NOT NULL DEFAULT 0')
+
+
+def _m010_modo_resumen(cursor):
+    """Modo resumen de notificaciones y coincidencias pendientes de enviar en él."""
+    _add_column_if_missing(cursor, 'usuarios', 'modo_resumen', 'INTEGER NOT NULL DEFAULT 0')
+    # Copia duradera del buffer en memoria: se recupera al reiniciar
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS resumen_pendiente (
+            transportista_tid INTEGER NOT NULL,
+            solicitud_id INTEGER NOT NULL,
+            creado_en TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (transportista_tid, solicitud_id)
+        ) WITHOUT ROWID
+    ''')
+
+
+# Columnas de texto libre indexadas para la búsqueda
+SOLICITUDES_FTS_COLUMNS = ('description', 'pickup', 'delivery')
+
+
+def _m011_busqueda_solicitudes(cursor):
+    """
+    Índice FTS5 (external content sobre `solicitudes`) que solo contiene las
+    solicitudes activas: los triggers las añaden al pasar a 'activa' y las
+    quitan al salir de ese estado, así el índice no crece con el histórico.
+    """
+    columns = ', '.join(SOLICITUDES_FTS_COLUMNS)
+    old_values = ', '.join(f'OLD.{c}' for c in SOLICITUDES_FTS_COLUMNS)
+    new_values = ', '.join(f'NEW.{c}' for c in SOLICITUDES_FTS_COLUMNS)
+    cursor.execute(f'''
+        CREATE VIRTUAL TABLE IF NOT EXISTS solicitudes_fts USING fts5(
+            {columns},
+            content='solicitudes', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_solicitudes_fts_insert AFTER INSERT ON solicitudes
+        WHEN NEW.estado = 'activa'
+        BEGIN
+            INSERT INTO solicitudes_fts (rowid, {columns}) VALUES (NEW.id, {new_values});
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_solicitudes_fts_delete AFTER DELETE ON solicitudes
+        WHEN OLD.estado = 'activa'
+        BEGIN
+            INSERT INTO solicitudes_fts (solicitudes_fts, rowid, {columns}) VALUES ('delete', OLD.id, {old_values});
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_solicitudes_fts_update
+        AFTER UPDATE OF estado, {columns} ON solicitudes
+        WHEN OLD.estado = 'activa' OR NEW.estado = 'activa'
+        BEGIN
+            INSERT INTO solicitudes_fts (solicitudes_fts, rowid, {columns})
+            SELECT 'delete', OLD.id, {old_values} WHERE OLD.estado = 'activa';
+            INSERT INTO solicitudes_fts (rowid, {columns})
+            SELECT NEW.id, {new_values} WHERE NEW.estado = 'activa';
+        END
+    ''')
+    # Carga inicial reejecutable: se vacía el índice antes de rellenarlo. No se
+    # usa 'rebuild' porque indexaría también las solicitudes no activas
+    cursor.execute("INSERT INTO solicitudes_fts (solicitudes_fts) VALUES ('delete-all')")
+    cursor.execute(f'''
+        INSERT INTO solicitudes_fts (rowid, {columns})
+        SELECT id, {columns} FROM solicitudes WHERE estado = 'activa'
+    ''')
+
+
+# Recalcula los contadores con COUNT(*) (migración y comando de verificación)
+STATS_COUNTERS_REBUILD_SQL = '''
+    UPDATE stats_counters SET
+        usuarios_total = (SELECT COUNT(*) FROM usuarios),
+        usuarios_activos = (SELECT COUNT(*) FROM usuarios WHERE estado = 'activo'),
+        solicitudes_total = (SELECT COUNT(*) FROM solicitudes),
+        solicitudes_activas = (SELECT COUNT(*) FROM solicitudes WHERE estado = 'activa')
+    WHERE id = 1
+'''
+
+
+# (versión, nombre, función) — añadir siempre al final con una versión nueva
+MIGRATIONS = [
+    (1, 'transportista_zonas', _m001_transportista_zonas),
+    (2, 'indices_secundarios', _m002_indices_secundarios),
+    (3, 'indice_feed_solicitudes', _m003_indice_feed_solicitudes),
+    (4, 'stats_counters', _m004_stats_counters),
+    (5, 'solicitudes_archivo', _m005_solicitudes_archivo),
+    (6, 'indice_confirmaciones', _m006_indice_confirmaciones),
+    (7, 'geo_ancestros', _m007_geo_ancestros),
+    (8, 'requisitos_capacidad', _m008_requisitos_capacidad),
+    (9, 'centroides_zonas', _m009_centroides_zonas),
+    (10, 'modo_resumen', _m010_modo_resumen),
+    (11, 'busqueda_solicitudes', _m011_busqueda_solicitudes),
+]
+
+
+def apply_migrations(cursor):
+    """Aplica en orden las migraciones pendientes y devuelve cuántas se ejecutaron."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            nombre TEXT,
+            aplicada_en TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute("SELECT version FROM schema_version")
+    applied = {row[0] for row in cursor.fetchall()}
+
+    pending = [m for m in sorted(MIGRATIONS) if m[0] not in applied]
+    for version, name, migrate in pending:
+        # sqlite3 no abre transacción antes del DDL: sin SAVEPOINT explícito una
+        # migración interrumpida dejaría el esquema a medias y sin versión
+        cursor.execute("SAVEPOINT migracion")
+        try:
+            migrate(cursor)
+            cursor.execute("INSERT INTO schema_version (version, nombre) VALUES (?, ?)", (version, name))
+        except Exception as e:
+            cursor.execute("ROLLBACK TO migracion")
+            cursor.execute("RELEASE migracion")
+            logger.error(f"❌ Migración {version:03d} ({name}) revertida: {e}")
+            raise
+        cursor.execute("RELEASE migracion")
+        logger.info(f"✅ Migración {version:03d} aplicada: {name}")
+
+    if pending:
+        # Actualizar estadísticas del planificador tras crear índices
+        cursor.execute("ANALYZE")
+    return len(pending)
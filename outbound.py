@@ -0,0 +1,326 @@
+# outbound.py
+import atexit
+import heapq
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from telebot.apihelper import ApiTelegramException
+from config import logger
+
+# Límites de Telegram: ~30 mensajes/s en total y ~1/s sostenido por chat
+OUTBOUND_GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', 30))
+OUTBOUND_CHAT_RATE = float(os.getenv('OUTBOUND_CHAT_RATE', 1))
+OUTBOUND_CHAT_BURST = float(os.getenv('OUTBOUND_CHAT_BURST', 3))
+OUTBOUND_WORKERS = int(os.getenv('OUTBOUND_WORKERS', 4))
+OUTBOUND_MAX_RETRIES = int(os.getenv('OUTBOUND_MAX_RETRIES', 5))
+OUTBOUND_MAX_QUEUE = int(os.getenv('OUTBOUND_MAX_QUEUE', 10000))
+
+# Carriles por prioridad: las respuestas interactivas adelantan a las notificaciones masivas
+LANE_INTERACTIVE = 'interactive'
+LANE_BULK = 'bulk'
+LANES = (LANE_INTERACTIVE, LANE_BULK)
+
+# Métodos del bot que pasan por el despachador → posición de chat_id en sus argumentos
+WRAPPED_METHODS = {'send_message': 0, 'edit_message_text': 1}
+
+
+def _chat_of(method, args, kwargs):
+    position = WRAPPED_METHODS[method]
+    return args[position] if len(args) > position else kwargs.get('chat_id')
+
+
+class TokenBucket:
+    """Cubo de tokens thread-safe: `rate` tokens/s hasta un máximo de `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        """Consume un token; devuelve 0 si lo había o los segundos hasta el siguiente."""
+        with self._lock:
+            now = time.monotonic()
+            # `_updated` queda en el futuro mientras dura una pausa: no se repone nada
+            if now >= self._updated:
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return 0
+            return self._updated - now + max(0, 1 - self._tokens) / self.rate
+
+    def pause(self, seconds):
+        """Vacía el cubo y no repone tokens durante `seconds` (p. ej. tras un 429)."""
+        with self._lock:
+            until = time.monotonic() + seconds
+            if until > self._updated:
+                self._tokens = 0
+                self._updated = until
+
+    def refund(self):
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + 1)
+
+    def is_idle(self, now):
+        with self._lock:
+            return self._tokens + (now - self._updated) * self.rate >= self.capacity
+
+
+class _Job:
+    __slots__ = ('seq', 'lane', 'method', 'chat_id', 'args', 'kwargs', 'future', 'enqueued_at', 'attempts')
+
+    def __init__(self, seq, lane, method, args, kwargs):
+        self.seq = seq
+        self.lane = lane
+        self.method = method
+        self.chat_id = _chat_of(method, args, kwargs)
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+
+
+class OutboundDispatcher:
+    """
+    Cola de envíos a Telegram con límite global y por chat.
+
+    Los handlers encolan y vuelven enseguida; un pool de hilos envía
+    respetando un token bucket global y uno por chat. Un trabajo sin token se
+    aparca hasta que puede salir sin bloquear al resto de chats; su chat sigue
+    ocupado mientras tanto, así que nada lo adelanta. Un 429 además pausa el
+    cubo global durante `retry_after`. Dentro de cada carril se conserva el
+    orden de llegada, y el carril interactivo siempre se atiende antes que el masivo.
+    """
+
+    def __init__(self, methods, workers=OUTBOUND_WORKERS, global_rate=OUTBOUND_GLOBAL_RATE,
+                 chat_rate=OUTBOUND_CHAT_RATE, chat_burst=OUTBOUND_CHAT_BURST,
+                 max_retries=OUTBOUND_MAX_RETRIES, max_queue=OUTBOUND_MAX_QUEUE):
+        self._methods = methods
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_queue = max_queue
+
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets = {}
+        self._buckets_lock = threading.Lock()
+
+        self._cond = threading.Condition()
+        self._ready = {lane: [] for lane in LANES}  # heap (seq, job) por carril
+        self._delayed = []                          # heap (ready_at, seq, job)
+        self._seq = itertools.count()
+        self._in_flight = 0
+        self._busy_chats = set()                    # chats con un envío en curso o aparcado: conserva el orden
+        self._stopping = False
+        self._threads = []
+
+        self.stats = {'enqueued': 0, 'sent': 0, 'failed': 0, 'retried': 0, 'rate_limited': 0, 'dropped': 0}
+        self._latencies = deque(maxlen=1000)
+
+    # --- API ---
+
+    def start(self):
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"outbound-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        atexit.register(self.stop)
+        logger.info(f"✅ Despachador de salida iniciado ({self.workers} hilos)")
+
+    def submit(self, method, *args, lane=LANE_INTERACTIVE, **kwargs):
+        """Encola `bot.<method>(*args, **kwargs)`; devuelve un Future con el resultado."""
+        with self._cond:
+            job = _Job(next(self._seq), lane, method, args, kwargs)
+            if lane == LANE_BULK and self._queued() >= self.max_queue:
+                self.stats['dropped'] += 1
+                job.future.set_exception(RuntimeError("Cola de salida llena"))
+                return job.future
+            heapq.heappush(self._ready[lane], (job.seq, job))
+            self.stats['enqueued'] += 1
+            self._cond.notify()
+        return job.future
+
+    def stop(self, timeout=5):
+        """Espera (hasta `timeout`) a que se vacíe la cola y detiene los hilos."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while (self._queued() or self._in_flight) and time.monotonic() < deadline:
+                self._cond.wait(0.1)
+            self._stopping = True
+            self._cond.notify_all()
+
+    def get_stats(self):
+        with self._cond:
+            stats = dict(self.stats)
+            stats.update({f'queued_{lane}': len(self._ready[lane]) for lane in LANES})
+            stats['delayed'] = len(self._delayed)
+            stats['in_flight'] = self._in_flight
+            latencies = sorted(self._latencies)
+        if latencies:
+            stats['latency_p50_ms'] = round(latencies[len(latencies) // 2] * 1000, 1)
+            stats['latency_p95_ms'] = round(latencies[int(len(latencies) * 0.95) - 1 or 0] * 1000, 1)
+        return stats
+
+    # --- Planificación ---
+
+    def _queued(self):
+        return sum(len(heap) for heap in self._ready.values()) + len(self._delayed)
+
+    def _release(self, job):
+        """Libera el chat del trabajo (llamar con `_cond` adquirido)."""
+        self._in_flight -= 1
+        self._busy_chats.discard(job.chat_id)
+        self._cond.notify_all()
+
+    def _defer(self, job, delay):
+        """Aparca el trabajo `delay` segundos; su chat sigue ocupado hasta que se reanude."""
+        with self._cond:
+            heapq.heappush(self._delayed, (time.monotonic() + delay, job.seq, job))
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def _pop_ready(self, lane):
+        """Saca el trabajo más antiguo del carril cuyo chat no tenga un envío en curso."""
+        heap = self._ready[lane]
+        skipped = []
+        job = None
+        while heap:
+            seq, candidate = heapq.heappop(heap)
+            if candidate.chat_id is not None and candidate.chat_id in self._busy_chats:
+                skipped.append((seq, candidate))
+                continue
+            job = candidate
+            break
+        for item in skipped:
+            heapq.heappush(heap, item)
+        return job
+
+    def _take(self):
+        with self._cond:
+            while not self._stopping:
+                now = time.monotonic()
+                while self._delayed and self._delayed[0][0] <= now:
+                    _, seq, job = heapq.heappop(self._delayed)
+                    # Es el trabajo más antiguo de su chat en el carril: sale antes que los siguientes
+                    self._busy_chats.discard(job.chat_id)
+                    heapq.heappush(self._ready[job.lane], (seq, job))
+                for lane in LANES:
+                    job = self._pop_ready(lane)
+                    if job is not None:
+                        self._in_flight += 1
+                        if job.chat_id is not None:
+                            self._busy_chats.add(job.chat_id)
+                        return job
+                self._cond.wait(self._delayed[0][0] - now if self._delayed else None)
+            return None
+
+    def _chat_bucket(self, chat_id):
+        with self._buckets_lock:
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is None:
+                if len(self._chat_buckets) > 10000:
+                    now = time.monotonic()
+                    self._chat_buckets = {k: b for k, b in self._chat_buckets.items() if not b.is_idle(now)}
+                bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            return bucket
+
+    def _run(self):
+        while True:
+            job = self._take()
+            if job is None:
+                return
+
+            wait = self._global_bucket.try_acquire()
+            if wait:
+                self._defer(job, wait)
+                continue
+            # Ediciones de mensajes inline (sin chat) solo cuentan para el límite global
+            wait = self._chat_bucket(job.chat_id).try_acquire() if job.chat_id is not None else 0
+            if wait:
+                self._global_bucket.refund()
+                self._defer(job, wait)
+                continue
+
+            self._send(job)
+
+    def _send(self, job):
+        job.attempts += 1
+        try:
+            result = self._methods[job.method](*job.args, **job.kwargs)
+        except ApiTelegramException as e:
+            if e.error_code == 429 and job.attempts <= self.max_retries:
+                retry_after = ((e.result_json or {}).get('parameters') or {}).get('retry_after', 1)
+                logger.warning(f"⏳ Telegram pidió esperar {retry_after}s (chat {job.chat_id})")
+                with self._cond:
+                    self.stats['rate_limited'] += 1
+                # El límite es de todo el bot: no se envía a ningún chat durante la espera
+                self._global_bucket.pause(retry_after)
+                self._defer(job, retry_after)
+                return
+            self._fail(job, e)
+            return
+        except Exception as e:
+            # Errores de red: reintento con espera exponencial
+            if job.attempts <= self.max_retries:
+                with self._cond:
+                    self.stats['retried'] += 1
+                self._defer(job, min(2 ** (job.attempts - 1), 30))
+                return
+            self._fail(job, e)
+            return
+
+        with self._cond:
+            self.stats['sent'] += 1
+            self._latencies.append(time.monotonic() - job.enqueued_at)
+            self._release(job)
+        job.future.set_result(result)
+
+    def _fail(self, job, error):
+        logger.error(f"❌ Error enviando {job.method} al chat {job.chat_id}: {error}")
+        with self._cond:
+            self.stats['failed'] += 1
+            self._release(job)
+        job.future.set_exception(error)
+
+
+_dispatcher = None
+
+
+def install_outbound(bot):
+    """
+    Sustituye bot.send_message y bot.edit_message_text (y con ellos reply_to)
+    por versiones que encolan en el carril interactivo y devuelven un Future.
+    """
+    global _dispatcher
+    if _dispatcher is not None:
+        return _dispatcher
+
+    dispatcher = OutboundDispatcher({name: getattr(bot, name) for name in WRAPPED_METHODS})
+    for name in WRAPPED_METHODS:
+        def enqueue(*args, _method=name, **kwargs):
+            return dispatcher.submit(_method, *args, **kwargs)
+        setattr(bot, name, enqueue)
+    dispatcher.start()
+    _dispatcher = dispatcher
+    return dispatcher
+
+
+def send_bulk(bot, chat_id, text, **kwargs):
+    """Notificación masiva: carril de baja prioridad si el despachador está activo."""
+    if _dispatcher is None:
+        return bot.send_message(chat_id, text, **kwargs)
+    return _dispatcher.submit('send_message', chat_id, text, lane=LANE_BULK, **kwargs)
+
+
+def get_outbound_stats():
+    return _dispatcher.get_stats() if _dispatcher is not None else {}
@@ -0,0 +1,254 @@
+# presence.py
+import atexit
+import heapq
+import json
+import math
+import os
+import threading
+import time
+from config import logger
+from db import add_user_change_listener
+from matching import carrier_index
+
+# Lado de cada celda de la rejilla en grados (~5,5 km de latitud)
+PRESENCE_CELL_DEG = float(os.getenv('PRESENCE_CELL_DEG', 0.05))
+# Validez de una posición sin actualizar (la ubicación en tiempo real se reenvía cada pocos segundos)
+PRESENCE_TTL = float(os.getenv('PRESENCE_TTL', 900))
+# Distancia máxima de búsqueda de transportistas cercanos
+PRESENCE_MAX_KM = float(os.getenv('PRESENCE_MAX_KM', 50))
+PRESENCE_SNAPSHOT_FILE = os.getenv('PRESENCE_SNAPSHOT_FILE', 'presence_snapshot.json')
+PRESENCE_SNAPSHOT_INTERVAL = float(os.getenv('PRESENCE_SNAPSHOT_INTERVAL', 60))
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEG = math.pi * EARTH_RADIUS_KM / 180
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(1.0, a)))
+
+
+class PresenceIndex:
+    """
+    Última posición conocida de cada transportista, solo en memoria.
+
+    Las posiciones se agrupan en una rejilla uniforme de celdas de
+    `cell_deg` grados; los k más cercanos a un punto se buscan recorriendo
+    anillos de celdas alrededor del suyo hasta que ningún anillo pendiente
+    puede mejorar el k-ésimo. Cada posición caduca a los `ttl` segundos (o
+    al terminar su ubicación en tiempo real) y las caducadas se descartan al
+    consultarlas y en cada barrido.
+    """
+
+    def __init__(self, cell_deg=PRESENCE_CELL_DEG, ttl=PRESENCE_TTL):
+        self.cell_deg = cell_deg
+        self.ttl = ttl
+        self._cells = {}      # (fila, columna) -> {telegram_id}
+        self._positions = {}  # telegram_id -> (lat, lon, expira_en, celda)
+        self._lock = threading.Lock()
+        self.stats = {'updates': 0, 'queries': 0, 'expired': 0}
+
+    def _cell(self, lat, lon):
+        return math.floor(lat / self.cell_deg), math.floor(lon / self.cell_deg)
+
+    def update(self, telegram_id, lat, lon, expires_at=None):
+        """Registra la posición; `expires_at` (epoch) acorta el TTL por defecto."""
+        now = time.time()
+        expires_at = min(now + self.ttl, expires_at or float('inf'))
+        if expires_at <= now:
+            self.remove(telegram_id)
+            return
+        cell = self._cell(lat, lon)
+        with self._lock:
+            previous = self._positions.get(telegram_id)
+            if previous is not None and previous[3] != cell:
+                self._discard_from_cell(telegram_id, previous[3])
+            self._cells.setdefault(cell, set()).add(telegram_id)
+            self._positions[telegram_id] = (lat, lon, expires_at, cell)
+            self.stats['updates'] += 1
+
+    def remove(self, telegram_id):
+        with self._lock:
+            previous = self._positions.pop(telegram_id, None)
+            if previous is not None:
+                self._discard_from_cell(telegram_id, previous[3])
+
+    def _discard_from_cell(self, telegram_id, cell):
+        members = self._cells.get(cell)
+        if members is not None:
+            members.discard(telegram_id)
+            if not members:
+                del self._cells[cell]
+
+    def _ring(self, center, radius):
+        """Celdas a distancia de Chebyshev exactamente `radius` de `center`."""
+        row, col = center
+        if radius == 0:
+            yield center
+            return
+        for dc in range(-radius, radius + 1):
+            yield row - radius, col + dc
+            yield row + radius, col + dc
+        for dr in range(-radius + 1, radius):
+            yield row + dr, col - radius
+            yield row + dr, col + radius
+
+    def nearest(self, lat, lon, k, max_km=PRESENCE_MAX_KM, eligible=None):
+        """
+        Hasta `k` pares (distancia_km, telegram_id) más cercanos a (lat, lon),
+        a ≤ max_km y que cumplan `eligible(telegram_id)` si se da.
+        """
+        now = time.time()
+        center = self._cell(lat, lon)
+        # Lado mínimo de celda en km dentro del área de búsqueda (los meridianos convergen)
+        max_lat = min(89.0, abs(lat) + max_km / KM_PER_DEG)
+        cell_km = self.cell_deg * KM_PER_DEG * math.cos(math.radians(max_lat))
+        max_ring = int(max_km / cell_km) + 1 if cell_km > 0 else 0
+
+        best = []  # max-heap de los k mejores: (-distancia, telegram_id)
+        expired = []
+        with self._lock:
+            self.stats['queries'] += 1
+            for radius in range(max_ring + 1):
+                # Un punto del anillo r está al menos a (r - 1) celdas completas
+                if (radius - 1) * cell_km > max_km:
+                    break
+                if len(best) == k and (radius - 1) * cell_km > -best[0][0]:
+                    break
+                for cell in self._ring(center, radius):
+                    for telegram_id in self._cells.get(cell, ()):
+                        p_lat, p_lon, expires_at, _ = self._positions[telegram_id]
+                        if expires_at <= now:
+                            expired.append(telegram_id)
+                            continue
+                        if eligible is not None and not eligible(telegram_id):
+                            continue
+                        distance = haversine_km(lat, lon, p_lat, p_lon)
+                        if distance > max_km:
+                            continue
+                        if len(best) < k:
+                            heapq.heappush(best, (-distance, telegram_id))
+                        elif distance < -best[0][0]:
+                            heapq.heapreplace(best, (-distance, telegram_id))
+            for telegram_id in expired:
+                self._discard_from_cell(telegram_id, self._positions.pop(telegram_id)[3])
+            self.stats['expired'] += len(expired)
+
+        return sorted((-d, telegram_id) for d, telegram_id in best)
+
+    def sweep(self):
+        """Elimina las posiciones caducadas; devuelve cuántas."""
+        now = time.time()
+        with self._lock:
+            expired = [tid for tid, (_, _, expires_at, _) in self._positions.items() if expires_at <= now]
+            for telegram_id in expired:
+                self._discard_from_cell(telegram_id, self._positions.pop(telegram_id)[3])
+            self.stats['expired'] += len(expired)
+        return len(expired)
+
+    def dump(self):
+        with self._lock:
+            return [[tid, lat, lon, expires_at] for tid, (lat, lon, expires_at, _) in self._positions.items()]
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['carriers'] = len(self._positions)
+            stats['cells'] = len(self._cells)
+        return stats
+
+
+presence_index = PresenceIndex()
+_snapshot_thread = None
+
+
+def save_snapshot(path=PRESENCE_SNAPSHOT_FILE):
+    """Vuelca las posiciones vigentes a disco (escritura atómica)."""
+    try:
+        entries = presence_index.dump()
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, path)
+        return len(entries)
+    except Exception as e:
+        logger.error(f"❌ Error guardando el snapshot de presencia: {e}")
+        return 0
+
+
+def load_snapshot(path=PRESENCE_SNAPSHOT_FILE):
+    """Recupera las posiciones no caducadas del último snapshot."""
+    try:
+        with open(path, encoding='utf-8') as f:
+            entries = json.load(f)
+    except FileNotFoundError:
+        return 0
+    except (OSError, ValueError) as e:
+        logger.warning(f"⚠️ Snapshot de presencia ilegible ({e}); se empieza vacío")
+        return 0
+
+    now = time.time()
+    loaded = 0
+    for telegram_id, lat, lon, expires_at in entries:
+        if expires_at > now:
+            presence_index.update(telegram_id, lat, lon, expires_at)
+            loaded += 1
+    return loaded
+
+
+def is_known_carrier(telegram_id):
+    """Solo los transportistas del índice de matching tienen presencia."""
+    return bool(carrier_index.zones_of(telegram_id))
+
+
+def update_location(telegram_id, lat, lon, expires_at=None):
+    """Registra una posición en memoria; devuelve False si el usuario no es transportista."""
+    if not is_known_carrier(telegram_id):
+        return False
+    presence_index.update(telegram_id, lat, lon, expires_at)
+    return True
+
+
+def get_nearest_carriers(lat, lon, k=10, max_km=PRESENCE_MAX_KM, exclude=None):
+    """Los k transportistas disponibles más cercanos: [(distancia_km, telegram_id)]."""
+    def eligible(telegram_id):
+        return telegram_id != exclude and is_known_carrier(telegram_id)
+    return presence_index.nearest(lat, lon, k, max_km, eligible)
+
+
+def get_nearest_carriers_for_zone(zona_id, k=10, max_km=PRESENCE_MAX_KM, exclude=None):
+    """Igual que get_nearest_carriers, desde el centroide de la zona (vacío si no tiene)."""
+    from geography_db import get_geography_snapshot
+
+    zona = get_geography_snapshot().by_id['zona'].get(zona_id)
+    if zona is None or zona['lat'] is None or zona['lon'] is None:
+        return []
+    return get_nearest_carriers(zona['lat'], zona['lon'], k, max_km, exclude)
+
+
+def _forget_if_not_carrier(telegram_id):
+    # Se registra después del de matching: el índice ya refleja el cambio
+    if not is_known_carrier(telegram_id):
+        presence_index.remove(telegram_id)
+
+
+def init_presence():
+    global _snapshot_thread
+    if _snapshot_thread is not None:
+        return
+    loaded = load_snapshot()
+
+    def run_snapshots():
+        while True:
+            time.sleep(PRESENCE_SNAPSHOT_INTERVAL)
+            presence_index.sweep()
+            save_snapshot()
+
+    _snapshot_thread = threading.Thread(target=run_snapshots, name="presence", daemon=True)
+    _snapshot_thread.start()
+    atexit.register(save_snapshot)
+    logger.info(f"✅ Índice de presencia iniciado ({loaded} posiciones recuperadas)")
+
+
+add_user_change_listener(_forget_if_not_carrier)
@@ -0,0 +1,101 @@
+# ranking.py
+import heapq
+import os
+import time
+from config import logger
+from db import iter_ranking_candidates, get_carrier_vehicles
+from geography_db import get_zone_distances_from
+
+# Pesos de cada criterio (se normalizan: solo importa su proporción)
+RANKING_WEIGHTS = {
+    'budget': float(os.getenv('RANK_WEIGHT_BUDGET', 0.35)),
+    'recency': float(os.getenv('RANK_WEIGHT_RECENCY', 0.30)),
+    'distance': float(os.getenv('RANK_WEIGHT_DISTANCE', 0.20)),
+    'fit': float(os.getenv('RANK_WEIGHT_FIT', 0.15)),
+}
+# Presupuesto por tonelada que puntúa 0.5 (la escala satura por encima)
+RANK_BUDGET_PER_TON_REF = float(os.getenv('RANK_BUDGET_PER_TON_REF', 1000))
+# Horas en las que la puntuación por antigüedad cae a la mitad
+RANK_HALF_LIFE_HOURS = float(os.getenv('RANK_HALF_LIFE_HOURS', 12))
+# Distancia (km) a la que la puntuación por cercanía cae a la mitad
+RANK_DISTANCE_SCALE_KM = float(os.getenv('RANK_DISTANCE_SCALE_KM', 20))
+# Carga estimada mínima (t): las solicitudes no indican peso, se usa el requisito de capacidad
+RANK_MIN_TONS = float(os.getenv('RANK_MIN_TONS', 0.25))
+RANK_FETCH_SIZE = int(os.getenv('RANK_FETCH_SIZE', 200))
+
+
+class RankingContext:
+    """Datos del transportista que se calculan una vez por ranking."""
+
+    def __init__(self, user_db, now=None):
+        self.now = time.time() if now is None else now
+        self.distances = get_zone_distances_from(user_db.get('zonas_trabajo_ids') or [])
+        self.vehicles = get_carrier_vehicles(user_db['id'])
+        self.vehicle_types = {(tipo or '').casefold() for tipo, _ in self.vehicles}
+        self.capacities = sorted(cap for _, cap in self.vehicles if cap)
+
+
+def budget_score(solicitud):
+    """Presupuesto por tonelada estimada, en [0, 1)."""
+    budget = solicitud['budget']
+    if not budget or budget <= 0:
+        return 0.0
+    per_ton = budget / max(solicitud['min_toneladas'] or 0, RANK_MIN_TONS)
+    return per_ton / (per_ton + RANK_BUDGET_PER_TON_REF)
+
+def recency_score(solicitud, now):
+    """1 recién creada, 0.5 tras RANK_HALF_LIFE_HOURS."""
+    age_hours = max(0.0, now - solicitud['creado_epoch']) / 3600
+    return 0.5 ** (age_hours / RANK_HALF_LIFE_HOURS)
+
+def distance_score(solicitud, distances):
+    """1 en una zona propia, 0.5 a RANK_DISTANCE_SCALE_KM; 0 si la distancia es desconocida."""
+    km = distances.get(solicitud['zona_id'])
+    if km is None:
+        return 0.0
+    return 1 / (1 + km / RANK_DISTANCE_SCALE_KM)
+
+def fit_score(solicitud, context):
+    """
+    1 si tiene un vehículo del tipo pedido; si no, cuánto aprovecha la carga
+    su vehículo más pequeño que la admite (un camión para un paquete puntúa
+    bajo). 0.5 sin vehículos registrados.
+    """
+    if (solicitud['vehicle_type'] or '').casefold() in context.vehicle_types:
+        return 1.0
+    if not context.capacities:
+        return 0.5
+    load = max(solicitud['min_toneladas'] or 0, RANK_MIN_TONS)
+    capacity = next((cap for cap in context.capacities if cap >= load), context.capacities[-1])
+    return min(1.0, load / capacity)
+
+def score_request(solicitud, context, weights=None):
+    weights = weights or RANKING_WEIGHTS
+    total = sum(weights.values()) or 1
+    return (
+        weights['budget'] * budget_score(solicitud)
+        + weights['recency'] * recency_score(solicitud, context.now)
+        + weights['distance'] * distance_score(solicitud, context.distances)
+        + weights['fit'] * fit_score(solicitud, context)
+    ) / total
+
+
+def rank_requests_for_transportista(user_db, n=5, weights=None, fetch_size=RANK_FETCH_SIZE):
+    """
+    Las `n` mejores solicitudes para el transportista como [(puntuación, fila)],
+    de mayor a menor. Recorre los candidatos en streaming y conserva solo un
+    min-heap de tamaño n: memoria O(n) sea cual sea el número de solicitudes.
+    """
+    try:
+        context = RankingContext(user_db)
+        best = []  # (puntuación, id, fila); a igual puntuación gana la más reciente
+        for solicitud in iter_ranking_candidates(user_db, fetch_size):
+            entry = (score_request(solicitud, context, weights), solicitud['id'], solicitud)
+            if len(best) < n:
+                heapq.heappush(best, entry)
+            elif entry[:2] > best[0][:2]:
+                heapq.heapreplace(best, entry)
+        return [(score, solicitud) for score, _, solicitud in sorted(best, reverse=True)]
+    except Exception as e:
+        logger.error(f"Error calculando el ranking para el transportista {user_db.get('telegram_id', 'unknown')}: {e}")
+        return []
@@ -1,14 +1,47 @@
 # scheduler.py
+import os
 import threading
 import time
-from config import logger 
+from config import logger, REQUEST_ARCHIVABLE_STATES
+from db import archive_solicitudes_batch
+from expirations import init_expirations
+
+# Antigüedad mínima (días) de una solicitud finalizada para archivarla
+ARCHIVE_AFTER_DAYS = float(os.getenv('ARCHIVE_AFTER_DAYS', 30))
+# Filas movidas por transacción; lotes pequeños no bloquean a los writers del webhook
+ARCHIVE_BATCH_SIZE = int(os.getenv('ARCHIVE_BATCH_SIZE', 1000))
+# Pausa entre lotes para ceder el bloqueo de escritura
+ARCHIVE_BATCH_PAUSE = float(os.getenv('ARCHIVE_BATCH_PAUSE', 0.05))
 
 def tarea_limpieza_solicitudes():
+    """Archiva por lotes las solicitudes cerradas, expiradas o canceladas antiguas."""
     logger.info("🧹 Ejecutando tarea de limpieza de solicitudes programada.")
-    # Aquí iría la lógica para eliminar solicitudes antiguas o procesar pagos.
-    pass
+    start = time.monotonic()
+    cutoff = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(time.time() - ARCHIVE_AFTER_DAYS * 86400))
+    moved = 0
+    batches = 0
+
+    try:
+        while True:
+            count = archive_solicitudes_batch(REQUEST_ARCHIVABLE_STATES, cutoff, ARCHIVE_BATCH_SIZE)
+            if not count:
+                break
+            moved += count
+            batches += 1
+            if count < ARCHIVE_BATCH_SIZE:
+                break
+            time.sleep(ARCHIVE_BATCH_PAUSE)
+    except Exception as e:
+        logger.error(f"❌ Error archivando solicitudes (movidas hasta ahora: {moved}): {e}")
+
+    elapsed = time.monotonic() - start
+    logger.info(f"✅ Limpieza completada: {moved} solicitudes archivadas en {batches} lotes ({elapsed:.2f} s)")
+    return {'moved': moved, 'batches': batches, 'seconds': elapsed}
 
 def init_scheduler():
+    # Expiraciones de confirmación: hilo propio con precisión de segundos
+    init_expirations()
+
     def run_scheduled_jobs():
         logger.info("⚙️ Hilo del Scheduler iniciado y corriendo.")
         while True:
@@ -0,0 +1,51 @@
+# search.py
+import os
+import re
+import unicodedata
+from db import LRUCache, search_solicitudes
+
+# Resultados cacheados por consulta normalizada: una consulta inline se repite
+# en cada tecla y entre usuarios
+SEARCH_CACHE_TTL = int(os.getenv('SEARCH_CACHE_TTL', 30))
+SEARCH_CACHE_MAX = int(os.getenv('SEARCH_CACHE_MAX', 2000))
+SEARCH_RESULTS_LIMIT = 20
+# Longitud mínima de la última palabra para buscarla como prefijo ("haba" → "habana")
+SEARCH_MIN_PREFIX = 3
+SEARCH_MAX_TERMS = 8
+
+WORD_RE = re.compile(r'\w+')
+
+_results_cache = LRUCache(SEARCH_CACHE_MAX, ttl=SEARCH_CACHE_TTL)
+
+
+def normalize_query(text):
+    """Términos de búsqueda sin tildes ni mayúsculas: 'Colchón  HABANA' → ('colchon', 'habana')."""
+    decomposed = unicodedata.normalize('NFKD', text or '')
+    plain = ''.join(ch for ch in decomposed if not unicodedata.combining(ch)).casefold()
+    return tuple(WORD_RE.findall(plain)[:SEARCH_MAX_TERMS])
+
+
+def build_match_expression(terms):
+    """
+    Expresión MATCH de FTS5: todos los términos entre comillas (sin sintaxis
+    FTS del usuario) y la última palabra como prefijo mientras se escribe.
+    """
+    quoted = [f'"{term}"' for term in terms]
+    if len(terms[-1]) >= SEARCH_MIN_PREFIX:
+        quoted[-1] += '*'
+    return ' '.join(quoted)
+
+
+def search_active_solicitudes(text, offset=0, limit=SEARCH_RESULTS_LIMIT):
+    """Solicitudes activas que contienen todos los términos, ordenadas por bm25."""
+    terms = normalize_query(text)
+    if not terms:
+        return []
+
+    key = (terms, offset, limit)
+    hit, results = _results_cache.get(key)
+    if hit:
+        return results
+    results = search_solicitudes(build_match_expression(terms), limit, offset)
+    _results_cache.put(key, results)
+    return results